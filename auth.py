@@ -126,7 +126,8 @@ def sign_in(username: str, password: str) -> bool:
             st.session_state.group_id = None # Ensure user is not in a group upon new login
             st.session_state.webrtc_ctx = None # Clear any previous WebRTC context
             st.session_state.chat_messages = [] # Clear chat history on new login
-            st.session_state.uploaded_video_bytes = None # Clear any previously uploaded video
+            st.session_state.uploaded_video_path = None # Clear any previously uploaded video
+            st.session_state.video_url = None
             return True
         else:
             logger.warning(f"Sign in failed: Incorrect password for username '{username}'.")
@@ -140,7 +141,7 @@ def sign_out():
     """Clear user-specific session state variables."""
     user = st.session_state.get("user", "Unknown user")
     # List all keys related to a user session that need clearing
-    keys_to_clear = ["user", "group_id", "webrtc_ctx", "chat_messages", "uploaded_video_bytes"]
+    keys_to_clear = ["user", "group_id", "webrtc_ctx", "chat_messages", "uploaded_video_path", "video_url"]
     for key in keys_to_clear:
         if key in st.session_state:
             del st.session_state[key]
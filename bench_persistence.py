@@ -0,0 +1,321 @@
+# bench_persistence.py
+"""
+Concurrency benchmark and stress test for the group and user stores.
+
+Many workers (threads, like Streamlit sessions in one server, or processes, like
+several app replicas) run a seeded mix of create/join/leave and sign-up/sign-in
+operations against a temporary copy of realistically sized stores. Every worker
+touches its own keys, so the correct final state is known no matter how the
+operations interleave; anything missing at the end is a lost update.
+
+Group backends:
+    json      Legacy baseline: group.load_groups / group.save_groups read-modify-write of
+              groups.json. The app no longer writes groups this way; it is kept to compare against.
+    service   The path the app uses: every worker talks to the membership service through its
+              own membership.MembershipClient, over a real Unix socket served by membership.serve
+              (run on an event loop in a background thread of the benchmark, as the relay does).
+Users always go through auth.load_users / auth.save_users.
+
+Reported per operation: throughput and p50/p95/p99/max latency. Reported overall:
+lost updates (created groups, joins, sign-ups and seed records missing at the end,
+leaves that came back) and failed sign-ins of existing users (torn reads).
+
+Usage:
+    python bench_persistence.py                               # 10k groups, 100k users, 16 threads
+    python bench_persistence.py --backend service --ops 5000
+    python bench_persistence.py --mode processes --workers 8 --json results.json
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+
+import bcrypt
+
+import auth
+import group
+import membership
+from stats import percentile
+
+logger = logging.getLogger(__name__)
+
+# Share of each operation in the mix; a leave without an earlier join becomes a join.
+OP_MIX = {"create": 0.10, "join": 0.30, "leave": 0.10, "sign_up": 0.20, "sign_in": 0.30}
+SEED_PASSWORD = "movie-night"
+SOCKET_NAME = "membership.sock" # In the benchmark's workdir
+
+
+@dataclass
+class BenchConfig:
+    groups: int = 10_000
+    users: int = 100_000
+    ops: int = 2_000 # Total across workers
+    workers: int = 16
+    mode: str = "threads"
+    backend: str = "json"
+    bcrypt_rounds: int = 4 # Minimum cost: measure the stores, not bcrypt
+    seed: int = 1
+    workdir: str = ""
+
+
+@dataclass
+class WorkerResult:
+    latencies: dict = field(default_factory=lambda: {op: [] for op in OP_MIX})
+    errors: dict = field(default_factory=lambda: {op: 0 for op in OP_MIX})
+    created: list = field(default_factory=list) # Group IDs that must exist
+    joined: list = field(default_factory=list) # (group_id, username) that must be members
+    left: list = field(default_factory=list) # (group_id, username) that must not be members
+    signed_up: list = field(default_factory=list) # Usernames that must exist
+    failed_sign_ins: int = 0
+
+
+# --- Store Setup ---
+
+def seed_group_id(i: int) -> str:
+    return f"s{i:07d}"
+
+def seed_username(i: int) -> str:
+    return f"seed-user-{i}"
+
+def configure_paths(workdir: str):
+    """Points the stores at the benchmark's copies (also run as the process-pool initializer)."""
+    # Failed loads/saves are counted in the report; logging each one (with st.error
+    # outside a script run) would dominate the timings.
+    for name in ("streamlit", "auth", "group", "membership"):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+    group.GROUPS_FILE = os.path.join(workdir, "groups.json")
+    auth.USERS_FILE = os.path.join(workdir, "users.json")
+
+def seed_stores(config: BenchConfig):
+    """Writes `groups` groups (two members each) and `users` users in the stores' own formats."""
+    groups = {seed_group_id(i): {"creator": seed_username(i), "video_info": {"filename": f"movie-{i}.mp4", "size": 1 << 30},
+                                 "members": {seed_username(i), seed_username(i + 1)}, "created_at": time.time()}
+              for i in range(config.groups)}
+    membership.write_groups_file(os.path.join(config.workdir, "groups.json"), groups)
+    hashed = bcrypt.hashpw(SEED_PASSWORD.encode("utf-8"), bcrypt.gensalt(config.bcrypt_rounds)).decode("utf-8")
+    with open(os.path.join(config.workdir, "users.json"), "w") as f:
+        json.dump({seed_username(i): hashed for i in range(config.users)}, f, indent=4)
+
+
+# --- Operations ---
+
+def op_create(config, service, group_id, username):
+    record = {"creator": username, "video_info": {"filename": "bench.mp4", "size": 1}, "members": {username}, "created_at": time.time()}
+    if service:
+        return service.create_group(group_id, record)
+    groups = group.load_groups()
+    groups[group_id] = record
+    group.save_groups(groups)
+    return True
+
+def op_join(config, service, group_id, username):
+    if service:
+        return service.join(group_id, username) is not None
+    groups = group.load_groups()
+    if group_id not in groups:
+        return False
+    groups[group_id]["members"].add(username)
+    group.save_groups(groups)
+    return True
+
+def op_leave(config, service, group_id, username):
+    if service:
+        return bool(service.leave(group_id, username))
+    groups = group.load_groups()
+    if group_id not in groups:
+        return False
+    groups[group_id]["members"].discard(username)
+    group.save_groups(groups)
+    return True
+
+def op_sign_up(username: str, hashed: str) -> bool:
+    # auth.sign_up's persistence path, minus the per-call bcrypt cost and Streamlit messages.
+    users = auth.load_users()
+    if username in users:
+        return False
+    users[username] = hashed
+    auth.save_users(users)
+    return True
+
+def op_sign_in(username: str) -> bool:
+    stored = auth.load_users().get(username)
+    return bool(stored) and bcrypt.checkpw(SEED_PASSWORD.encode("utf-8"), stored.encode("utf-8"))
+
+def start_service(workdir: str):
+    """
+    Hosts a MembershipRegistry over the benchmark's groups.json on a Unix socket, served from
+    an event loop in a background thread.
+
+    Returns:
+        tuple: (registry, loop, server); pass it to stop_service().
+    """
+    registry = membership.MembershipRegistry(os.path.join(workdir, "groups.json"), write_behind=True)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="bench-membership-service", daemon=True).start()
+    server = asyncio.run_coroutine_threadsafe(membership.serve(registry, os.path.join(workdir, SOCKET_NAME)), loop).result()
+    return registry, loop, server
+
+def stop_service(registry, loop, server):
+    async def close():
+        server.close()
+        await server.wait_closed()
+    asyncio.run_coroutine_threadsafe(close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    registry.close()
+
+def run_worker(config: BenchConfig, worker: int) -> WorkerResult:
+    """Runs this worker's share of the seeded operation mix."""
+    rng = random.Random(config.seed * 1_000_003 + worker)
+    service = membership.MembershipClient(os.path.join(config.workdir, SOCKET_NAME)) if config.backend == "service" else None
+    hashed = bcrypt.hashpw(SEED_PASSWORD.encode("utf-8"), bcrypt.gensalt(config.bcrypt_rounds)).decode("utf-8")
+    result = WorkerResult()
+    pending_leaves = []
+    ops = config.ops // config.workers + (worker < config.ops % config.workers)
+    names, weights = zip(*OP_MIX.items())
+    for n in range(ops):
+        op = rng.choices(names, weights)[0]
+        if op == "leave" and not pending_leaves:
+            op = "join"
+        own_name = f"w{worker}-{n}"
+        started = time.perf_counter()
+        try:
+            if op == "create":
+                ok = op_create(config, service, own_name, own_name)
+                if ok: result.created.append(own_name)
+            elif op == "join":
+                target = seed_group_id(rng.randrange(config.groups))
+                ok = op_join(config, service, target, own_name)
+                if ok: pending_leaves.append((target, own_name))
+            elif op == "leave":
+                target, name = pending_leaves.pop(rng.randrange(len(pending_leaves)))
+                ok = op_leave(config, service, target, name)
+                if ok: result.left.append((target, name))
+            elif op == "sign_up":
+                ok = op_sign_up(own_name, hashed)
+                if ok: result.signed_up.append(own_name)
+            else:
+                ok = op_sign_in(seed_username(rng.randrange(config.users)))
+                if not ok: result.failed_sign_ins += 1
+            if not ok:
+                result.errors[op] += 1
+        except Exception as e:
+            logger.debug(f"Worker {worker} {op} failed: {e}")
+            result.errors[op] += 1
+        result.latencies[op].append(time.perf_counter() - started)
+    result.joined = pending_leaves # Joins that were never undone must still be there
+    if service:
+        service.close()
+    return result
+
+
+# --- Verification and Report ---
+
+def count_lost_updates(config: BenchConfig, results: list, registry=None) -> dict:
+    """Compares the final stores with what the successful operations guarantee."""
+    if registry is not None:
+        get = registry.get_group
+    else:
+        groups = membership.read_groups_file(os.path.join(config.workdir, "groups.json"))
+        get = lambda gid: groups.get(gid)
+    with open(os.path.join(config.workdir, "users.json"), "r") as f:
+        users = json.load(f)
+    members = lambda gid: set((get(gid) or {}).get("members", ()))
+    return {
+        "groups_lost": sum(get(gid) is None for r in results for gid in r.created),
+        "joins_lost": sum(name not in members(gid) for r in results for gid, name in r.joined),
+        "leaves_undone": sum(name in members(gid) for r in results for gid, name in r.left),
+        "sign_ups_lost": sum(name not in users for r in results for name in r.signed_up),
+        "seed_groups_lost": sum(get(seed_group_id(i)) is None for i in range(config.groups)),
+        "seed_users_lost": sum(seed_username(i) not in users for i in range(config.users)),
+    }
+
+def run_benchmark(config: BenchConfig) -> dict:
+    config.workdir = tempfile.mkdtemp(prefix="bench_persistence_")
+    registry = service = None
+    try:
+        configure_paths(config.workdir)
+        started = time.perf_counter()
+        seed_stores(config)
+        logger.info(f"Seeded {config.groups} groups and {config.users} users in {time.perf_counter() - started:.1f}s ({config.workdir})")
+        if config.backend == "service":
+            service = start_service(config.workdir)
+            registry = service[0]
+
+        if config.mode == "processes":
+            pool = concurrent.futures.ProcessPoolExecutor(config.workers, initializer=configure_paths, initargs=(config.workdir,))
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(config.workers)
+        started = time.perf_counter()
+        with pool:
+            results = list(pool.map(run_worker, [config] * config.workers, range(config.workers)))
+        elapsed = time.perf_counter() - started
+
+        operations = {}
+        for op in OP_MIX:
+            latencies = sorted(l for r in results for l in r.latencies[op])
+            operations[op] = {
+                "count": len(latencies),
+                "errors": sum(r.errors[op] for r in results),
+                "throughput_per_s": len(latencies) / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+            }
+        return {
+            "config": {key: value for key, value in vars(config).items() if key != "workdir"},
+            "elapsed_s": elapsed,
+            "throughput_per_s": sum(o["count"] for o in operations.values()) / elapsed if elapsed else 0.0,
+            "operations": operations,
+            "lost_updates": count_lost_updates(config, results, registry),
+            "failed_sign_ins": sum(r.failed_sign_ins for r in results),
+        }
+    finally:
+        if service:
+            stop_service(*service)
+        shutil.rmtree(config.workdir, ignore_errors=True)
+
+def format_report(report: dict) -> str:
+    columns = ["count", "errors", "throughput_per_s", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+    table = [["op"] + columns] + [[op] + [f"{row[c]:.1f}" if isinstance(row[c], float) else str(row[c]) for c in columns]
+                                  for op, row in report["operations"].items()]
+    widths = [max(len(r[i]) for r in table) for i in range(len(table[0]))]
+    lines = ["  ".join(cell.ljust(w) for cell, w in zip(r, widths)) for r in table]
+    lines.append(f"total: {report['throughput_per_s']:.1f} ops/s over {report['elapsed_s']:.1f}s")
+    lines.append("lost updates: " + ", ".join(f"{k}={v}" for k, v in report["lost_updates"].items()))
+    lines.append(f"failed sign-ins of existing users: {report['failed_sign_ins']}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress the group and user stores with concurrent sessions.")
+    defaults = BenchConfig()
+    parser.add_argument("--groups", type=int, default=defaults.groups, help="Groups in the seeded store")
+    parser.add_argument("--users", type=int, default=defaults.users, help="Users in the seeded store")
+    parser.add_argument("--ops", type=int, default=defaults.ops, help="Operations across all workers")
+    parser.add_argument("--workers", type=int, default=defaults.workers, help="Concurrent sessions")
+    parser.add_argument("--mode", choices=["threads", "processes"], default=defaults.mode, help="Sessions as threads (one app server) or processes (replicas)")
+    parser.add_argument("--backend", choices=["json", "service"], default=defaults.backend, help="Group store to exercise (json is the legacy baseline)")
+    parser.add_argument("--bcrypt-rounds", type=int, default=defaults.bcrypt_rounds, help="bcrypt cost of the stored hashes")
+    parser.add_argument("--seed", type=int, default=defaults.seed, help="Seed of the operation mix")
+    parser.add_argument("--json", metavar="PATH", help="Also write the report as JSON")
+    args = parser.parse_args()
+
+    config = BenchConfig(args.groups, args.users, args.ops, args.workers, args.mode, args.backend, args.bcrypt_rounds, args.seed)
+    report = run_benchmark(config)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
+        logger.info(f"Wrote report to {args.json}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,134 @@
+# capture.py
+"""
+Records the frames clients send to the relay (server.py) so real traffic can be
+replayed later with replay.py.
+
+A capture is a gzip-compressed JSON-lines file. The first line is a header:
+    {"format": "relay-capture", "version": 1, "startedAt": <epoch seconds>}
+Every following line is one record:
+    [t, conn, groupId, frame]
+where t is the offset in seconds from the start of the capture, conn a small integer
+identifying the connection, groupId the frame's group (or null) and frame the raw text
+the client sent. A record whose frame is null marks the connection closing.
+
+Configured through environment variables:
+    RELAY_CAPTURE_FILE     Where to write the capture; unset disables capturing.
+    RELAY_CAPTURE_REDACT   Replace chat text with same-length filler (default 1).
+"""
+import gzip
+import itertools
+import json
+import logging
+import os
+import time
+import weakref
+
+# Configure logger for this module
+logger = logging.getLogger(__name__)
+
+CAPTURE_FILE = os.environ.get("RELAY_CAPTURE_FILE") or None
+CAPTURE_REDACT = os.environ.get("RELAY_CAPTURE_REDACT", "1") != "0"
+CAPTURE_FORMAT = "relay-capture"
+CAPTURE_VERSION = 1
+
+
+class CaptureError(Exception):
+    """Raised when a file is not a readable relay capture."""
+
+
+def redact_frame(data: dict) -> str:
+    """Re-serializes a chat frame with its text replaced by filler of the same length."""
+    data = dict(data, text="x" * len(str(data.get("text", ""))))
+    return json.dumps(data)
+
+
+class Capture:
+    """Appends incoming relay frames to a capture file. A disabled capture ignores every call."""
+
+    def __init__(self, path: str | None = None, redact: bool = CAPTURE_REDACT):
+        self.path = path
+        self.redact = redact
+        self.records = 0
+        self._file = None
+        self._ids = weakref.WeakKeyDictionary()
+        self._next_id = itertools.count(1)
+        self._start = time.monotonic()
+        if path:
+            self._file = gzip.open(path, "wt", encoding="utf-8")
+            self._file.write(json.dumps({"format": CAPTURE_FORMAT, "version": CAPTURE_VERSION, "startedAt": time.time()}) + "\n")
+            logger.info(f"Capturing incoming relay frames to {path}{' (chat text redacted)' if redact else ''}")
+
+    @classmethod
+    def from_env(cls) -> "Capture":
+        return cls(CAPTURE_FILE, CAPTURE_REDACT)
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def connection_id(self, connection) -> int:
+        conn_id = self._ids.get(connection)
+        if conn_id is None:
+            conn_id = self._ids[connection] = next(self._next_id)
+        return conn_id
+
+    def frame(self, connection, raw: str, data: dict | None = None):
+        """
+        Records one frame received on `connection`.
+
+        Args:
+            connection: The client's websocket.
+            raw (str): The frame exactly as received.
+            data (dict, optional): The parsed frame, if it was valid JSON.
+        """
+        if not self._file:
+            return
+        group_id = data.get("groupId") if isinstance(data, dict) else None
+        if self.redact and isinstance(data, dict) and data.get("type") == "chat":
+            raw = redact_frame(data)
+        self._write([round(time.monotonic() - self._start, 4), self.connection_id(connection), group_id, raw])
+
+    def closed(self, connection):
+        """Records that `connection` went away."""
+        if self._file:
+            self._write([round(time.monotonic() - self._start, 4), self.connection_id(connection), None, None])
+
+    def _write(self, record: list):
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.records += 1
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+            logger.info(f"Capture closed after {self.records} records: {self.path}")
+
+
+def read_capture(path: str) -> tuple[dict, list]:
+    """
+    Reads a capture written by Capture.
+
+    A capture cut short (e.g. the relay was killed) is read up to its last complete record.
+
+    Returns:
+        tuple[dict, list]: The header and the list of [t, conn, groupId, frame] records.
+
+    Raises:
+        CaptureError: If the file is not a relay capture.
+    """
+    records = []
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline() or "null")
+            if not isinstance(header, dict) or header.get("format") != CAPTURE_FORMAT:
+                raise CaptureError(f"{path} is not a relay capture")
+            if header.get("version") != CAPTURE_VERSION:
+                raise CaptureError(f"Unsupported capture version {header.get('version')} in {path}")
+            try:
+                for line in f:
+                    records.append(json.loads(line))
+            except (EOFError, json.JSONDecodeError):
+                logger.warning(f"Capture {path} is truncated; using the first {len(records)} records")
+    except (OSError, json.JSONDecodeError) as e:
+        raise CaptureError(f"Could not read capture {path}: {e}") from e
+    return header, records
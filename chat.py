@@ -3,14 +3,28 @@ import streamlit as st
 import time # Keep for potential timestamp formatting if needed
 import logging
 import json # Keep for potential formatting/parsing if needed
+import html
+import sqlite3
+import uuid
+from collections import OrderedDict, deque
+from itertools import chain, islice
+
+import chat_store
+import timing
 
 # Configure logger for this module
 logger = logging.getLogger(__name__)
 
+CHAT_PAGE_SIZE = 30 # Number of messages rendered per "page" in the chat pane
+MAX_CHAT_HISTORY = 100 # Live messages kept in memory per session
+MAX_EARLIER_MESSAGES = 10 * CHAT_PAGE_SIZE # Paged-back messages kept in memory; the oldest are dropped past this
+MAX_SEEN_IDS = 1000 # Recent message IDs remembered for duplicate suppression
+
 def initialize_chat_state():
     """Initializes chat messages list in session state if not present."""
-    if "chat_messages" not in st.session_state:
-        st.session_state.chat_messages = []
+    # Other modules reset the history with a plain list; normalize it to our structures.
+    if not isinstance(st.session_state.get("chat_messages"), deque):
+        reset_chat_state()
         logger.debug("Chat message state initialized.")
     # Also initialize a flag for messages needing JS action
     if "new_outgoing_message" not in st.session_state:
@@ -18,38 +32,204 @@ def initialize_chat_state():
     if "received_message_from_js" not in st.session_state:
         st.session_state.received_message_from_js = None
 
+def reset_chat_state():
+    """Clears the chat history and rendering window (e.g., when joining or leaving a group)."""
+    # Live tail of the conversation; the deque drops the oldest entry itself once full.
+    st.session_state.chat_messages = deque(maxlen=MAX_CHAT_HISTORY)
+    # Older pages pulled from the store on demand (oldest first), shown before the tail.
+    st.session_state.chat_earlier_messages = []
+    # Bounded, insertion-ordered set of recently seen message IDs for O(1) duplicate checks.
+    st.session_state.chat_seen_ids = OrderedDict()
+    st.session_state.chat_visible_count = CHAT_PAGE_SIZE
+    # Which group's persisted history is loaded, and whether older pages remain in the store
+    st.session_state.chat_history_group = None
+    st.session_state.chat_history_has_more = False
+
+def _remember_message_id(msg_id: str) -> bool:
+    """
+    Records a message ID in the recent-ID set.
+
+    Args:
+        msg_id (str): The sender-assigned message ID.
+
+    Returns:
+        bool: False if the ID was already seen (i.e., the message is a duplicate).
+    """
+    seen_ids = st.session_state.chat_seen_ids
+    if msg_id in seen_ids:
+        return False
+    seen_ids[msg_id] = None
+    if len(seen_ids) > MAX_SEEN_IDS:
+        seen_ids.popitem(last=False) # Forget the oldest ID
+    return True
+
+def new_message_id() -> str:
+    """Returns a unique ID for an outgoing chat message."""
+    return uuid.uuid4().hex
+
+def get_message_count() -> int:
+    """Returns the number of messages currently held in memory (earlier pages + live tail)."""
+    return len(st.session_state.chat_earlier_messages) + len(st.session_state.chat_messages)
+
+def get_visible_messages(count: int) -> list:
+    """
+    Returns the newest `count` messages in memory, oldest first.
+
+    Args:
+        count (int): The size of the rendering window.
+
+    Returns:
+        list: The message dictionaries to render.
+    """
+    tail = st.session_state.chat_messages
+    if count <= len(tail):
+        return list(islice(tail, len(tail) - count, None))
+    earlier = st.session_state.chat_earlier_messages
+    return earlier[-(count - len(tail)):] + list(tail)
+
+def load_chat_history(group_id: str):
+    """
+    Replaces the in-memory chat with the most recent page of the group's persisted history.
+
+    Args:
+        group_id (str): The group whose history to load.
+    """
+    reset_chat_state()
+    try:
+        messages, has_more = chat_store.load_page(group_id, limit=CHAT_PAGE_SIZE)
+    except sqlite3.Error as e:
+        logger.error(f"Error loading chat history for group {group_id}: {e}", exc_info=True)
+        st.toast("⚠️ Couldn't load earlier messages.", icon="💬")
+        messages, has_more = [], False
+    for msg in messages:
+        if msg.get("id"):
+            _remember_message_id(msg["id"])
+        st.session_state.chat_messages.append(msg)
+    st.session_state.chat_history_group = group_id
+    st.session_state.chat_history_has_more = has_more
+    logger.info(f"Loaded {len(messages)} persisted messages for group {group_id}.")
+
+def load_older_messages(group_id: str) -> int:
+    """
+    Prepends the next older page of persisted history, using the oldest loaded
+    message's sequence number as the cursor.
+
+    Args:
+        group_id (str): The group whose history to page through.
+
+    Returns:
+        int: The number of messages added.
+    """
+    room = MAX_EARLIER_MESSAGES - len(st.session_state.chat_earlier_messages)
+    if room <= 0:
+        # Scrolling back is limited to what the pane keeps in memory; the rest stays in the store.
+        logger.debug(f"Not loading older messages for group {group_id}: {MAX_EARLIER_MESSAGES} already loaded.")
+        st.session_state.chat_history_has_more = False
+        return 0
+    loaded = chain(st.session_state.chat_earlier_messages, st.session_state.chat_messages)
+    before_seq = next((m["seq"] for m in loaded if m.get("seq") is not None), None)
+    if before_seq is None:
+        st.session_state.chat_history_has_more = False
+        return 0
+    try:
+        messages, has_more = chat_store.load_page(group_id, before_seq=before_seq, limit=min(CHAT_PAGE_SIZE, room))
+    except sqlite3.Error as e:
+        logger.error(f"Error loading older chat messages for group {group_id}: {e}", exc_info=True)
+        st.toast("⚠️ Couldn't load earlier messages.", icon="💬")
+        return 0
+    for msg in messages:
+        if msg.get("id"):
+            _remember_message_id(msg["id"])
+    st.session_state.chat_earlier_messages = messages + st.session_state.chat_earlier_messages
+    st.session_state.chat_history_has_more = has_more
+    return len(messages)
+
 
 # REMOVED: create_chat_message - The JS will format the outgoing message.
 # REMOVED: send_chat_message - The JS will send via WebSocket.
 
-def add_message_to_state(message_data: dict):
+def add_message_to_state(message_data: dict) -> bool:
     """
     Adds a message dictionary (received via JS component or locally generated)
-    to the session state list for display history.
+    to the session state history for display.
+
+    Duplicates are detected by the sender-assigned 'id', so re-deliveries after a
+    rerun or reconnect are dropped regardless of the order they arrive in.
 
     Args:
-        message_data (dict): The message dictionary (must include sender, text, time).
-    """
-    initialize_chat_state() # Ensure list exists
-
-    # Prevent duplicates if possible (e.g., based on a unique message ID if added)
-    # Simple check based on content and recent time might work but is imperfect.
-    # For now, we rely on logic elsewhere to not call this excessively for the same message.
-
-    if all(k in message_data for k in ("sender", "text", "time")):
-        # Ensure message isn't already the very last one added to prevent rapid duplicates
-        if not st.session_state.chat_messages or st.session_state.chat_messages[-1] != message_data:
-             st.session_state.chat_messages.append(message_data)
-             logger.debug(f"Added message to state: {message_data['sender']}: {message_data['text']}")
-             # Limit chat history size (optional)
-             max_history = 100
-             if len(st.session_state.chat_messages) > max_history:
-                 st.session_state.chat_messages = st.session_state.chat_messages[-max_history:]
-        else:
-             logger.debug(f"Skipped adding potential duplicate message to state: {message_data}")
+        message_data (dict): The message dictionary (must include sender, text, time;
+                             should include id).
+
+    Returns:
+        bool: True if the message was added, False if it was invalid or a duplicate.
+    """
+    initialize_chat_state() # Ensure history exists
 
-    else:
+    if not all(k in message_data for k in ("sender", "text", "time")):
         logger.warning(f"Attempted to add invalid message data to state: {message_data}")
+        return False
+
+    msg_id = message_data.get("id")
+    if msg_id is None:
+        # Messages from older clients carry no ID and can't be de-duplicated.
+        logger.debug(f"Message without id added without duplicate check: {message_data}")
+    elif not _remember_message_id(msg_id):
+        logger.debug(f"Skipped duplicate message {msg_id} from {message_data['sender']}")
+        return False
+
+    messages = st.session_state.chat_messages
+    if len(messages) == messages.maxlen:
+        if st.session_state.chat_earlier_messages:
+            # The user has paged back; keep the evicted message visible so there is no gap.
+            earlier = st.session_state.chat_earlier_messages
+            earlier.append(messages[0])
+            if len(earlier) > MAX_EARLIER_MESSAGES:
+                # Drop the oldest loaded message (it stays in the store). The pane is full, so
+                # there is no paging further back until the history is reloaded.
+                del earlier[0]
+                st.session_state.chat_history_has_more = False
+        else:
+            # The evicted message is still in the store; let the user page back to it.
+            st.session_state.chat_history_has_more = True
+    messages.append(message_data)
+    logger.debug(f"Added message to state: {message_data['sender']}: {message_data['text']}")
+    return True
+
+
+def render_message_html(msg: dict, current_user: str | None) -> str:
+    """
+    Builds the HTML for a single chat bubble.
+
+    Args:
+        msg (dict): The message dictionary (sender, text, time).
+        current_user (str | None): The logged-in user, used to align sent/received bubbles.
+
+    Returns:
+        str: The escaped HTML for the bubble.
+    """
+    # Align sent/received using CSS classes defined in styles.css
+    bubble_class = "sent" if msg['sender'] == current_user else "received"
+    return (
+        '<div class="chat-bubble-container">'
+        f'<div class="chat-bubble {bubble_class}">'
+        f'<span class="chat-sender-time">{html.escape(str(msg["sender"]))} ({html.escape(str(msg["time"]))})</span>'
+        f'<span class="chat-text">{html.escape(str(msg["text"]))}</span>'
+        '</div></div>'
+    )
+
+def build_chat_html(messages: list, current_user: str | None) -> str:
+    """
+    Joins a window of messages into one HTML block so the whole chat pane is
+    sent to the browser as a single element.
+
+    Args:
+        messages (list): The message dictionaries to render, oldest first.
+        current_user (str | None): The logged-in user.
+
+    Returns:
+        str: The HTML for all bubbles.
+    """
+    return "".join(render_message_html(msg, current_user) for msg in messages)
 
 
 def render_chat_interface(group_id: str):
@@ -61,6 +241,9 @@ def render_chat_interface(group_id: str):
         group_id (str): Unique identifier for the group (used for input key).
     """
     initialize_chat_state()
+    # Opening a room (or coming back after a restart) loads only the last page from disk.
+    if st.session_state.chat_history_group != group_id:
+        load_chat_history(group_id)
 
     st.markdown("### Chat with Your Loved One 💬")
 
@@ -70,22 +253,24 @@ def render_chat_interface(group_id: str):
         if not st.session_state.chat_messages:
             st.caption("Say hello! ✨") # Placeholder when chat is empty
         else:
-            # Display messages stored in session state
-            for msg in st.session_state.chat_messages:
-                # Align sent/received using CSS classes (needs styles.css update)
-                bubble_class = "sent" if msg['sender'] == st.session_state.get('user') else "received"
-                # Use the CSS classes defined in styles.css
-                st.markdown(
-                    f"""
-                    <div class="chat-bubble-container">
-                        <div class="chat-bubble {bubble_class}">
-                            <span class="chat-sender-time">{msg['sender']} ({msg['time']})</span>
-                            <span class="chat-text">{msg['text']}</span>
-                        </div>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
+            # Only the newest `chat_visible_count` messages are materialized;
+            # older ones are revealed a page at a time with the button below,
+            # first from memory and then from the persisted history.
+            visible_count = min(st.session_state.chat_visible_count, get_message_count())
+            if visible_count < get_message_count() or st.session_state.chat_history_has_more:
+                # The button is drawn above the bubbles, so growing the window here
+                # takes effect in this same run (no extra st.rerun()).
+                if st.button("Load older messages ⬆️", key=f"load_older_{group_id}", use_container_width=True):
+                    if visible_count >= get_message_count():
+                        load_older_messages(group_id)
+                    st.session_state.chat_visible_count += CHAT_PAGE_SIZE
+                    visible_count = min(st.session_state.chat_visible_count, get_message_count())
+            # Render the whole window as ONE markdown element so each rerun sends
+            # a single delta instead of one per message.
+            st.markdown(
+                build_chat_html(get_visible_messages(visible_count), st.session_state.get('user')),
+                unsafe_allow_html=True
+            )
 
     # --- Chat Input Area ---
     # We still need the input box in Streamlit
@@ -108,22 +293,28 @@ def render_chat_interface(group_id: str):
                 "sender": st.session_state.get("user", "unknown"),
                 "text": message_text,
                 "time": time.strftime("%H:%M"),
-                # Consider adding a temporary client-side ID for tracking?
-                # "clientId": str(uuid.uuid4()) # Requires import uuid
+                "id": new_message_id(), # Lets every receiver drop re-deliveries
             }
-            # 2. Add message to local state immediately for display
+            # 2. Persist it to the group's history. Only the sender writes, so each
+            #    message is stored once; the seq travels with it to the partner.
+            try:
+                msg_data["seq"] = chat_store.append_message(group_id, msg_data)
+            except sqlite3.Error as e:
+                logger.error(f"Error saving chat message for group {group_id}: {e}", exc_info=True)
+                st.toast("⚠️ Message sent but not saved to history.", icon="💬")
+            # 3. Add message to local state immediately for display
             add_message_to_state(msg_data)
 
-            # 3. Set the flag/value for the JS component to pick up on the next run
+            # 4. Set the flag/value for the JS component to pick up on the next run
             #    The JS component script will read this, send via WebSocket,
             #    and potentially clear it using Streamlit.setComponentValue
             st.session_state.new_outgoing_message = msg_data
 
-            # 4. Rerun to update the chat display and pass the signal to the JS component
+            # 5. Rerun to update the chat display and pass the signal to the JS component
             # We need to clear the input manually now if possible, st.rerun helps but isn't guaranteed
             # Setting text_input value back requires more complex state management or forms.
             # For now, new_outgoing_message flag + rerun is the core mechanism.
-            st.rerun()
+            timing.rerun("chat")
         else:
              logger.debug("Send button clicked, but message was empty.")
 
@@ -135,7 +326,10 @@ def render_chat_interface(group_id: str):
     # We check the flag set by the component interaction here.
     if st.session_state.received_message_from_js:
          logger.debug(f"Processing message received from JS: {st.session_state.received_message_from_js}")
-         add_message_to_state(st.session_state.received_message_from_js)
+         received = st.session_state.received_message_from_js
+         # A batched frame from the relay arrives as a list of messages
+         for message in (received if isinstance(received, list) else [received]):
+             add_message_to_state(message)
          # Clear the flag after processing
          st.session_state.received_message_from_js = None
          # Rerun needed ONLY if add_message_to_state actually added something and we want immediate display update
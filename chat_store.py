@@ -0,0 +1,112 @@
+# chat_store.py
+import sqlite3
+import threading
+import time
+import logging
+
+# Configure logger for this module
+logger = logging.getLogger(__name__)
+
+CHAT_DB_FILE = "chat_history.db" # Define filename as a constant
+DEFAULT_PAGE_SIZE = 30
+
+# One connection per thread: Streamlit runs each session's script in its own thread
+# and sqlite3 connections must not be shared across threads.
+_local = threading.local()
+
+def _get_connection() -> sqlite3.Connection:
+    """Returns this thread's connection to the chat database, creating the schema on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "path", None) != CHAT_DB_FILE:
+        conn = sqlite3.connect(CHAT_DB_FILE, timeout=5)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers page through history while another session appends.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                group_id TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                text TEXT NOT NULL,
+                time TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        # Databases created before message IDs existed lack the msg_id column.
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(messages)")}
+        if "msg_id" not in columns:
+            conn.execute("ALTER TABLE messages ADD COLUMN msg_id TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_group_seq ON messages (group_id, seq)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_msg_id ON messages (msg_id)")
+        conn.commit()
+        _local.conn = conn
+        _local.path = CHAT_DB_FILE
+        logger.info(f"Opened chat history database {CHAT_DB_FILE}")
+    return conn
+
+def append_message(group_id: str, message: dict) -> int:
+    """
+    Appends a chat message to a group's history. Existing rows are never rewritten;
+    appending a message whose 'id' is already stored returns the existing seq.
+
+    Args:
+        group_id (str): The group the message belongs to.
+        message (dict): The message dictionary (must include sender, text, time; may include id).
+
+    Returns:
+        int: The sequence number assigned to the message (usable as a pagination cursor).
+
+    Raises:
+        sqlite3.Error: If the database cannot be written.
+    """
+    conn = _get_connection()
+    msg_id = message.get("id")
+    with conn: # Commits on success, rolls back on error
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO messages (group_id, sender, text, time, created_at, msg_id) VALUES (?, ?, ?, ?, ?, ?)",
+            (group_id, message["sender"], message["text"], message["time"], time.time(), msg_id)
+        )
+    if cursor.rowcount == 0:
+        # Already stored (e.g., a retried send); hand back the original position.
+        seq = conn.execute("SELECT seq FROM messages WHERE msg_id = ?", (msg_id,)).fetchone()["seq"]
+        logger.debug(f"Message {msg_id} already in group {group_id} history as {seq}.")
+        return seq
+    logger.debug(f"Appended message {cursor.lastrowid} to group {group_id} history.")
+    return cursor.lastrowid
+
+def load_page(group_id: str, before_seq: int | None = None, limit: int = DEFAULT_PAGE_SIZE) -> tuple[list, bool]:
+    """
+    Loads one page of a group's chat history, newest page first.
+
+    Args:
+        group_id (str): The group whose history to read.
+        before_seq (int, optional): Cursor; only messages older than this sequence number
+                                    are returned. None loads the most recent page.
+        limit (int): Maximum number of messages in the page.
+
+    Returns:
+        tuple[list, bool]: The messages (oldest first, each with 'seq' and 'id' keys) and
+                           whether older messages remain.
+
+    Raises:
+        sqlite3.Error: If the database cannot be read.
+    """
+    conn = _get_connection()
+    # Fetch one extra row to learn whether another page exists without a COUNT(*).
+    if before_seq is None:
+        rows = conn.execute(
+            "SELECT seq, msg_id AS id, sender, text, time FROM messages WHERE group_id = ? ORDER BY seq DESC LIMIT ?",
+            (group_id, limit + 1)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT seq, msg_id AS id, sender, text, time FROM messages WHERE group_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+            (group_id, before_seq, limit + 1)
+        ).fetchall()
+    has_more = len(rows) > limit
+    messages = [dict(row) for row in reversed(rows[:limit])]
+    logger.debug(f"Loaded {len(messages)} messages for group {group_id} before {before_seq} (more: {has_more}).")
+    return messages, has_more
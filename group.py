@@ -5,25 +5,24 @@ import logging
 import time
 import json
 import os
+import secrets
+
+import membership
+import mp4
 
 logger = logging.getLogger(__name__)
 
-GROUPS_FILE = "groups.json" # Define file path
+GROUPS_FILE = membership.GROUPS_FILE
 
 # --- File Persistence Functions ---
+# groups.json is owned by the membership service (see membership.py); these read and
+# write it directly and are only needed for maintenance and offline tooling.
 
-def save_groups(groups: dict): # Moved save_groups up so load_groups can call it
+def save_groups(groups: dict):
     """Saves group data to JSON file."""
     try:
-        groups_to_save = {}
-        for group_id, data in groups.items():
-            data_copy = data.copy()
-            if "members" in data_copy and isinstance(data_copy["members"], set):
-                data_copy["members"] = sorted(list(data_copy["members"]))
-            groups_to_save[group_id] = data_copy
-        with open(GROUPS_FILE, "w") as f:
-            json.dump(groups_to_save, f, indent=4)
-        logger.debug(f"Saved {len(groups_to_save)} groups to {GROUPS_FILE}")
+        membership.write_groups_file(GROUPS_FILE, groups)
+        logger.debug(f"Saved {len(groups)} groups to {GROUPS_FILE}")
     except TypeError as e:
         logger.error(f"Error serializing groups data to JSON: {e}", exc_info=True)
         st.error("⚠️ Failed to save group data due to a data type issue.")
@@ -33,25 +32,11 @@ def save_groups(groups: dict): # Moved save_groups up so load_groups can call it
 
 
 def load_groups() -> dict:
-    """Loads group data from JSON file, creating the file if it doesn't exist."""
-    groups = {}
-    if not os.path.exists(GROUPS_FILE): # Check moved inside
-        logger.info(f"{GROUPS_FILE} not found, creating empty file.")
-        save_groups({}) # Create empty file now
-        return {} # Return empty dict as the file was just created empty
-
-    # File exists, proceed with loading
+    """Loads group data from JSON file."""
     try:
-        with open(GROUPS_FILE, "r") as f:
-            content = f.read()
-            if not content:
-                logger.warning(f"{GROUPS_FILE} is empty. Returning empty dict.")
-                return {}
-            groups = json.loads(content)
-        for group_id, data in groups.items():
-             if "members" in data and isinstance(data["members"], list):
-                 data["members"] = set(data["members"])
+        groups = membership.read_groups_file(GROUPS_FILE)
         logger.debug(f"Loaded {len(groups)} groups from {GROUPS_FILE}")
+        return groups
     except json.JSONDecodeError:
         logger.error(f"Error decoding JSON from {GROUPS_FILE}. File might be corrupted.", exc_info=True)
         st.error("⚠️ Group data file seems corrupted. Check logs. Starting fresh.")
@@ -60,24 +45,40 @@ def load_groups() -> dict:
         logger.error(f"Error loading groups from {GROUPS_FILE}: {e}", exc_info=True)
         st.error("⚠️ An unexpected error occurred while loading group data.")
         return {}
-    return groups
 
 
-# --- Group Management Functions (create_group, join_group, leave_group, etc.) ---
-# ... (Keep the rest of the group.py functions as they were in the previous step) ...
+# --- Group Management Functions ---
+# All reads and writes go through the membership service so the app and the relay
+# agree on which groups exist and who belongs to them.
 
-def create_group(username: str, video_file: st.runtime.uploaded_file_manager.UploadedFile) -> str | None:
+def create_group(username: str, video_file: st.runtime.uploaded_file_manager.UploadedFile, media_info: dict | None = None,
+                 relay_upload_id: str | None = None) -> str | None:
     if not video_file:
         logger.warning(f"User {username} attempted create_group without video file.")
         st.error("Please select a video file first! 🎬")
         return None
-    groups = load_groups()
     try:
+        service = membership.get_service()
         group_id = str(uuid.uuid4())[:8]
         logger.info(f"Attempting to create group {group_id} for user {username} with video '{video_file.name}'")
         video_info = {"filename": video_file.name, "size": video_file.size, "type": video_file.type}
-        groups[group_id] = {"creator": username, "video_info": video_info, "members": {username}, "created_at": time.time()}
-        save_groups(groups)
+        # Probe the container once so the join UI can show duration/codec without decoding
+        # (unless the upload pipeline already did).
+        if media_info is None:
+            try:
+                media_info = mp4.probe(video_file)
+            except mp4.MP4Error as e:
+                logger.warning(f"Could not read metadata of '{video_file.name}': {e}")
+        if media_info:
+            video_info.update({key: media_info.get(key) for key in ("duration", "codec", "bitrate", "width", "height")})
+        if relay_upload_id:
+            # Partners stream the creator's copy from the relay (see server.process_request),
+            # which only serves it to requests carrying the group's media token.
+            video_info["relay_upload_id"] = relay_upload_id
+            video_info["media_token"] = secrets.token_urlsafe(16)
+        record = {"creator": username, "video_info": video_info, "members": {username}, "created_at": time.time()}
+        if not service.create_group(group_id, record):
+            raise membership.MembershipError(f"Group ID {group_id} is already taken")
         logger.info(f"Group {group_id} created and saved successfully.")
         return group_id
     except Exception as e:
@@ -86,24 +87,20 @@ def create_group(username: str, video_file: st.runtime.uploaded_file_manager.Upl
         return None
 
 def join_group(username: str, group_id: str) -> bool:
-    groups = load_groups()
     if not group_id or len(group_id) != 8:
          st.error("Invalid Group ID format. Please check again. 🤔")
          return False
-    if group_id not in groups:
-        logger.warning(f"User {username} failed to join non-existent group {group_id}. Current groups file keys: {list(load_groups().keys())}")
-        st.error("Group ID not found. Maybe it expired or was mistyped? 🤔")
-        return False
     try:
-        group_data = groups[group_id]
-        if username in group_data["members"]:
+        result = membership.get_service().join(group_id, username)
+        if result is None:
+            logger.warning(f"User {username} failed to join non-existent group {group_id}.")
+            st.error("Group ID not found. Maybe it expired or was mistyped? 🤔")
+            return False
+        if result == "already_member":
              logger.info(f"User {username} is already a member of group {group_id}. Allowing join.")
              st.success(f"Welcome back to the movie night, {username}! 🎉")
              return True
-        group_data["members"].add(username)
-        logger.info(f"User {username} added to group {group_id}. Current members: {group_data['members']}")
-        save_groups(groups)
-        logger.info(f"Group {group_id} updated and saved after user {username} joined.")
+        logger.info(f"User {username} added to group {group_id}.")
         st.success(f"Welcome to the movie night, {username}! 🎉")
         return True
     except Exception as e:
@@ -112,37 +109,49 @@ def join_group(username: str, group_id: str) -> bool:
         return False
 
 def leave_group(username: str, group_id: str):
-    groups = load_groups()
-    group_modified = False
-    if group_id not in groups:
-        logger.warning(f"User {username} tried to leave non-existent group {group_id}")
-        return
     try:
-        group_data = groups[group_id]
-        if username in group_data["members"]:
-            group_data["members"].remove(username)
-            logger.info(f"User {username} removed from group {group_id}. Remaining members: {group_data['members']}")
+        result = membership.get_service().leave(group_id, username)
+        if result is None:
+            logger.warning(f"User {username} tried to leave non-existent group {group_id}")
+            return
+        if result["removed"]:
+            logger.info(f"User {username} removed from group {group_id}.")
             st.toast(f"You left the group. See you next time!", icon="👋")
-            group_modified = True
-            if not group_data["members"]:
-                del groups[group_id]
+            if result["deleted"]:
                 logger.info(f"Group {group_id} is now empty and has been deleted.")
         else:
             logger.warning(f"User {username} tried to leave group {group_id} but was not a member.")
-        if group_modified:
-            save_groups(groups)
-            logger.info(f"Group state saved after changes related to user {username} leaving group {group_id}.")
     except Exception as e:
         logger.error(f"Error leaving group {group_id} or saving state for user {username}: {e}", exc_info=True)
 
 def get_group_data(group_id: str) -> dict | None:
-    groups = load_groups()
-    group_data = groups.get(group_id)
-    if group_data: logger.debug(f"Retrieved data for group {group_id} from file.")
-    else: logger.warning(f"Attempted to retrieve data for non-existent group {group_id} from file.")
+    try:
+        group_data = membership.get_service().get_group(group_id)
+    except membership.MembershipError as e:
+        logger.error(f"Could not fetch group {group_id} from the membership service: {e}")
+        return None
+    if group_data:
+        group_data["members"] = set(group_data["members"])
+        logger.debug(f"Retrieved data for group {group_id} from the membership service.")
+    else: logger.warning(f"Attempted to retrieve data for non-existent group {group_id}.")
     return group_data
 
+def get_online_members(group_id: str) -> list:
+    """Users currently connected to the relay in this group (pushed by the membership service)."""
+    watcher = _presence_watcher()
+    if watcher.connected:
+        return watcher.online(group_id)
+    try:
+        return membership.get_service().presence(group_id)
+    except membership.MembershipError:
+        return []
+
+@st.cache_resource
+def _presence_watcher() -> membership.PresenceWatcher:
+    # One watcher thread per Streamlit server process, shared by all sessions.
+    return membership.PresenceWatcher(membership.MEMBERSHIP_SOCKET)
+
 def get_expected_video_info(group_id: str) -> dict | None:
     group_data = get_group_data(group_id)
     if group_data: return group_data.get("video_info")
-    return None
\ No newline at end of file
+    return None
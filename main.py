@@ -6,6 +6,9 @@ from streamlit import cache_data # Correct import for caching data functions
 
 import auth
 import group
+import mp4
+import timing
+import uploads
 # import sync # Not used in WebSocket architecture
 import chat
 import json
@@ -26,13 +29,18 @@ WEBSOCKET_URL = os.environ.get("WEBSOCKET_URL", "ws://localhost:8765") # Use env
 # Or use Streamlit Secrets:
 # WEBSOCKET_URL = st.secrets.get("websocket_url", "ws://localhost:8765")
 logger.info(f"Using WebSocket URL: {WEBSOCKET_URL}")
+# Shared videos are streamed over plain HTTP from the same relay (ws://host -> http://host).
+# st.video only treats strings passing its URL validator as URLs, and bare "localhost" fails it.
+RELAY_MEDIA_URL = os.environ.get("RELAY_MEDIA_URL", WEBSOCKET_URL.replace("ws", "http", 1).replace("://localhost", "://127.0.0.1"))
+# Keyframes handed to the bridge for seek snapping; long videos are thinned to at most this many.
+MAX_BRIDGE_KEYFRAMES = 1000
 
 # --- Initialize Session State ---
 # Use a function to avoid polluting global namespace and ensure keys exist
 def initialize_session():
     defaults = {
         "user": None, "group_id": None, "theme": "Light",
-        "uploaded_video_bytes": None, "user_group_status": None,
+        "uploaded_video_path": None, "video_url": None, "user_group_status": None,
         "chat_messages": [],
         "new_outgoing_message": None, "playback_action_to_send": None, "seek_time_to_send": None,
         "received_message_from_js": None, "outgoing_message_sent_ack": None, "playback_action_sent_ack": None,
@@ -58,6 +66,51 @@ def load_static_file(filepath: str) -> str:
         st.error(f"Error: Required file '{os.path.basename(filepath)}' not found!")
         return "" # Return empty string on error
 
+# Cached per video file (path, size and modification time), so reruns reuse the serialized list.
+@cache_data(max_entries=32)
+def bridge_keyframes(path: str, size: int, mtime_ns: int) -> str:
+    """
+    JSON list of the video's keyframe times for the bridge's data-keyframes attribute.
+
+    Seeks snap to the latest listed keyframe at or before the target, so any subset of real
+    keyframes works as long as every peer gets the same one. Keyframes closer together than
+    duration / MAX_BRIDGE_KEYFRAMES are dropped, which bounds the attribute's size.
+    """
+    video_index = mp4.probe_file(path)
+    keyframes = video_index["keyframes"] if video_index else []
+    spacing = keyframes[-1] / MAX_BRIDGE_KEYFRAMES if keyframes else 0.0
+    thinned = []
+    for t in keyframes:
+        if not thinned or t - thinned[-1] >= spacing:
+            thinned.append(round(t, 3))
+    logger.info(f"Keyframe index for {path}: {len(thinned)} of {len(keyframes)} keyframes sent to the bridge.")
+    return json.dumps(thinned)
+
+# --- Upload Processing ---
+def save_uploaded_video(uploaded_file) -> uploads.ChunkedUpload | None:
+    """
+    Streams an uploaded video to disk chunk by chunk (resuming an interrupted attempt),
+    rewrites it to fast-start layout, and shows progress while doing so.
+
+    Args:
+        uploaded_file: The Streamlit UploadedFile.
+
+    Returns:
+        uploads.ChunkedUpload | None: The stored upload (its path and upload ID), or None if it failed.
+    """
+    progress = st.progress(0.0, text="Saving video...")
+    def report(done, total):
+        progress.progress(done / total if total else 1.0, text=f"Saving video... {done / (1024*1024):.1f} / {total / (1024*1024):.1f} MB")
+    try:
+        return uploads.stream_to_disk(uploaded_file, st.session_state.user, uploaded_file.name, uploaded_file.size,
+                                      progress_callback=report)
+    except (uploads.UploadError, mp4.MP4Error, OSError) as e:
+        logger.error(f"Saving upload '{uploaded_file.name}' for {st.session_state.user} failed: {e}", exc_info=True)
+        st.error("Couldn't save the video. Try again and it will pick up where it stopped. 🙏")
+        return None
+    finally:
+        progress.empty()
+
 # --- Theme Application ---
 def apply_theme_class(theme_name):
     """Injects JavaScript to add/remove the dark-mode class on the body."""
@@ -87,12 +140,14 @@ def main():
     )
 
     # --- Load CSS ---
-    css_code = load_static_file("styles.css")
-    if css_code:
-        st.markdown(f"<style>{css_code}</style>", unsafe_allow_html=True)
+    with timing.section("css"):
+        css_code = load_static_file("styles.css")
+        if css_code:
+            st.markdown(f"<style>{css_code}</style>", unsafe_allow_html=True)
 
     # --- Apply Theme ---
-    apply_theme_class(st.session_state.theme)
+    with timing.section("theme"):
+        apply_theme_class(st.session_state.theme)
 
     # --- Sidebar ---
     with st.sidebar:
@@ -106,7 +161,7 @@ def main():
         )
         if selected_theme != st.session_state.theme:
             st.session_state.theme = selected_theme
-            st.rerun() # Rerun needed to apply theme class
+            timing.rerun("button") # Rerun needed to apply theme class
         st.markdown("---")
         # User Welcome / Sign Out
         if st.session_state.user:
@@ -116,8 +171,9 @@ def main():
                 user = st.session_state.user # Get user before clearing
                 for key in list(st.session_state.keys()): del st.session_state[key]
                 logger.info(f"User '{user}' signed out.")
-                st.toast("You have been signed out. See you soon! 👋"); time.sleep(1); st.rerun()
+                st.toast("You have been signed out. See you soon! 👋"); time.sleep(1); timing.rerun("button")
         else: st.markdown("Sign in or sign up! ✨")
+        timing.render_panel() # Only with APP_TIMING_PANEL=1
 
     # --- Main Content Area ---
     if not st.session_state.user:
@@ -132,7 +188,7 @@ def main():
                  if submitted:
                      # Assumes auth.py uses @cache_data for load_users internally
                      if auth.sign_in(username, password):
-                         st.success("Signed in! Ready to watch? 💖"); time.sleep(1); st.rerun()
+                         st.success("Signed in! Ready to watch? 💖"); time.sleep(1); timing.rerun("button")
                      else: st.error("Invalid credentials. Did you sign up? 😊")
         with tab2: # Sign Up Form
              with st.form("signup_form"):
@@ -154,17 +210,24 @@ def main():
                  with st.form("create_group_form"):
                      st.markdown("Upload the video you want to watch together:")
                      creator_video_file = st.file_uploader("Upload a video", type=["mp4", "mov", "avi", "mkv"], key="creator_upload")
+                     share_via_relay = st.checkbox("Let my partner stream this copy (they won't need the file)", key="share_via_relay")
                      submitted = st.form_submit_button("Create Group & Start Watching")
                      if submitted:
                          if creator_video_file:
                              logger.info(f"Create Group submitted by {st.session_state.user}")
-                             # Assumes group.py uses @cache_data for load_groups internally
-                             group_id = group.create_group(st.session_state.user, creator_video_file)
+                             # The group is only created once the whole video is safely on disk, so a
+                             # failed save leaves nothing behind and "Try again" doesn't duplicate it.
+                             upload = save_uploaded_video(creator_video_file)
+                             video_path = upload.path if upload else None
+                             relay_upload_id = upload.upload_id if upload and share_via_relay else None
+                             # Probing the stored copy also warms the index the player's keyframes come from.
+                             media_info = mp4.probe_file(video_path) if video_path else None
+                             group_id = group.create_group(st.session_state.user, creator_video_file, media_info=media_info or {}, relay_upload_id=relay_upload_id) if video_path else None
                              if group_id:
-                                 st.session_state.group_id = group_id; st.session_state.uploaded_video_bytes = creator_video_file.read()
+                                 st.session_state.group_id = group_id; st.session_state.uploaded_video_path = video_path; st.session_state.video_url = None
                                  st.session_state.user_group_status = 'watching'; st.session_state.new_outgoing_message = None; st.session_state.playback_action_to_send = None; st.session_state.seek_time_to_send = None # Reset flags
                                  logger.info(f"User {st.session_state.user} CREATED group {group_id}. Rerunning.")
-                                 st.success(f"Group created! Share ID: `{group_id}` 💞"); time.sleep(1.5); st.rerun()
+                                 st.success(f"Group created! Share ID: `{group_id}` 💞"); time.sleep(1.5); timing.rerun("button")
                          else: st.error("Please upload a video first! 😊")
             with tab2: # Join Group Form
                  with st.form("join_group_form"):
@@ -177,25 +240,29 @@ def main():
                              # Assumes group.py uses @cache_data for load_groups internally
                              if group.join_group(st.session_state.user, join_group_id_input):
                                  st.session_state.group_id = join_group_id_input; st.session_state.user_group_status = 'joining'
-                                 st.session_state.uploaded_video_bytes = None; st.session_state.chat_messages = []; st.session_state.new_outgoing_message = None; st.session_state.playback_action_to_send = None; st.session_state.seek_time_to_send = None # Reset state/flags
+                                 st.session_state.uploaded_video_path = None; st.session_state.video_url = None; chat.reset_chat_state(); st.session_state.new_outgoing_message = None; st.session_state.playback_action_to_send = None; st.session_state.seek_time_to_send = None # Reset state/flags
                                  logger.info(f"User {st.session_state.user} joined group {join_group_id_input}. Status -> 'joining'. Rerunning.")
-                                 st.rerun()
+                                 timing.rerun("button")
                          else: st.error("Please enter a Group ID. 😊")
 
         else: # --- User is in a Group ---
             current_group_id = st.session_state.group_id
             logger.debug(f"User {st.session_state.user} in group {current_group_id}, status: {st.session_state.user_group_status}")
             # Assumes group.py uses @cache_data for load_groups internally
-            group_data = group.get_group_data(current_group_id)
+            with timing.section("group_data"):
+                group_data = group.get_group_data(current_group_id)
 
             # Check if group exists
             if not group_data:
                 logger.error(f"Group {current_group_id} NOT FOUND for user {st.session_state.user}.")
                 st.error("This group no longer exists. 😟")
-                st.session_state.group_id = None; st.session_state.user_group_status = None; st.session_state.uploaded_video_bytes = None; st.session_state.chat_messages = []; st.session_state.new_outgoing_message = None; st.session_state.playback_action_to_send = None; st.session_state.seek_time_to_send = None # Reset state
-                time.sleep(2); st.rerun(); return
+                st.session_state.group_id = None; st.session_state.user_group_status = None; st.session_state.uploaded_video_path = None; st.session_state.video_url = None; chat.reset_chat_state(); st.session_state.new_outgoing_message = None; st.session_state.playback_action_to_send = None; st.session_state.seek_time_to_send = None # Reset state
+                time.sleep(2); timing.rerun("state"); return
 
             st.subheader(f"Movie Night: Group `{current_group_id}` 💞")
+            with timing.section("presence"):
+                online_members = group.get_online_members(current_group_id)
+            if online_members: st.caption(f"🟢 Online now: {', '.join(online_members)}")
 
             # --- Handle 'Joining' State ---
             if st.session_state.user_group_status == 'joining':
@@ -204,22 +271,35 @@ def main():
                 expected_info = group.get_expected_video_info(current_group_id)
                 if expected_info:
                     st.info(f"Upload: **{expected_info.get('filename', 'N/A')}** ({expected_info.get('size', 0) / (1024*1024):.2f} MB)")
-                    joiner_video_file = st.file_uploader("Upload the matching video", type=["mp4", "mov", "avi", "mkv"], key="joiner_upload")
+                    if expected_info.get('duration'): # Probed from the creator's upload (MP4/MOV only)
+                        minutes, seconds = divmod(int(expected_info['duration']), 60)
+                        st.caption(f"Duration {minutes}:{seconds:02d} · {expected_info.get('codec') or 'unknown codec'} · {(expected_info.get('bitrate') or 0) / 1_000_000:.1f} Mbit/s")
+                    if expected_info.get('relay_upload_id'): # Creator shared their copy through the relay
+                        st.success("Your partner is sharing this video, no upload needed! 🍿")
+                        if st.button("Start Watching ▶️", key="start_shared_video"):
+                            st.session_state.video_url = f"{RELAY_MEDIA_URL}/media/{current_group_id}?token={expected_info.get('media_token', '')}"
+                            st.session_state.user_group_status = 'watching'
+                            logger.info(f"User {st.session_state.user} streaming shared video of group {current_group_id}. Status -> 'watching'. Rerunning.")
+                            timing.rerun("button")
+                    joiner_video_file = None if expected_info.get('relay_upload_id') else st.file_uploader("Upload the matching video", type=["mp4", "mov", "avi", "mkv"], key="joiner_upload")
                     if joiner_video_file:
                         logger.debug(f"Joiner {st.session_state.user} uploaded file: {joiner_video_file.name}")
                         if joiner_video_file.name == expected_info.get('filename'):
-                            st.session_state.uploaded_video_bytes = joiner_video_file.read()
-                            st.session_state.user_group_status = 'watching' # Transition to watching
-                            logger.info(f"User {st.session_state.user} uploaded MATCHING video. Status -> 'watching'. Rerunning.")
-                            st.success("Video matched! Starting the player... 🎉"); time.sleep(1); st.rerun()
+                            upload = save_uploaded_video(joiner_video_file)
+                            video_path = upload.path if upload else None
+                            if video_path:
+                                st.session_state.uploaded_video_path = video_path
+                                st.session_state.user_group_status = 'watching' # Transition to watching
+                                logger.info(f"User {st.session_state.user} uploaded MATCHING video. Status -> 'watching'. Rerunning.")
+                                st.success("Video matched! Starting the player... 🎉"); time.sleep(1); timing.rerun("button")
                         else: st.error(f"Wrong file! Expected '{expected_info.get('filename', 'N/A')}', got '{joiner_video_file.name}'.")
                 else: st.error("Could not get expected video info. Partner might have left? 😥")
 
             # --- Handle 'Watching' State ---
             elif st.session_state.user_group_status == 'watching':
                 logger.debug(f"Rendering 'watching' state UI for {st.session_state.user}")
-                if not st.session_state.uploaded_video_bytes:
-                    st.error("Video data missing! Try re-joining. 🤷‍♀️"); logger.error(f"User {st.session_state.user} watching but no video bytes!")
+                if not st.session_state.video_url and (not st.session_state.uploaded_video_path or not os.path.exists(st.session_state.uploaded_video_path)):
+                    st.error("Video data missing! Try re-joining. 🤷‍♀️"); logger.error(f"User {st.session_state.user} watching but no video file!")
                 else:
                     # --- Process results/data received FROM the JS component ---
                     component_value = st.session_state.get("component_value", None)
@@ -229,7 +309,7 @@ def main():
                         msg_type = component_value.get("type")
                         msg_data = component_value.get("data")
 
-                        if msg_type == "received_chat":
+                        if msg_type in ("received_chat", "received_chat_batch"): # A batch is a list of chat messages
                             st.session_state.received_message_from_js = msg_data # Set flag for chat.py
                             rerun_needed_after_processing = True # Rerun to display new chat message
                         elif msg_type == "outgoing_message_sent":
@@ -252,13 +332,14 @@ def main():
                     # Trigger rerun ONLY ONCE if needed after processing component value
                     if rerun_needed_after_processing:
                          logger.debug("Rerunning after processing component value (e.g., for new chat message).")
-                         st.rerun()
+                         timing.rerun("component")
 
                     # --- Main Watching Area Layout ---
                     col_video, col_chat = st.columns([3, 1]) # Common layout good for desktop/mobile
                     with col_video: # Video Player, Controls
                         st.markdown("#### Video Player")
-                        st.video(st.session_state.uploaded_video_bytes)
+                        with timing.section("video"):
+                            st.video(st.session_state.video_url or st.session_state.uploaded_video_path)
 
                         # Playback Controls
                         st.markdown("##### Controls")
@@ -268,12 +349,12 @@ def main():
                             if st.button("Play ▶️", key="play_button", use_container_width=True):
                                 logger.info(f"User {st.session_state.user} clicked Play -> Setting flag.")
                                 st.session_state.playback_action_to_send = "play"
-                                st.rerun() # Rerun to pass flag to component
+                                timing.rerun("button") # Rerun to pass flag to component
                         with control_cols[1]:
                             if st.button("Pause ⏸️", key="pause_button", use_container_width=True):
                                 logger.info(f"User {st.session_state.user} clicked Pause -> Setting flag.")
                                 st.session_state.playback_action_to_send = "pause"
-                                st.rerun() # Rerun to pass flag to component
+                                timing.rerun("button") # Rerun to pass flag to component
 
                         # TODO: Seek Slider
                         # seek_pos = st.slider("Seek", 0.0, 1.0, 0.0, 0.01, key="seek_slider") # Value 0.0 to 1.0
@@ -289,16 +370,23 @@ def main():
                         }
                         logger.debug(f"Passing data to component: {component_data}")
 
-                        js_code = load_static_file("script.js") # Load JS using cached helper
+                        # Keyframe index (cached per video) lets the bridge snap seeks to keyframes
+                        with timing.section("keyframes"):
+                            index_path = st.session_state.uploaded_video_path or uploads.completed_upload_path(group_data["video_info"].get("relay_upload_id", ""))
+                            index_stat = os.stat(index_path) if index_path and os.path.exists(index_path) else None
+                            keyframes = bridge_keyframes(index_path, index_stat.st_size, index_stat.st_mtime_ns) if index_stat else "[]"
+
+                        with timing.section("bridge"):
+                            js_code = load_static_file("script.js") # Load JS using cached helper
 
-                        if js_code: # Only render component if JS loaded
-                            component_value_from_call = html(f"""
-                                <div id="ws-bridge-container" data-websocket-url="{component_data['websocketUrl']}" data-group-id="{component_data['groupId']}" data-username="{component_data['username']}" data-outgoing-message='{json.dumps(component_data['outgoingMessage'])}' data-playback-action="{component_data['playbackAction'] if component_data['playbackAction'] else ''}" data-seek-time="{component_data['seekTime'] if component_data['seekTime'] is not None else ''}">
-                                    <p id="ws-status">Initializing Bridge...</p>
-                                </div><script>{js_code}</script>""",
-                                height=50, # Keep small
-                                # No key needed for html()
-                            )
+                            if js_code: # Only render component if JS loaded
+                                component_value_from_call = html(f"""
+                                    <div id="ws-bridge-container" data-websocket-url="{component_data['websocketUrl']}" data-group-id="{component_data['groupId']}" data-username="{component_data['username']}" data-outgoing-message='{json.dumps(component_data['outgoingMessage'])}' data-playback-action="{component_data['playbackAction'] if component_data['playbackAction'] else ''}" data-seek-time="{component_data['seekTime'] if component_data['seekTime'] is not None else ''}" data-keyframes='{keyframes}'>
+                                        <p id="ws-status">Initializing Bridge...</p>
+                                    </div><script>{js_code}</script>""",
+                                    height=50, # Keep small
+                                    # No key needed for html()
+                                )
 
                             # Store return value for processing on next run's beginning
                             if component_value_from_call:
@@ -310,7 +398,8 @@ def main():
                             st.session_state.seek_time_to_send = None
 
                     with col_chat: # Chat Area
-                        chat.render_chat_interface(current_group_id) # Renders UI, Send button sets flag
+                        with timing.section("chat"):
+                            chat.render_chat_interface(current_group_id) # Renders UI, Send button sets flag
 
                     # Leave Group Button
                     st.markdown("---")
@@ -319,8 +408,8 @@ def main():
                         # TODO: Consider telling JS/Server user is leaving?
                         group.leave_group(st.session_state.user, current_group_id)
                         # Reset session state
-                        st.session_state.group_id = None; st.session_state.user_group_status = None; st.session_state.uploaded_video_bytes = None; st.session_state.chat_messages = []; st.session_state.new_outgoing_message = None; st.session_state.playback_action_to_send = None; st.session_state.seek_time_to_send = None
-                        st.rerun()
+                        st.session_state.group_id = None; st.session_state.user_group_status = None; st.session_state.uploaded_video_path = None; st.session_state.video_url = None; chat.reset_chat_state(); st.session_state.new_outgoing_message = None; st.session_state.playback_action_to_send = None; st.session_state.seek_time_to_send = None
+                        timing.rerun("button")
 
             else: # Unknown State
                 st.error("Unexpected state."); logger.error(f"Invalid status: {st.session_state.user_group_status}")
@@ -328,5 +417,6 @@ def main():
 # --- Entry Point ---
 if __name__ == "__main__":
     logger.info("\n" + "="*60 + "\n Starting New Streamlit App Run \n" + "="*60)
-    main()
+    with timing.track_rerun(): # Section timings and rerun cause (see timing.py)
+        main()
     logger.info("\n" + "-"*60 + "\n Finished Streamlit App Run \n" + "-"*60)
\ No newline at end of file
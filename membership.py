@@ -0,0 +1,583 @@
+# membership.py
+"""
+Single source of truth for group membership.
+
+MembershipRegistry owns both the persistent group records (creator, video info,
+members; stored in groups.json) and live presence (who is connected to the relay
+right now). The relay (server.py) hosts the registry and exposes it on a Unix
+socket with `serve()`; the Streamlit app talks to it through MembershipClient and
+receives presence changes pushed to a PresenceWatcher.
+
+Protocol: newline-delimited JSON. Each request is {"id": n, "op": "...", ...} and
+gets {"id": n, "ok": true, "result": ...} or {"id": n, "ok": false, "error": "..."}.
+The "watch" op turns the connection into a stream of {"event": ...} messages.
+
+When no service is listening (e.g., the relay isn't running during development),
+get_service() falls back to LocalMembership, which works on groups.json directly and
+keeps no copy of it between calls. Writers of groups.json hold an exclusive lock on
+groups.json.lock (see file_lock()).
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Configure logger for this module
+logger = logging.getLogger(__name__)
+
+GROUPS_FILE = "groups.json"
+MEMBERSHIP_SOCKET = os.environ.get("MEMBERSHIP_SOCKET", "membership.sock")
+CLIENT_TIMEOUT_S = 5.0
+READ_ONLY_OPS = ("exists", "get", "presence") # Safe to resend even if the first attempt may have arrived
+WATCH_RETRY_S = 2.0
+
+
+class MembershipError(Exception):
+    """Raised when the membership service can't be reached or rejects a request."""
+
+
+# --- File Persistence ---
+
+@contextmanager
+def file_lock(path: str):
+    """Holds an exclusive lock on `path`.lock (between threads and processes) while the block runs."""
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_groups_file(path: str) -> dict:
+    """
+    Loads group records from a JSON file, converting member lists to sets.
+
+    Raises:
+        json.JSONDecodeError: If the file is corrupted.
+        OSError: If the file can't be read.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        content = f.read()
+    if not content:
+        return {}
+    groups = json.loads(content)
+    for data in groups.values():
+        if isinstance(data.get("members"), list):
+            data["members"] = set(data["members"])
+    return groups
+
+def write_groups_file(path: str, groups: dict):
+    """
+    Saves group records to a JSON file (members as sorted lists), replacing it atomically.
+
+    Raises:
+        TypeError: If a record isn't JSON serializable.
+        OSError: If the file can't be written.
+    """
+    groups_to_save = {}
+    for group_id, data in groups.items():
+        data_copy = data.copy()
+        if isinstance(data_copy.get("members"), set):
+            data_copy["members"] = sorted(data_copy["members"])
+        groups_to_save[group_id] = data_copy
+    # A temp file of our own per write, so concurrent writers never share (or rename) each other's.
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(groups_to_save, f, indent=4)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# --- Registry ---
+
+class MembershipRegistry:
+    """
+    Persistent group records plus live presence, guarded by one lock.
+
+    Changes are written to disk either synchronously, or (write_behind=True, as the relay
+    runs it) by a background thread, so a join never rewrites groups.json on the relay's
+    event loop. The writer coalesces bursts of changes into one write of the latest
+    records; close() waits for the last one.
+    """
+
+    def __init__(self, groups_file: str | None = GROUPS_FILE, groups: dict | None = None, write_behind: bool = False):
+        """
+        Args:
+            groups_file (str | None): Where records are loaded from and written to. None keeps
+                                      them in memory only (the caller persists them).
+            groups (dict, optional): Records to start from instead of reading `groups_file`.
+            write_behind (bool): Write changes from a background thread instead of in the caller.
+        """
+        self.groups_file = groups_file
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._unsaved = False
+        self._closing = False
+        self._writer = None
+        self._presence = {} # {group_id: {username: open connection count}}
+        self._subscribers = []
+        if groups is not None:
+            self._groups = groups
+        else:
+            with file_lock(groups_file):
+                self._groups = read_groups_file(groups_file)
+            logger.info(f"Membership registry loaded {len(self._groups)} groups from {groups_file}")
+        if write_behind and groups_file:
+            self._writer = threading.Thread(target=self._write_behind, name="membership-writer", daemon=True)
+            self._writer.start()
+
+    def _save(self):
+        # Called with self._lock held.
+        if not self.groups_file:
+            return
+        if self._writer is None:
+            with file_lock(self.groups_file):
+                write_groups_file(self.groups_file, self._groups)
+            return
+        self._unsaved = True
+        self._changed.notify()
+
+    def _write_behind(self):
+        while True:
+            with self._lock:
+                while not self._unsaved and not self._closing:
+                    self._changed.wait()
+                if not self._unsaved:
+                    return
+                self._unsaved = False
+                # Copy what the write needs, so the lock isn't held while it's serialized.
+                snapshot = {gid: dict(record, members=set(record.get("members", ()))) for gid, record in self._groups.items()}
+            try:
+                with file_lock(self.groups_file):
+                    write_groups_file(self.groups_file, snapshot)
+            except (OSError, TypeError) as e:
+                logger.error(f"Writing {self.groups_file} failed; retrying with the next change: {e}", exc_info=True)
+
+    def close(self):
+        """Stops the background writer after it has written any pending changes."""
+        writer = self._writer
+        if writer is None:
+            return
+        with self._lock:
+            self._closing = True
+            self._changed.notify()
+        writer.join()
+        self._writer = None
+
+    def _publish(self, event: dict):
+        for callback in list(self._subscribers):
+            try:
+                callback(event)
+            except Exception as e:
+                logger.error(f"Membership subscriber failed on {event}: {e}", exc_info=True)
+
+    def _public_record(self, group_id: str) -> dict:
+        record = dict(self._groups[group_id])
+        record["members"] = sorted(record.get("members", ()))
+        record["online"] = sorted(self._presence.get(group_id, ()))
+        return record
+
+    def subscribe(self, callback):
+        """
+        Registers `callback(event)` for presence and group changes.
+
+        Returns:
+            callable: Call it to unsubscribe.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback) if callback in self._subscribers else None
+
+    # --- Persistent membership ---
+
+    def group_exists(self, group_id: str) -> bool:
+        return group_id in self._groups
+
+    def get_group(self, group_id: str) -> dict | None:
+        """Returns a copy of the group record (members and online users as sorted lists), or None."""
+        with self._lock:
+            if group_id not in self._groups:
+                return None
+            return self._public_record(group_id)
+
+    def create_group(self, group_id: str, record: dict) -> bool:
+        """Stores a new group. Returns False if the ID is taken."""
+        with self._lock:
+            if group_id in self._groups:
+                return False
+            record = dict(record)
+            record["members"] = set(record.get("members", ()))
+            self._groups[group_id] = record
+            self._save()
+        self._publish({"event": "group", "groupId": group_id, "deleted": False})
+        return True
+
+    def join(self, group_id: str, username: str) -> str | None:
+        """
+        Adds a member.
+
+        Returns:
+            str | None: "joined", "already_member", or None if the group doesn't exist.
+        """
+        with self._lock:
+            if group_id not in self._groups:
+                return None
+            members = self._groups[group_id]["members"]
+            if username in members:
+                return "already_member"
+            members.add(username)
+            self._save()
+        self._publish({"event": "group", "groupId": group_id, "deleted": False})
+        return "joined"
+
+    def leave(self, group_id: str, username: str) -> dict | None:
+        """
+        Removes a member, deleting the group once nobody is left.
+
+        Returns:
+            dict | None: {"removed": bool, "deleted": bool}, or None if the group doesn't exist.
+        """
+        with self._lock:
+            if group_id not in self._groups:
+                return None
+            members = self._groups[group_id]["members"]
+            if username not in members:
+                return {"removed": False, "deleted": False}
+            members.remove(username)
+            deleted = not members
+            if deleted:
+                del self._groups[group_id]
+            self._save()
+        self._publish({"event": "group", "groupId": group_id, "deleted": deleted})
+        return {"removed": True, "deleted": deleted}
+
+    # --- Live presence ---
+
+    def connect(self, group_id: str, username: str):
+        """Records an open relay connection for a user in a group."""
+        with self._lock:
+            users = self._presence.setdefault(group_id, {})
+            users[username] = users.get(username, 0) + 1
+            came_online = users[username] == 1
+            online = sorted(users)
+        if came_online:
+            self._publish({"event": "presence", "groupId": group_id, "online": online})
+
+    def disconnect(self, group_id: str, username: str):
+        """Records a closed relay connection; the user goes offline when their last one closes."""
+        with self._lock:
+            users = self._presence.get(group_id, {})
+            if username not in users:
+                return
+            users[username] -= 1
+            went_offline = users[username] == 0
+            if went_offline:
+                del users[username]
+                if not users:
+                    del self._presence[group_id]
+            online = sorted(users)
+        if went_offline:
+            self._publish({"event": "presence", "groupId": group_id, "online": online})
+
+    def presence(self, group_id: str | None = None) -> dict | list:
+        """Online users for one group (list), or for every group ({group_id: list})."""
+        with self._lock:
+            if group_id is not None:
+                return sorted(self._presence.get(group_id, ()))
+            return {gid: sorted(users) for gid, users in self._presence.items()}
+
+    def dispatch(self, op: str, args: dict):
+        """Runs a protocol request against the registry (used by the socket server)."""
+        handlers = {
+            "exists": lambda: self.group_exists(args["groupId"]),
+            "get": lambda: self.get_group(args["groupId"]),
+            "create": lambda: self.create_group(args["groupId"], args["record"]),
+            "join": lambda: self.join(args["groupId"], args["username"]),
+            "leave": lambda: self.leave(args["groupId"], args["username"]),
+            "presence": lambda: self.presence(args.get("groupId")),
+        }
+        if op not in handlers:
+            raise MembershipError(f"Unknown op '{op}'")
+        return handlers[op]()
+
+
+# --- Unix Socket Server (runs inside the relay's event loop) ---
+
+async def serve(registry: MembershipRegistry, path: str = MEMBERSHIP_SOCKET):
+    """
+    Exposes `registry` on a Unix socket. Returns the asyncio server; close it to stop.
+    """
+    if os.path.exists(path):
+        os.remove(path) # Stale socket from a previous run
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    if request.get("op") == "watch":
+                        await _stream_events(registry, request, writer)
+                        return
+                    response = {"id": request.get("id"), "ok": True, "result": registry.dispatch(request.get("op"), request)}
+                except (MembershipError, KeyError, json.JSONDecodeError, TypeError) as e:
+                    response = {"id": request.get("id") if isinstance(request, dict) else None, "ok": False, "error": str(e)}
+                except OSError as e:
+                    logger.error(f"Membership request failed to persist: {e}", exc_info=True)
+                    response = {"id": request.get("id"), "ok": False, "error": f"Storage error: {e}"}
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            pass # Relay shutting down with this client still connected
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle, path=path)
+    logger.info(f"Membership service listening on {path}")
+    return server
+
+async def _stream_events(registry: MembershipRegistry, request: dict, writer: asyncio.StreamWriter):
+    queue = asyncio.Queue()
+    unsubscribe = registry.subscribe(queue.put_nowait)
+    try:
+        snapshot = {"id": request.get("id"), "ok": True, "result": registry.presence()}
+        writer.write(json.dumps(snapshot).encode("utf-8") + b"\n")
+        await writer.drain()
+        while True:
+            event = await queue.get()
+            writer.write(json.dumps(event).encode("utf-8") + b"\n")
+            await writer.drain()
+    finally:
+        unsubscribe()
+
+
+# --- Client (used by the Streamlit app) ---
+
+class MembershipClient:
+    """Blocking client for the membership service. Safe to share between Streamlit sessions."""
+
+    def __init__(self, path: str = MEMBERSHIP_SOCKET, timeout: float = CLIENT_TIMEOUT_S):
+        self.path = path
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._file = None
+        self._next_id = 0
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self._sock, self._file = sock, sock.makefile("rwb")
+
+    @property
+    def connected(self) -> bool:
+        """Whether the last call left an open connection (False after a failure)."""
+        return self._sock is not None
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _disconnect(self):
+        for closable in (self._file, self._sock):
+            if closable is not None:
+                try:
+                    closable.close()
+                except OSError:
+                    pass # Already broken; we only want the descriptor back
+        self._sock = self._file = None
+
+    def call(self, op: str, **args):
+        """
+        Sends one request and waits for its response.
+
+        If the connection turns out to be dead before the request was sent (e.g., the relay
+        restarted), it reconnects and sends it once more. Once a request has been sent it is
+        only resent for READ_ONLY_OPS: a create or join may already have been applied.
+
+        Raises:
+            MembershipError: If the service is unreachable or returns an error.
+        """
+        with self._lock:
+            for attempt in (1, 2):
+                sent = False
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._next_id += 1
+                    request = dict(args, op=op, id=self._next_id)
+                    self._file.write(json.dumps(request).encode("utf-8") + b"\n")
+                    self._file.flush()
+                    sent = True
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError("Membership service closed the connection")
+                    response = json.loads(line)
+                    break
+                except OSError as e:
+                    self._disconnect()
+                    if attempt == 2 or (sent and op not in READ_ONLY_OPS):
+                        raise MembershipError(f"Membership service unavailable at {self.path}: {e}") from e
+        if not response.get("ok"):
+            raise MembershipError(response.get("error", "Unknown membership error"))
+        return response.get("result")
+
+    def group_exists(self, group_id: str) -> bool:
+        return self.call("exists", groupId=group_id)
+
+    def get_group(self, group_id: str) -> dict | None:
+        return self.call("get", groupId=group_id)
+
+    def create_group(self, group_id: str, record: dict) -> bool:
+        record = dict(record, members=sorted(record.get("members", ())))
+        return self.call("create", groupId=group_id, record=record)
+
+    def join(self, group_id: str, username: str) -> str | None:
+        return self.call("join", groupId=group_id, username=username)
+
+    def leave(self, group_id: str, username: str) -> dict | None:
+        return self.call("leave", groupId=group_id, username=username)
+
+    def presence(self, group_id: str | None = None):
+        return self.call("presence", groupId=group_id)
+
+
+class PresenceWatcher:
+    """
+    Keeps a local copy of live presence, updated by events pushed from the service
+    over a dedicated connection, so reading it never touches the socket or groups.json.
+    """
+
+    def __init__(self, path: str = MEMBERSHIP_SOCKET):
+        self.path = path
+        self._presence = {}
+        self._lock = threading.Lock()
+        self.connected = False
+        self._thread = threading.Thread(target=self._run, name="membership-presence-watcher", daemon=True)
+        self._thread.start()
+
+    def online(self, group_id: str) -> list:
+        with self._lock:
+            return list(self._presence.get(group_id, ()))
+
+    def _run(self):
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(self.path)
+                    stream = sock.makefile("rwb")
+                    stream.write(b'{"op": "watch", "id": 0}\n')
+                    stream.flush()
+                    snapshot = json.loads(stream.readline())
+                    with self._lock:
+                        self._presence = snapshot.get("result") or {}
+                    self.connected = True
+                    for line in stream:
+                        event = json.loads(line)
+                        with self._lock:
+                            if event.get("event") == "presence":
+                                self._presence[event["groupId"]] = event["online"]
+                            elif event.get("event") == "group" and event.get("deleted"):
+                                self._presence.pop(event["groupId"], None)
+            except (OSError, ValueError) as e:
+                logger.debug(f"Presence watcher disconnected from {self.path}: {e}")
+            self.connected = False
+            time.sleep(WATCH_RETRY_S)
+
+
+# --- Fallback Without the Relay ---
+
+class LocalMembership:
+    """
+    Stands in for the membership service while the relay is down. Every call re-reads
+    groups.json under file_lock() and writes changes straight back, so no stale copy is
+    kept between calls that could overwrite records the relay wrote in the meantime.
+    Presence is always empty: nobody is connected to a relay that isn't running.
+    """
+
+    def __init__(self, groups_file: str = GROUPS_FILE):
+        self.groups_file = groups_file
+
+    def _call(self, op: str, *args, write: bool = False):
+        with file_lock(self.groups_file):
+            registry = MembershipRegistry(None, groups=read_groups_file(self.groups_file))
+            result = getattr(registry, op)(*args)
+            if write and result:
+                write_groups_file(self.groups_file, registry._groups)
+        return result
+
+    def group_exists(self, group_id: str) -> bool:
+        return self._call("group_exists", group_id)
+
+    def get_group(self, group_id: str) -> dict | None:
+        return self._call("get_group", group_id)
+
+    def create_group(self, group_id: str, record: dict) -> bool:
+        return self._call("create_group", group_id, record, write=True)
+
+    def join(self, group_id: str, username: str) -> str | None:
+        return self._call("join", group_id, username, write=True)
+
+    def leave(self, group_id: str, username: str) -> dict | None:
+        return self._call("leave", group_id, username, write=True)
+
+    def presence(self, group_id: str | None = None):
+        return [] if group_id is not None else {}
+
+
+# --- Service Lookup ---
+
+_local = None
+_client = None
+_last_service = None # What the previous lookup returned, to log switches to the fallback once
+_lookup_lock = threading.Lock()
+
+def _service_listening(path: str) -> bool:
+    """Whether something accepts connections on `path` (a socket file left by a crashed relay doesn't)."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CLIENT_TIMEOUT_S)
+            sock.connect(path)
+        return True
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+    except OSError as e:
+        logger.warning(f"Could not probe the membership service at {path}: {e}")
+        return False
+
+def get_service():
+    """
+    Returns the membership service: a MembershipClient when the relay is listening on its
+    socket, otherwise a LocalMembership over groups.json (both expose the same methods).
+
+    The socket is probed again whenever the client has no open connection (first use, or
+    after a failed call), so a restarted or crashed relay is noticed on the next lookup.
+    """
+    global _local, _client, _last_service
+    with _lookup_lock:
+        if _client is not None and _client.connected:
+            return _client
+        if _service_listening(MEMBERSHIP_SOCKET):
+            if _client is None:
+                _client = MembershipClient(MEMBERSHIP_SOCKET)
+            _last_service = _client
+            return _client
+        if _local is None:
+            _local = LocalMembership(GROUPS_FILE)
+        if _last_service is not _local:
+            logger.warning(f"Membership service not found at {MEMBERSHIP_SOCKET}; using {GROUPS_FILE} directly.")
+            _last_service = _local
+        return _local
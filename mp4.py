@@ -0,0 +1,395 @@
+# mp4.py
+"""
+Minimal streaming parser for MP4/MOV (ISO BMFF) files.
+
+Only box headers are read while scanning the top level, and only the `moov`
+box is loaded into memory, so probing a multi-GB file costs a few seeks and a
+read of its (usually small) metadata. From `moov` we extract the duration,
+codecs and resolution, and build a keyframe index from the video track's
+sample tables (`stts`, `stss`, `stsc`, `stsz`, `stco`/`co64`).
+
+faststart() rewrites files whose `moov` trails the media data so it comes
+first, streaming the media through and patching the chunk offset tables.
+"""
+import bisect
+import logging
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+VIDEO_INDEX_CACHE_SIZE = 32 # Probed videos kept in memory (shared by all sessions in the process)
+COPY_CHUNK_SIZE = 1024 * 1024 # Bytes copied at a time when rewriting a file
+
+# Boxes whose payload is just a sequence of child boxes, on the path to the sample tables.
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+MAX_MOOV_SIZE = 256 * 1024 * 1024 # Refuse to load absurdly large metadata
+
+
+class MP4Error(Exception):
+    """Raised when a file is not a parseable MP4/MOV."""
+
+
+def read_box_header(f, offset: int, end: int) -> tuple[bytes, int, int] | None:
+    """
+    Reads the box header at `offset`.
+
+    Args:
+        f: A seekable binary file object.
+        offset (int): Where the box starts.
+        end (int): Where the enclosing box (or the file) ends.
+
+    Returns:
+        tuple[bytes, int, int] | None: (box type, header size, total box size), or None
+                                       if there is no complete header before `end`.
+    """
+    if end - offset < 8:
+        return None
+    f.seek(offset)
+    header = f.read(8)
+    if len(header) < 8:
+        return None
+    size, box_type = struct.unpack(">I4s", header)
+    header_size = 8
+    if size == 1: # 64-bit "largesize" follows the type
+        large = f.read(8)
+        if len(large) < 8:
+            return None
+        size = struct.unpack(">Q", large)[0]
+        header_size = 16
+    elif size == 0: # Box extends to the end of the enclosing space
+        size = end - offset
+    if size < header_size:
+        raise MP4Error(f"Invalid size {size} for box {box_type!r} at offset {offset}")
+    return box_type, header_size, size
+
+def iter_top_level_boxes(f, file_size: int):
+    """
+    Yields (type, offset, header size, size) for each top-level box, seeking past payloads.
+
+    Args:
+        f: A seekable binary file object.
+        file_size (int): Total size of the file.
+    """
+    offset = 0
+    while offset < file_size:
+        header = read_box_header(f, offset, file_size)
+        if header is None:
+            return
+        box_type, header_size, size = header
+        yield box_type, offset, header_size, size
+        offset += size
+
+def iter_child_boxes(data: bytes, start: int, end: int):
+    """Yields (type, payload start, payload end) for each box inside data[start:end]."""
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise MP4Error(f"Truncated box {box_type!r} inside moov")
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+def _find_child(data: bytes, start: int, end: int, box_type: bytes) -> tuple[int, int] | None:
+    for child_type, payload_start, payload_end in iter_child_boxes(data, start, end):
+        if child_type == box_type:
+            return payload_start, payload_end
+    return None
+
+def _parse_timescale_duration(data: bytes, start: int) -> tuple[int, int]:
+    """Parses (timescale, duration) from an mvhd/mdhd full box payload."""
+    version = data[start]
+    if version == 1:
+        return struct.unpack_from(">IQ", data, start + 20)
+    return struct.unpack_from(">II", data, start + 12)
+
+def _parse_table(data: bytes, start: int, fmt: str, fields: int) -> tuple:
+    """Parses `entry_count` followed by that many entries of `fields` values from a full box payload."""
+    count = struct.unpack_from(">I", data, start + 4)[0]
+    return struct.unpack_from(f">{count * fields}{fmt}", data, start + 8)
+
+def _parse_track(data: bytes, start: int, end: int) -> dict | None:
+    """Extracts what we need from one `trak` box payload."""
+    mdia = _find_child(data, start, end, b"mdia")
+    if mdia is None:
+        return None
+    mdhd = _find_child(data, *mdia, b"mdhd")
+    hdlr = _find_child(data, *mdia, b"hdlr")
+    minf = _find_child(data, *mdia, b"minf")
+    if mdhd is None or hdlr is None or minf is None:
+        return None
+    stbl = _find_child(data, *minf, b"stbl")
+    if stbl is None:
+        return None
+    timescale, duration = _parse_timescale_duration(data, mdhd[0])
+    track = {
+        "handler": data[hdlr[0] + 8:hdlr[0] + 12].decode("latin-1"),
+        "timescale": timescale,
+        "duration": duration,
+    }
+    tables = {box_type: (s, e) for box_type, s, e in iter_child_boxes(data, *stbl)}
+    if b"stsd" in tables:
+        entry = tables[b"stsd"][0] + 8 # Skip version/flags and entry_count
+        track["codec"] = data[entry + 4:entry + 8].decode("latin-1")
+        if track["handler"] == "vide":
+            track["width"], track["height"] = struct.unpack_from(">HH", data, entry + 32)
+    if b"stts" in tables:
+        track["stts"] = _parse_table(data, tables[b"stts"][0], "I", 2)
+    if b"stss" in tables:
+        track["stss"] = _parse_table(data, tables[b"stss"][0], "I", 1)
+    if b"stsc" in tables:
+        track["stsc"] = _parse_table(data, tables[b"stsc"][0], "I", 3)
+    if b"stsz" in tables:
+        s = tables[b"stsz"][0]
+        sample_size, sample_count = struct.unpack_from(">II", data, s + 4)
+        track["stsz"] = (sample_size, sample_count, () if sample_size else struct.unpack_from(f">{sample_count}I", data, s + 12))
+    if b"stco" in tables:
+        track["chunk_offsets"] = _parse_table(data, tables[b"stco"][0], "I", 1)
+    elif b"co64" in tables:
+        track["chunk_offsets"] = _parse_table(data, tables[b"co64"][0], "Q", 1)
+    return track
+
+def _sample_times(stts: tuple, samples: list) -> list:
+    """Converts 1-based sample numbers (ascending) to decode timestamps in track units."""
+    times = []
+    sample, time, i = 1, 0, 0
+    for run in range(0, len(stts), 2):
+        count, delta = stts[run], stts[run + 1]
+        while i < len(samples) and samples[i] < sample + count:
+            times.append(time + (samples[i] - sample) * delta)
+            i += 1
+        sample += count
+        time += count * delta
+    return times
+
+def _sample_offsets(track: dict, samples: list) -> list:
+    """Converts 1-based sample numbers (ascending) to byte offsets in the file."""
+    stsc, chunk_offsets = track.get("stsc"), track.get("chunk_offsets")
+    if not stsc or not chunk_offsets or "stsz" not in track:
+        return []
+    uniform_size, _, sizes = track["stsz"]
+    offsets = []
+    i = 0
+    first_sample = 1
+    runs = [stsc[r:r + 3] for r in range(0, len(stsc), 3)]
+    for run_index, (first_chunk, per_chunk, _) in enumerate(runs):
+        last_chunk = runs[run_index + 1][0] - 1 if run_index + 1 < len(runs) else len(chunk_offsets)
+        for chunk in range(first_chunk, last_chunk + 1):
+            chunk_end_sample = first_sample + per_chunk
+            while i < len(samples) and samples[i] < chunk_end_sample:
+                before = range(first_sample - 1, samples[i] - 1) # 0-based samples earlier in this chunk
+                skipped = uniform_size * len(before) if uniform_size else sum(sizes[s] for s in before)
+                offsets.append(chunk_offsets[chunk - 1] + skipped)
+                i += 1
+            first_sample = chunk_end_sample
+            if i == len(samples):
+                return offsets
+    return offsets
+
+def probe(f) -> dict | None:
+    """
+    Reads MP4/MOV metadata and the keyframe index without loading the media data.
+
+    The file position is restored afterwards, so callers can keep reading an upload.
+
+    Args:
+        f: A seekable binary file object (e.g., an open file or Streamlit UploadedFile).
+
+    Returns:
+        dict | None: duration (s), codec, audio_codec, width, height, bitrate (bit/s),
+                     keyframes (s), keyframe_offsets (bytes), moov/mdat offsets and whether
+                     the file is already fast-start. None if the file is not an MP4/MOV.
+    """
+    position = f.tell()
+    try:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        boxes = {}
+        for box_type, offset, header_size, size in iter_top_level_boxes(f, file_size):
+            boxes.setdefault(box_type, (offset, header_size, size))
+        if b"moov" not in boxes:
+            return None
+        moov_offset, header_size, moov_size = boxes[b"moov"]
+        if moov_size > MAX_MOOV_SIZE:
+            raise MP4Error(f"moov box too large ({moov_size} bytes)")
+        f.seek(moov_offset)
+        data = f.read(moov_size)
+        if len(data) < moov_size:
+            raise MP4Error("File ends inside the moov box")
+
+        info = {"moov_offset": moov_offset, "mdat_offset": boxes.get(b"mdat", (None,))[0]}
+        info["faststart"] = info["mdat_offset"] is None or moov_offset < info["mdat_offset"]
+        mvhd = _find_child(data, header_size, moov_size, b"mvhd")
+        if mvhd:
+            timescale, duration = _parse_timescale_duration(data, mvhd[0])
+            info["duration"] = duration / timescale if timescale else None
+        tracks = [
+            t for box_type, s, e in iter_child_boxes(data, header_size, moov_size)
+            if box_type == b"trak" and (t := _parse_track(data, s, e))
+        ]
+        video = next((t for t in tracks if t["handler"] == "vide"), None)
+        audio = next((t for t in tracks if t["handler"] == "soun"), None)
+        info["audio_codec"] = audio.get("codec") if audio else None
+        info["codec"] = video.get("codec") if video else None
+        info["keyframes"], info["keyframe_offsets"] = [], []
+        if video:
+            info["width"], info["height"] = video.get("width"), video.get("height")
+            if not info.get("duration") and video["timescale"]:
+                info["duration"] = video["duration"] / video["timescale"]
+            # Without stss every sample is a sync sample, so there is nothing to snap to.
+            sync_samples = sorted(video.get("stss", ()))
+            if sync_samples and video.get("stts") and video["timescale"]:
+                info["keyframes"] = [t / video["timescale"] for t in _sample_times(video["stts"], sync_samples)]
+                info["keyframe_offsets"] = _sample_offsets(video, sync_samples)
+        if info.get("duration"):
+            info["bitrate"] = int(file_size * 8 / info["duration"])
+        return info
+    except (struct.error, IndexError) as e:
+        raise MP4Error(f"Malformed MP4 metadata: {e}") from e
+    finally:
+        f.seek(position)
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def probe_cached(cache_key, f) -> dict | None:
+    """
+    Like probe(), but results are kept in a small per-process LRU cache so every
+    session watching the same video shares one index.
+
+    Args:
+        cache_key: Identifies the video, e.g. (filename, size).
+        f: A seekable binary file object, only read on a cache miss.
+
+    Returns:
+        dict | None: See probe(). Failures are cached as None.
+    """
+    with _cache_lock:
+        if cache_key in _cache:
+            _cache.move_to_end(cache_key)
+            return _cache[cache_key]
+    try:
+        info = probe(f)
+    except MP4Error as e:
+        logger.warning(f"Could not parse MP4 metadata for {cache_key}: {e}")
+        info = None
+    with _cache_lock:
+        _cache[cache_key] = info
+        if len(_cache) > VIDEO_INDEX_CACHE_SIZE:
+            _cache.popitem(last=False)
+    logger.info(f"Probed video {cache_key}: duration={info and info.get('duration')}, keyframes={info and len(info['keyframes'])}")
+    return info
+
+def probe_file(path: str) -> dict | None:
+    """probe_cached() for a file on disk, keyed on its path, size and modification time."""
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        return probe_cached((os.path.abspath(path), stat.st_size, stat.st_mtime_ns), f)
+
+def _chunk_offset_tables(data: bytearray, start: int, end: int):
+    """Yields (box type, payload start) for every stco/co64 box below data[start:end]."""
+    for box_type, payload_start, payload_end in iter_child_boxes(data, start, end):
+        if box_type in (b"stco", b"co64"):
+            yield box_type, payload_start
+        elif box_type in CONTAINER_BOXES:
+            yield from _chunk_offset_tables(data, payload_start, payload_end)
+
+def _copy_range(src, dst, offset: int, length: int):
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(COPY_CHUNK_SIZE, length))
+        if not chunk:
+            raise MP4Error("Unexpected end of file while copying")
+        dst.write(chunk)
+        length -= len(chunk)
+
+def faststart(src, dst) -> bool:
+    """
+    Rewrites an MP4/MOV with a trailing `moov` into fast-start layout (moov before mdat),
+    so players can start and seek before the whole file has downloaded.
+
+    Media data is streamed through in COPY_CHUNK_SIZE pieces and never re-encoded;
+    only `moov` is held in memory while its chunk offsets are patched.
+
+    Args:
+        src: A seekable binary file object to read. Its position is restored.
+        dst: A binary file object to write the rewritten file to.
+
+    Returns:
+        bool: True if `dst` was written. False (nothing written) if `src` is not an
+              MP4/MOV, is already fast-start, or its offsets would overflow 32-bit stco.
+
+    Raises:
+        MP4Error: If the metadata is malformed.
+    """
+    position = src.tell()
+    try:
+        src.seek(0, os.SEEK_END)
+        file_size = src.tell()
+        boxes = list(iter_top_level_boxes(src, file_size))
+        types = [b[0] for b in boxes]
+        if b"moov" not in types or b"mdat" not in types:
+            return False
+        moov_index, first_mdat = types.index(b"moov"), types.index(b"mdat")
+        if moov_index < first_mdat:
+            return False # Already fast-start
+        moov = boxes[moov_index]
+        if moov[3] > MAX_MOOV_SIZE:
+            raise MP4Error(f"moov box too large ({moov[3]} bytes)")
+
+        # New order: everything before the first mdat, then moov, then the rest.
+        order = [b for b in boxes[:first_mdat]] + [moov] + [b for b in boxes[first_mdat:] if b is not moov]
+        new_offsets, offset = {}, 0
+        for box in order:
+            new_offsets[box[1]] = offset
+            offset += box[3]
+        # (old start, old end, shift) for every moved box, to relocate chunk offsets.
+        old_starts = [b[1] for b in boxes]
+        shifts = [(b[1], b[1] + b[3], new_offsets[b[1]] - b[1]) for b in boxes]
+
+        src.seek(moov[1])
+        data = bytearray(src.read(moov[3]))
+        for box_type, payload_start in _chunk_offset_tables(data, moov[2], moov[3]):
+            fmt = "I" if box_type == b"stco" else "Q"
+            count = struct.unpack_from(">I", data, payload_start + 4)[0]
+            entries = struct.unpack_from(f">{count}{fmt}", data, payload_start + 8)
+            patched = []
+            for value in entries:
+                i = bisect.bisect_right(old_starts, value) - 1
+                patched.append(value + (shifts[i][2] if i >= 0 and value < shifts[i][1] else 0))
+            if fmt == "I" and patched and max(patched) > 0xFFFFFFFF:
+                logger.warning("Fast-start rewrite skipped: chunk offsets would need co64.")
+                return False
+            struct.pack_into(f">{count}{fmt}", data, payload_start + 8, *patched)
+
+        for box in order:
+            if box is moov:
+                dst.write(data)
+            else:
+                _copy_range(src, dst, box[1], box[3])
+        logger.info(f"Rewrote {file_size} byte file to fast-start layout (moov {moov[3]} bytes moved to offset {new_offsets[moov[1]]}).")
+        return True
+    except (struct.error, IndexError) as e:
+        raise MP4Error(f"Malformed MP4 metadata: {e}") from e
+    finally:
+        src.seek(position)
+
+def snap_to_keyframe(keyframes: list, target: float) -> float:
+    """
+    Returns the latest keyframe time at or before `target` (or `target` if there is none).
+
+    Args:
+        keyframes (list): Ascending keyframe times in seconds, as returned by probe().
+        target (float): The requested seek time in seconds.
+    """
+    i = bisect.bisect_right(keyframes, target)
+    return keyframes[i - 1] if i else target
@@ -0,0 +1,183 @@
+# qoe.py
+"""
+Playback quality-of-experience telemetry for watch parties.
+
+Every player (script.js) sends a compact "qoe" frame every few seconds: its media
+time and play state, buffered ranges, rebuffer stalls since the last report and how
+long each remote command took to take effect. The relay (server.py) feeds them into
+a QoEAggregator, which keeps per group:
+
+    drift_ms     Spread of the members' playback positions, projected to the moment
+                 a report arrives (computed whenever two or more members are playing).
+    apply_ms     Time from receiving a remote play/pause/seek to the media event that
+                 completes it ('playing', 'pause', 'seeked').
+    stall_ms     Time spent rebuffering per report interval, plus rebuffer counts
+                 (in total and within a few seconds of a remote seek).
+
+Samples live in fixed-size rings, so memory per group is constant; percentiles are
+taken over the samples of the rolling window. Groups that stop reporting are forgotten
+once the window has passed, so memory overall stays bounded by the active groups.
+
+Summaries of all groups are keyed by group_key(), not by group ID: a group ID is all it
+takes to join a party, so it must not leak through the metrics.
+
+Configured through environment variables:
+    RELAY_QOE_WINDOW_S     Rolling window for percentiles (default 300).
+    RELAY_QOE_SAMPLES      Ring size per metric and group (default 512).
+    RELAY_QOE_REPORT_S     Interval of the per-group summary log lines (default 60, 0 disables).
+"""
+import hashlib
+import logging
+import math
+import os
+import time
+from collections import deque
+
+from stats import percentile
+
+# Configure logger for this module
+logger = logging.getLogger(__name__)
+
+QOE_WINDOW_S = float(os.environ.get("RELAY_QOE_WINDOW_S", "300"))
+QOE_SAMPLES = int(os.environ.get("RELAY_QOE_SAMPLES", "512"))
+QOE_REPORT_S = float(os.environ.get("RELAY_QOE_REPORT_S", "60"))
+REPORT_FRESH_S = 15.0 # A member's last report counts towards drift for this long
+MAX_APPLY_SAMPLES = 20 # Per report; script.js sends at most this many
+MAX_VALUE_MS = 600_000.0 # Larger values are client bugs, not measurements
+PRUNE_INTERVAL_S = 60.0 # How often record() forgets groups that went quiet
+
+
+def group_key(group_id: str) -> str:
+    """Stable pseudonym of a group for published metrics."""
+    return hashlib.sha256(group_id.encode("utf-8")).hexdigest()[:12]
+
+
+def _number(value, limit: float = MAX_VALUE_MS) -> float | None:
+    """The value as a finite float within [0, limit], or None."""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    value = float(value)
+    return value if math.isfinite(value) and 0 <= value <= limit else None
+
+def _percentiles(values: list) -> dict:
+    values = sorted(values)
+    return {"count": len(values), "p50": round(percentile(values, 50), 1), "p95": round(percentile(values, 95), 1),
+            "p99": round(percentile(values, 99), 1), "max": round(values[-1], 1) if values else 0.0}
+
+
+class Ring:
+    """The last `size` (timestamp, value) samples of one metric."""
+
+    def __init__(self, size: int = QOE_SAMPLES):
+        self._samples = deque(maxlen=size)
+
+    def add(self, value: float, now: float):
+        self._samples.append((now, value))
+
+    def window(self, now: float, window_s: float = QOE_WINDOW_S) -> list:
+        """Values sampled within the last `window_s` seconds."""
+        return [value for t, value in self._samples if now - t <= window_s]
+
+
+class GroupQoE:
+    """Rolling QoE state of one group."""
+
+    def __init__(self, size: int = QOE_SAMPLES):
+        self.drift_ms = Ring(size)
+        self.apply_ms = Ring(size)
+        self.stall_ms = Ring(size) # Rebuffering time per report
+        self.rebuffers = Ring(size) # (rebuffers, of which after a remote seek) per report with any
+        self.positions = {} # {user: (received_at, media_time, paused, rate)} from each member's last report
+        self.last_report = 0.0
+
+    def record(self, user: str, report: dict, now: float):
+        self.last_report = now
+        media_time = _number(report.get("mediaTime"), float("inf"))
+        if media_time is not None:
+            rate = _number(report.get("rate"), 16.0)
+            self.positions[user] = (now, media_time, bool(report.get("paused")), 1.0 if rate is None else rate)
+        apply_ms = report.get("applyMs")
+        for value in (apply_ms if isinstance(apply_ms, list) else [])[:MAX_APPLY_SAMPLES]:
+            value = _number(value)
+            if value is not None:
+                self.apply_ms.add(value, now)
+        stall = _number(report.get("rebufferMs"))
+        if stall is not None:
+            self.stall_ms.add(stall, now)
+        rebuffers = _number(report.get("rebuffers"), 1000.0)
+        if rebuffers:
+            after_seek = _number(report.get("rebuffersAfterSeek"), rebuffers) or 0.0
+            self.rebuffers.add((int(rebuffers), int(after_seek)), now)
+        self._sample_drift(now)
+
+    def _sample_drift(self, now: float):
+        # Project every fresh, playing member's position to `now` and take the spread.
+        for user, (received_at, *_) in list(self.positions.items()):
+            if now - received_at > REPORT_FRESH_S:
+                del self.positions[user] # Left, or its player is gone
+        playing = [media_time + (now - received_at) * rate
+                   for received_at, media_time, paused, rate in self.positions.values() if not paused]
+        if len(playing) >= 2:
+            self.drift_ms.add((max(playing) - min(playing)) * 1000, now)
+
+    def summary(self, now: float, window_s: float = QOE_WINDOW_S) -> dict:
+        rebuffers = self.rebuffers.window(now, window_s)
+        stalls = self.stall_ms.window(now, window_s)
+        return {
+            "members_reporting": len(self.positions),
+            "reports": len(stalls),
+            "drift_ms": _percentiles(self.drift_ms.window(now, window_s)),
+            "apply_ms": _percentiles(self.apply_ms.window(now, window_s)),
+            "stall_ms": _percentiles(stalls),
+            "rebuffers": sum(count for count, _ in rebuffers),
+            "rebuffers_after_seek": sum(after_seek for _, after_seek in rebuffers),
+        }
+
+
+class QoEAggregator:
+    """Per-group QoE for every group that reported within the window."""
+
+    def __init__(self, window_s: float = QOE_WINDOW_S, samples: int = QOE_SAMPLES):
+        self.window_s = window_s
+        self.samples = samples
+        self.groups = {}
+        self._last_prune = time.monotonic()
+
+    def record(self, group_id: str, user: str, report: dict, now: float | None = None):
+        """Adds one client report (a parsed "qoe" frame)."""
+        now = time.monotonic() if now is None else now
+        if now - self._last_prune >= PRUNE_INTERVAL_S:
+            self._last_prune = now
+            self.prune(now)
+        group = self.groups.get(group_id)
+        if group is None:
+            group = self.groups[group_id] = GroupQoE(self.samples)
+        group.record(user, report, now)
+
+    def summary(self, group_id: str | None = None, now: float | None = None) -> dict | None:
+        """
+        Percentiles over the rolling window.
+
+        Returns:
+            dict | None: One group's summary (None if it never reported), or {group_key: summary}
+                         for all groups if `group_id` is None.
+        """
+        now = time.monotonic() if now is None else now
+        if group_id is not None:
+            group = self.groups.get(group_id)
+            return group.summary(now, self.window_s) if group else None
+        self.prune(now)
+        return {group_key(gid): group.summary(now, self.window_s) for gid, group in self.groups.items()}
+
+    def prune(self, now: float | None = None):
+        """Forgets groups that haven't reported within the window."""
+        now = time.monotonic() if now is None else now
+        for group_id in [gid for gid, group in self.groups.items() if now - group.last_report > self.window_s]:
+            del self.groups[group_id]
+
+    def log_summary(self):
+        for key, s in self.summary().items():
+            logger.info(f"QoE group {key}: drift p50 {s['drift_ms']['p50']:.0f} ms / p95 {s['drift_ms']['p95']:.0f} ms, "
+                        f"apply p50 {s['apply_ms']['p50']:.0f} ms / p95 {s['apply_ms']['p95']:.0f} ms, "
+                        f"{s['rebuffers']} rebuffers ({s['rebuffers_after_seek']} after remote seeks), "
+                        f"stall p95 {s['stall_ms']['p95']:.0f} ms per report, {s['members_reporting']} members reporting")
@@ -0,0 +1,232 @@
+# replay.py
+"""
+Replays a relay capture (see capture.py) against a running relay and reports
+delivery latency and throughput.
+
+Every captured connection is reopened at its captured time and sends its frames
+on the captured schedule, divided by --speed. Chat and sync frames get a
+"replaySeq" field; the relay forwards frames verbatim, so every connection that
+receives one can match it to its send time. Connections close when they did in
+the capture.
+
+By default each captured group is replayed under a fresh group ID that is
+created through the membership socket first. The relay only accepts joins to
+known groups, and fresh IDs keep a repeated replay from colliding with the
+playback state (and Lamport clocks) of the previous run.
+
+Reported: frames sent, deliveries, delivery latency p50/p95/p99/max, send and
+delivery throughput, connection errors, and how far the replayer itself fell
+behind the schedule (if that is large, the results measure the replayer, not
+the relay; lower --speed).
+
+Usage:
+    RELAY_CAPTURE_FILE=night.jsonl.gz python server.py    # record
+    python replay.py night.jsonl.gz                       # replay at 1x
+    python replay.py night.jsonl.gz --speed 10 --json results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+import websockets
+
+import capture
+import membership
+from stats import percentile
+
+logger = logging.getLogger(__name__)
+
+RELAYED_TYPES = ("chat", "sync") # Frames the relay fans out to the rest of the group
+CLOSE_GRACE_S = 1.0 # How long to keep listening after the last frame, for deliveries in flight
+
+
+@dataclass
+class ReplayStats:
+    frames_sent: int = 0
+    relayed_sent: int = 0 # Frames tagged with a replaySeq
+    deliveries: int = 0
+    other_received: int = 0 # Relay-generated frames (join/leave/state/...)
+    connections: int = 0
+    connection_errors: int = 0
+    max_schedule_lag_s: float = 0.0
+    latencies_s: list = field(default_factory=list)
+    sent_at: dict = field(default_factory=dict) # {replaySeq: perf_counter() at send}
+
+
+def remap_groups(records: list, fresh: bool) -> dict:
+    """Maps every captured group ID to the ID to replay it under."""
+    group_ids = sorted({record[2] for record in records if record[2]})
+    return {gid: (str(uuid.uuid4())[:8] if fresh else gid) for gid in group_ids}
+
+def group_creators(records: list) -> dict:
+    """The first user seen in each captured group, used as the creator of the replayed group."""
+    creators = {}
+    for _, _, group_id, frame in records:
+        if group_id and frame and group_id not in creators:
+            try:
+                data = json.loads(frame)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(data, dict):
+                creators[group_id] = data.get("username") or data.get("sender")
+    return creators
+
+def ensure_groups(group_map: dict, creators: dict, socket_path: str) -> int:
+    """
+    Creates the replayed groups that don't exist yet through the relay's membership socket.
+
+    Returns:
+        int: The number of groups created.
+
+    Raises:
+        membership.MembershipError: If the membership socket can't be reached.
+    """
+    client = membership.MembershipClient(socket_path)
+    created = 0
+    try:
+        for captured_id, group_id in group_map.items():
+            if client.group_exists(group_id):
+                continue
+            creator = creators.get(captured_id) or "replay"
+            record = {"creator": creator, "members": {creator}, "created_at": time.time(),
+                      "video_info": {"filename": "replay.mp4", "size": 0, "type": "video/mp4"}}
+            created += bool(client.create_group(group_id, record))
+    finally:
+        client.close()
+    return created
+
+def prepare_frame(frame: str, group_map: dict, stats: ReplayStats) -> str:
+    """Rewrites the group ID and tags relayed frames with a replaySeq."""
+    try:
+        data = json.loads(frame)
+    except json.JSONDecodeError:
+        return frame # Replayed as captured; the relay logs and ignores it
+    if not isinstance(data, dict):
+        return frame
+    if data.get("groupId") in group_map:
+        data["groupId"] = group_map[data["groupId"]]
+    if data.get("type") in RELAYED_TYPES:
+        data["replaySeq"] = stats.relayed_sent
+        stats.sent_at[stats.relayed_sent] = time.perf_counter()
+        stats.relayed_sent += 1
+    return json.dumps(data)
+
+async def receive(ws, stats: ReplayStats):
+    async for message in ws:
+        received = time.perf_counter()
+        try:
+            data = json.loads(message)
+        except json.JSONDecodeError:
+            continue
+        for item in data if isinstance(data, list) else [data]: # Chat batches arrive as arrays
+            seq = item.get("replaySeq") if isinstance(item, dict) else None
+            if seq in stats.sent_at:
+                stats.deliveries += 1
+                stats.latencies_s.append(received - stats.sent_at[seq])
+            else:
+                stats.other_received += 1
+
+async def replay_connection(url: str, records: list, group_map: dict, start: float, speed: float, stats: ReplayStats):
+    """Opens one captured connection at its captured time and sends its frames on schedule."""
+    async def wait_until(offset: float):
+        delay = start + offset / speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            stats.max_schedule_lag_s = max(stats.max_schedule_lag_s, -delay)
+
+    await wait_until(records[0][0])
+    try:
+        async with websockets.connect(url, max_size=None) as ws:
+            stats.connections += 1
+            listener = asyncio.create_task(receive(ws, stats))
+            for offset, _, _, frame in records:
+                await wait_until(offset)
+                if frame is None:
+                    break # The connection closed here in the capture
+                await ws.send(prepare_frame(frame, group_map, stats))
+                stats.frames_sent += 1
+            else:
+                await asyncio.sleep(CLOSE_GRACE_S) # Captured connection was still open at the end
+            listener.cancel()
+    except (OSError, websockets.exceptions.WebSocketException) as e:
+        stats.connection_errors += 1
+        logger.warning(f"Replayed connection failed: {e}")
+
+async def replay(records: list, url: str, speed: float, group_map: dict) -> dict:
+    """
+    Replays captured records against the relay at `url`.
+
+    Returns:
+        dict: Counts, latency percentiles (ms) and throughput (frames/s).
+    """
+    by_connection = defaultdict(list)
+    for record in records:
+        by_connection[record[1]].append(record)
+    stats = ReplayStats()
+    lead_in = records[0][0] if records else 0.0 # Idle time before the first captured frame is skipped
+    start = time.perf_counter() - lead_in / speed
+    await asyncio.gather(*(replay_connection(url, conn_records, group_map, start, speed, stats)
+                           for conn_records in by_connection.values()))
+    elapsed = time.perf_counter() - start - lead_in / speed
+    latencies_ms = sorted(latency * 1000 for latency in stats.latencies_s)
+    return {
+        "speed": speed,
+        "captured_s": records[-1][0] - lead_in if records else 0.0,
+        "elapsed_s": elapsed,
+        "connections": stats.connections,
+        "connection_errors": stats.connection_errors,
+        "frames_sent": stats.frames_sent,
+        "relayed_sent": stats.relayed_sent,
+        "deliveries": stats.deliveries,
+        "other_received": stats.other_received,
+        "latency_p50_ms": percentile(latencies_ms, 50),
+        "latency_p95_ms": percentile(latencies_ms, 95),
+        "latency_p99_ms": percentile(latencies_ms, 99),
+        "latency_max_ms": latencies_ms[-1] if latencies_ms else 0.0,
+        "sent_per_s": stats.frames_sent / elapsed if elapsed else 0.0,
+        "deliveries_per_s": stats.deliveries / elapsed if elapsed else 0.0,
+        "max_schedule_lag_ms": stats.max_schedule_lag_s * 1000,
+    }
+
+def format_report(report: dict) -> str:
+    width = max(len(key) for key in report)
+    return "\n".join(f"{key.ljust(width)}  {value:.3f}" if isinstance(value, float) else f"{key.ljust(width)}  {value}"
+                     for key, value in report.items())
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a relay capture and measure latency and throughput.")
+    parser.add_argument("capture", help="Capture file written with RELAY_CAPTURE_FILE")
+    parser.add_argument("--url", default="ws://localhost:8765", help="Relay to replay against")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor (2 = twice as fast)")
+    parser.add_argument("--fresh-groups", action=argparse.BooleanOptionalAction, default=True,
+                        help="Replay each captured group under a new group ID")
+    parser.add_argument("--create-groups", action=argparse.BooleanOptionalAction, default=True,
+                        help="Create missing groups through the membership socket first")
+    parser.add_argument("--membership-socket", default=membership.MEMBERSHIP_SOCKET, help="The relay's membership socket")
+    parser.add_argument("--json", metavar="PATH", help="Also write the report as JSON")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    header, records = capture.read_capture(args.capture)
+    group_map = remap_groups(records, args.fresh_groups)
+    if args.create_groups:
+        created = ensure_groups(group_map, group_creators(records), args.membership_socket)
+        logger.info(f"Created {created} of {len(group_map)} groups for the replay")
+    logger.info(f"Replaying {len(records)} records captured at {time.ctime(header['startedAt'])} at {args.speed}x")
+    report = asyncio.run(replay(records, args.url, args.speed, group_map))
+    print(format_report(report))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
+        logger.info(f"Wrote report to {args.json}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
@@ -21,6 +21,13 @@
     }
     const playbackAction = container.dataset.playbackAction; // "play", "pause", "seek" or ""
     const seekTime = container.dataset.seekTime // number as string or ""
+    // Ascending keyframe times (seconds) from the MP4 index; empty if unknown
+    let keyframes = [];
+    try {
+      keyframes = JSON.parse(container.dataset.keyframes || "[]");
+    } catch (e) {
+      console.warn("Could not parse keyframe index:", e);
+    }
   
     console.log("Streamlit Data:", { websocketUrl, groupId, username, outgoingMessage, playbackAction, seekTime });
   
@@ -30,9 +37,26 @@
   
     // --- State Variables ---
     let ws = null; // WebSocket connection object
-    let isRemoteActionInProgress = false; // Flag to prevent sync loops
+    // Playback intents are ordered by (clock, origin) Lamport timestamps; the newest one wins
+    // everywhere (sync.PlaybackIntents is the Python twin of this logic).
+    let clock = 0;
+    let lastIntent = [0, ""]; // (clock, origin) of the intent the player currently reflects
+    let expectedPaused = true; // Play state the last intent asked for
+    let expectedSeek = null; // Position a pending seek will land on; its 'seeked' event isn't a user action
     let connectAttempt = 0;
     const MAX_CONNECT_ATTEMPTS = 5; // Prevent infinite loops
+
+    // Playback QoE telemetry, reported to the relay every QOE_INTERVAL_MS (aggregated by qoe.py)
+    const QOE_INTERVAL_MS = 5000;
+    const MAX_APPLY_SAMPLES = 20; // Per report
+    const REBUFFER_AFTER_SEEK_MS = 5000; // Stalls this soon after a remote seek are attributed to it
+    let pendingApply = null; // {event, startedAt}: the media event that completes the remote command being applied
+    let applySamples = []; // ms from receiving a remote command to that event
+    let rebuffers = 0;
+    let rebuffersAfterSeek = 0;
+    let rebufferMs = 0;
+    let stallStartedAt = null;
+    let lastRemoteSeekAt = -Infinity;
   
   
     // --- Helper Functions ---
@@ -74,14 +98,66 @@
          Streamlit.setComponentValue({ type: type, data: ackData });
     }
   
-    // Function to perform video actions, managing the sync loop flag
+    // Returns the latest keyframe at or before `time`, so every peer resumes from
+    // the same decodable frame instead of decoding forward from different points.
+    function snapToKeyframe(time) {
+      let lo = 0, hi = keyframes.length;
+      while (lo < hi) {
+        const mid = (lo + hi) >> 1;
+        if (keyframes[mid] <= time) lo = mid + 1; else hi = mid;
+      }
+      return lo > 0 ? keyframes[lo - 1] : time;
+    }
+  
+    function isNewerIntent(intentClock, origin) {
+      return intentClock > lastIntent[0] || (intentClock === lastIntent[0] && origin > lastIntent[1]);
+    }
+  
+    // Remember what an intent asks for, so the media events it causes aren't re-sent as new intents.
+    function recordIntent(action, time) {
+      if (action === "play") expectedPaused = false;
+      else if (action === "pause") expectedPaused = true;
+      else if (action === "seek") expectedSeek = time;
+    }
+  
+    // Sends a new intent for a local user action.
+    function emitIntent(action, time = null) {
+      clock += 1;
+      lastIntent = [clock, username];
+      recordIntent(action, time);
+      const syncData = { type: "sync", action: action, groupId: groupId, sender: username,
+                         clock: clock, origin: username, intentId: `${username}:${clock}` };
+      if (time !== null) syncData.time = time;
+      return sendMessage(syncData);
+    }
+  
+    // Applies a received intent unless a newer one (ours or anyone's) was already applied.
+    function applyIntent(data) {
+      if (typeof data.clock !== "number") { // Peer without intent ordering
+        if (data.sender === username) return;
+        recordIntent(data.action, data.time);
+        startApplyTimer(data.action);
+        performVideoAction(data.action, data.time);
+        return;
+      }
+      clock = Math.max(clock, data.clock);
+      if (!isNewerIntent(data.clock, data.origin)) {
+        console.log(`Discarding stale intent ${data.intentId} (have ${lastIntent.join(":")})`);
+        return;
+      }
+      lastIntent = [data.clock, data.origin];
+      recordIntent(data.action, data.time);
+      startApplyTimer(data.action);
+      performVideoAction(data.action, data.time);
+    }
+  
+    // Function to perform video actions (the resulting media events are recognised via recordIntent)
     function performVideoAction(action, time = null) {
        if (!videoElement) {
           console.error("Video element not found for action:", action);
           return;
        }
        console.log(`Performing remote action: ${action} ${time !== null ? `to ${time}` : ''}`);
-       isRemoteActionInProgress = true; // Set flag BEFORE action
   
        try {
           if (action === 'play') {
@@ -95,28 +171,86 @@
                    videoElement.currentTime = time;
               } else {
                    console.log(`Skipping seek, already close to target time ${time}`);
-                   // Clear flag immediately if action is skipped
-                   isRemoteActionInProgress = false;
+                   expectedSeek = null; // No 'seeked' event will follow
+                   pendingApply = null;
               }
           }
        } catch (error) {
            console.error(`Error during video action ${action}:`, error);
-           isRemoteActionInProgress = false; // Clear flag on error
        }
-  
-       // Reset the flag shortly after initiating the action.
-       // Using setTimeout ensures it happens after the current JS execution block.
-       // If seek event doesn't clear it reliably, this is a fallback.
-       setTimeout(() => {
-           // Check if the flag might have already been cleared by an event listener
-           if (isRemoteActionInProgress) {
-                console.log(`Clearing remote action flag via setTimeout for action: ${action}`);
-                isRemoteActionInProgress = false;
-           }
-       }, 100); // 100ms delay, adjust if needed
     }
   
   
+    // --- Playback QoE Telemetry ---
+
+    function startApplyTimer(action) {
+      const event = { play: "playing", pause: "pause", seek: "seeked" }[action];
+      if (!event || !videoElement) return;
+      if ((action === "play" && !videoElement.paused) || (action === "pause" && videoElement.paused)) {
+        pendingApply = null; // Already in that state; no event will follow
+        return;
+      }
+      pendingApply = { event: event, startedAt: performance.now() };
+      if (action === "seek") lastRemoteSeekAt = performance.now();
+    }
+
+    function completeApply(event) {
+      if (pendingApply && pendingApply.event === event) {
+        if (applySamples.length < MAX_APPLY_SAMPLES) {
+          applySamples.push(Math.round(performance.now() - pendingApply.startedAt));
+        }
+        pendingApply = null;
+      }
+    }
+
+    function endStall() {
+      if (stallStartedAt !== null) {
+        rebufferMs += performance.now() - stallStartedAt;
+        stallStartedAt = null;
+      }
+    }
+
+    // Buffered ranges as [start, end] pairs rounded to 0.1 s (at most 4, nearest the playhead first)
+    function bufferedRanges() {
+      const ranges = [];
+      for (let i = 0; i < videoElement.buffered.length; i++) {
+        ranges.push([Math.round(videoElement.buffered.start(i) * 10) / 10, Math.round(videoElement.buffered.end(i) * 10) / 10]);
+      }
+      const now = videoElement.currentTime;
+      ranges.sort((a, b) => Math.abs((a[0] + a[1]) / 2 - now) - Math.abs((b[0] + b[1]) / 2 - now));
+      return ranges.slice(0, 4);
+    }
+
+    function sendQoeReport() {
+      if (!videoElement || !ws || ws.readyState !== WebSocket.OPEN) return;
+      const stalled = stallStartedAt !== null;
+      if (stalled) { // Report the stall so far; the rest goes into the next report
+        endStall();
+        stallStartedAt = performance.now();
+      }
+      const now = videoElement.currentTime;
+      const ranges = bufferedRanges();
+      const ahead = ranges.find(([start, end]) => start <= now && now <= end);
+      sendMessage({
+        type: "qoe",
+        groupId: groupId,
+        sender: username,
+        mediaTime: Math.round(now * 1000) / 1000,
+        paused: videoElement.paused,
+        rate: videoElement.playbackRate,
+        bufferedAhead: ahead ? Math.round((ahead[1] - now) * 10) / 10 : 0,
+        ranges: ranges,
+        stalled: stalled,
+        rebuffers: rebuffers,
+        rebuffersAfterSeek: rebuffersAfterSeek,
+        rebufferMs: Math.round(rebufferMs),
+        applyMs: applySamples
+      });
+      applySamples = [];
+      rebuffers = rebuffersAfterSeek = rebufferMs = 0;
+    }
+
+
     // --- WebSocket Connection Logic ---
   
     function connect() {
@@ -156,6 +290,13 @@
         try {
           const data = JSON.parse(event.data);
   
+          if (Array.isArray(data)) {
+            // Chat messages the server batched into one frame: hand them over in one go (one rerun).
+            console.log(`Received batch of ${data.length} chat messages, sending to Streamlit.`);
+            Streamlit.setComponentValue({ type: "received_chat_batch", data: data });
+            return;
+          }
+  
           // Handle different message types from server
           switch (data.type) {
             case "chat":
@@ -166,7 +307,20 @@
             case "sync":
               // Perform the playback action locally
               console.log("Received sync command:", data);
-              performVideoAction(data.action, data.time); // time might be null
+              applyIntent(data);
+              break;
+            case "state":
+              // Where the room currently is, sent by the server when we (re)join.
+              console.log("Received playback state:", data);
+              if (typeof data.clock === "number") {
+                clock = Math.max(clock, data.clock);
+                if (!isNewerIntent(data.clock, data.origin)) break;
+                lastIntent = [data.clock, data.origin];
+              }
+              recordIntent("seek", data.time);
+              recordIntent(data.paused ? "pause" : "play");
+              performVideoAction("seek", data.time);
+              performVideoAction(data.paused ? "pause" : "play");
               break;
             case "notification":
               // Display notification (e.g., user joined/left) - maybe send to Streamlit?
@@ -200,6 +354,16 @@
         updateStatus(`Connection closed (${event.code}).`, event.wasClean ? false : true);
         ws = null; // Clear the WebSocket object
   
+        if (event.code === 1012) {
+          // Server is restarting and told us when to come back (staggered across clients).
+          let delay = 1000;
+          try { delay = JSON.parse(event.reason).reconnectAfterMs ?? delay; } catch (e) { /* keep default */ }
+          connectAttempt = 0; // A planned restart isn't a failed attempt
+          console.log(`Server restarting; reconnecting in ${delay} ms.`);
+          updateStatus("Server restarting. Reconnecting shortly...");
+          setTimeout(connect, delay);
+          return;
+        }
         // Implement basic reconnect logic (optional)
         if (connectAttempt < MAX_CONNECT_ATTEMPTS) {
              let timeout = Math.pow(2, connectAttempt) * 1000; // Exponential backoff
@@ -225,47 +389,68 @@
         return;
       }
       console.log("Setting up video event listeners.");
+      expectedPaused = videoElement.paused;
   
+      videoElement.addEventListener('playing', () => {
+        completeApply("playing");
+        endStall();
+      });
+
+      videoElement.addEventListener('waiting', () => {
+        // Playback stopped because the next frames aren't buffered (e.g. after a seek)
+        if (videoElement.paused || stallStartedAt !== null) return;
+        stallStartedAt = performance.now();
+        rebuffers += 1;
+        if (stallStartedAt - lastRemoteSeekAt <= REBUFFER_AFTER_SEEK_MS) rebuffersAfterSeek += 1;
+      });
+
       videoElement.addEventListener('play', () => {
-        if (isRemoteActionInProgress) {
-          console.log("Local 'play' event ignored (triggered by remote action).");
-          // Important: Clear the flag here IF the remote action directly caused this event
-          // isRemoteActionInProgress = false; // Test carefully if needed here or only in setTimeout
+        if (!expectedPaused) {
+          console.log("Local 'play' event matches the last intent (not a new action).");
           return;
         }
         console.log("Local 'play' event detected -> Sending sync message.");
-        sendMessage({ type: "sync", action: "play", groupId: groupId, sender: username });
+        emitIntent("play", videoElement.currentTime);
       });
   
       videoElement.addEventListener('pause', () => {
+        completeApply("pause");
+        endStall();
         // If video ends naturally, it pauses. Don't sync that unless intended.
         if (videoElement.ended) {
            console.log("Local 'pause' event ignored (video ended).");
            return;
         }
-        if (isRemoteActionInProgress) {
-          console.log("Local 'pause' event ignored (triggered by remote action).");
-          // isRemoteActionInProgress = false; // Test carefully
+        if (expectedPaused) {
+          console.log("Local 'pause' event matches the last intent (not a new action).");
           return;
         }
         console.log("Local 'pause' event detected -> Sending sync message.");
-        sendMessage({ type: "sync", action: "pause", groupId: groupId, sender: username });
+        emitIntent("pause", videoElement.currentTime);
       });
   
       videoElement.addEventListener('seeked', () => {
         // The 'seeked' event fires *after* a seek operation completes.
-        if (isRemoteActionInProgress) {
-          console.log("Local 'seeked' event finished (triggered by remote action). Clearing flag.");
-          // This is a good place to clear the flag after a remote seek
-          isRemoteActionInProgress = false;
+        completeApply("seeked");
+        if (expectedSeek !== null && Math.abs(videoElement.currentTime - expectedSeek) <= 0.5) {
+          console.log("Local 'seeked' event reached the intended position (not a new action).");
+          expectedSeek = null;
           return;
         }
         // Only send seek events initiated locally (e.g., user clicks progress bar)
         // Avoid sending seeks caused by play/pause events if currentTime changes slightly.
         // A robust way needs tracking if the user is *actively* seeking.
-        // Simple approach for now: always send seeked unless remote flag is set.
-        console.log("Local 'seeked' event detected -> Sending sync message. Time:", videoElement.currentTime);
-        sendMessage({ type: "sync", action: "seek", time: videoElement.currentTime, groupId: groupId, sender: username });
+        const target = snapToKeyframe(videoElement.currentTime);
+        const snapping = Math.abs(target - videoElement.currentTime) > 0.05;
+        console.log("Local 'seeked' event detected -> Sending sync message. Time:", target);
+        emitIntent("seek", target); // Records target as expectedSeek
+        if (snapping) {
+          // Move ourselves to the keyframe too; the resulting 'seeked' matches expectedSeek.
+          console.log(`Snapping local seek to keyframe ${target}`);
+          videoElement.currentTime = target;
+        } else {
+          expectedSeek = null; // Already there; no further 'seeked' event
+        }
       });
   
        videoElement.addEventListener('ended', () => {
@@ -286,7 +471,11 @@
     // Use setTimeout to delay slightly, allowing Streamlit to render the video
     setTimeout(setupVideoListeners, 500); // Adjust delay if needed
   
-    // 3. Send outgoing chat message if flagged by Streamlit
+    // 3. Report playback QoE periodically, and once more when this frame is torn down (every rerun)
+    setInterval(sendQoeReport, QOE_INTERVAL_MS);
+    window.addEventListener("pagehide", sendQoeReport);
+
+    // 4. Send outgoing chat message if flagged by Streamlit
     if (outgoingMessage && outgoingMessage.text) {
       console.log("Found outgoing message flag from Streamlit:", outgoingMessage);
       const success = sendMessage({
@@ -294,7 +483,9 @@
           groupId: groupId,
           sender: username, // Ensure sender is correct
           text: outgoingMessage.text,
-          time: outgoingMessage.time || new Date().toLocaleTimeString() // Add time if missing
+          time: outgoingMessage.time || new Date().toLocaleTimeString(), // Add time if missing
+          seq: outgoingMessage.seq, // Position in the persisted history (cursor for paging)
+          id: outgoingMessage.id // Sender-assigned ID, used by receivers to drop duplicates
       });
       // Acknowledge back to Streamlit that we attempted to send it
       if(success) {
@@ -302,7 +493,7 @@
       } // If sending failed, an error might have already been sent back
     }
   
-    // 4. Send playback action if flagged by Streamlit
+    // 5. Send playback action if flagged by Streamlit
     if (playbackAction) {
         console.log("Found playback action flag from Streamlit:", playbackAction, seekTime);
         let timeValue = null;
@@ -314,21 +505,10 @@
             }
         }
   
-        // Perform the action locally FIRST for responsiveness
-        // Note: This might trigger local event listeners, but the flag should handle it.
+        // Send the intent, then perform it locally; the media event it causes matches the
+        // recorded intent, so the listeners don't send it a second time.
+        const success = emitIntent(playbackAction, timeValue);
         performVideoAction(playbackAction, timeValue);
-  
-        // Then send the sync message to the server
-        const syncData = {
-            type: "sync",
-            action: playbackAction,
-            groupId: groupId,
-            sender: username
-        };
-        if (timeValue !== null) {
-            syncData.time = timeValue;
-        }
-        const success = sendMessage(syncData);
          // Acknowledge back to Streamlit that we attempted to send it
          if (success) {
              sendAckToStreamlit("playback_action_sent", { action: playbackAction });
@@ -1,10 +1,21 @@
 #!/usr/bin/env python
 
 import asyncio
+import hmac
+import http
 import json
 import logging
+import os
+import signal
+import time
+import urllib.parse
 import websockets
-from collections import defaultdict
+
+import capture
+import membership
+import qoe
+import tracing
+import uploads
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -19,32 +30,128 @@ logger = logging.getLogger("WebSocketServer")
 # If you needed to look up by username, you'd need an inverse map or store differently.
 CLIENTS = {}
 
-# Store groups: {group_id: {websocket_connection1, websocket_connection2, ...}}
-# Using defaultdict avoids checking if group_id exists before adding members.
-GROUPS = defaultdict(set)
+# Active groups: {group_id: GroupActor}. Each group's actor task owns its member list and
+# delivers the group's frames in order (see GroupActor); a group exists while it has members.
+GROUPS = {}
+GROUP_INBOX_SIZE = 1024 # Frames a group may have waiting before senders are made to wait
+DRAIN_FLUSH_TIMEOUT_S = 5.0 # How long a drain waits for the groups' queued frames to go out
+# A recipient whose frame isn't written within this is dropped (its writes only block once
+# websockets' write buffer is full, so this is a reader that has stopped keeping up).
+SEND_TIMEOUT_S = float(os.environ.get("RELAY_SEND_TIMEOUT_S", "5"))
+CLOSE_CODE_TOO_SLOW = 1013 # "Try again later"; the client reconnects
+DROPPED = set() # Slow connections being closed; skipped by every group until they're unregistered
+
+# Channels each connection is subscribed to: {websocket_connection: {group_id, ...}}.
+# One connection can carry many groups (see subscribe_client); GROUPS is the inverse index.
+SUBSCRIPTIONS = {}
+MAX_SUBSCRIPTIONS = int(os.environ.get("RELAY_MAX_SUBSCRIPTIONS", "32"))
+
+# Shared group membership and live presence. The Streamlit app reaches it through the
+# membership socket served alongside the relay (see main()).
+REGISTRY = None
+
+# Sampled per-frame tracing; replaced in main() according to RELAY_TRACE_* (see tracing.py).
+TRACER = tracing.Tracer(None)
+
+# Optional recording of incoming frames for replay.py; replaced in main() according to RELAY_CAPTURE_* (see capture.py).
+CAPTURE = capture.Capture(None)
+
+# Playback QoE reported by the players ("qoe" frames), aggregated per group; served at QOE_PATH.
+# The endpoint shares the public relay port, so it answers only requests carrying
+# RELAY_QOE_TOKEN (Authorization: Bearer <token>, or ?token=) and is off when that is unset.
+QOE = qoe.QoEAggregator()
+QOE_PATH = "/qoe"
+QOE_TOKEN = os.environ.get("RELAY_QOE_TOKEN") or None
+
+# Last known playback state per group: {group_id: {"paused", "position", "updatedAt", "sender"}}.
+# Sent to (re)joining clients and carried across restarts in the drain snapshot. A group's
+# entry is dropped once it has stayed empty for PLAYBACK_STATE_GRACE_S.
+PLAYBACK_STATE = {}
+PLAYBACK_STATE_GRACE_S = float(os.environ.get("RELAY_PLAYBACK_STATE_GRACE_S", "60"))
+
+# When each user last left each group: {group_id: {username: monotonic time}}. The Streamlit
+# iframe reconnects on every rerun; a user back within REJOIN_QUIET_S (or still connected
+# elsewhere) already has the room's state and isn't sent it again (it would force a seek).
+RECENT_LEAVES = {}
+REJOIN_QUIET_S = float(os.environ.get("RELAY_REJOIN_QUIET_S", "10"))
+PLAYBACK_PRUNES = {} # {group_id: asyncio.TimerHandle} for empty groups awaiting pruning
+
+# --- Chat Micro-Batching ---
+# With a window > 0, chat frames for a group arriving within the window are delivered to
+# each recipient as one JSON array frame (fewer frames, and one rerun instead of many on
+# the Streamlit side). Sync frames never wait. 0 (the default) sends every frame at once.
+CHAT_BATCH_WINDOW_MS = float(os.environ.get("RELAY_CHAT_BATCH_MS", "0"))
+
+# --- Drain / Restart Settings ---
+SNAPSHOT_FILE = os.environ.get("RELAY_SNAPSHOT_FILE", "relay_snapshot.json")
+SNAPSHOT_MAX_AGE_S = 600 # Older snapshots describe rooms that have long moved on
+RECONNECT_BASE_MS = int(os.environ.get("RELAY_RECONNECT_BASE_MS", "1000")) # Time for the new process to come up
+RECONNECT_SPREAD_MS = int(os.environ.get("RELAY_RECONNECT_SPREAD_MS", "10000")) # Window the reconnects are spread over
+CLOSE_CODE_SERVICE_RESTART = 1012
+DRAINING = False
 
 # --- Helper Functions ---
 
 async def register_client(websocket, join_data):
-    """Registers a new client and adds them to the requested group."""
+    """
+    Identifies a new client. A 'join' frame also subscribes it to its group (the original
+    one-group-per-connection protocol); an 'identify' frame subscribes to nothing, and the
+    client then sends 'subscribe'/'unsubscribe' frames for any number of groups.
+    """
     username = join_data.get("username")
     group_id = join_data.get("groupId")
+    is_join = join_data.get("type") == "join"
 
-    if not username or not group_id:
+    if not username or (is_join and not group_id):
         logger.warning(f"Invalid join data from {websocket.remote_address}: {join_data}")
         await websocket.send(json.dumps({"type": "error", "message": "Username and groupId required for join."}))
         # Close connection if join fails? Maybe allow retry depending on frontend logic.
         # await websocket.close(code=1008, reason="Invalid join message")
         return False # Indicate registration failed
 
+    # Only groups created through the app may be joined; this is a dict lookup, not a file read.
+    if is_join and not REGISTRY.group_exists(group_id):
+        logger.warning(f"User '{username}' tried to join unknown group '{group_id}' from {websocket.remote_address}")
+        await websocket.send(json.dumps({"type": "error", "message": f"Group {group_id} does not exist."}))
+        await websocket.close(code=1008, reason="Unknown group.")
+        return False
+
     # Store client mapping
     CLIENTS[websocket] = username
-    # Add client websocket to the group set
-    GROUPS[group_id].add(websocket)
+    SUBSCRIPTIONS[websocket] = set()
+    logger.info(f"Client Registered: User '{username}' ({websocket.remote_address}).")
+    if is_join:
+        await subscribe_client(websocket, group_id)
+    return True # Indicate registration succeeded
 
-    logger.info(f"Client Registered: User '{username}' ({websocket.remote_address}) joined group '{group_id}'.")
-    logger.debug(f"Current state - CLIENTS: { {c.remote_address: u for c, u in CLIENTS.items()} }") # Log addresses for readability
-    logger.debug(f"Current state - GROUPS: { {gid: {c.remote_address for c in members} for gid, members in GROUPS.items()} }")
+async def subscribe_client(websocket, group_id):
+    """Adds a registered connection to a group's channel. Returns False (after telling the client) if refused."""
+    username = CLIENTS[websocket]
+    subscriptions = SUBSCRIPTIONS[websocket]
+    if group_id in subscriptions:
+        return True
+    if not REGISTRY.group_exists(group_id):
+        logger.warning(f"User '{username}' tried to subscribe to unknown group '{group_id}'")
+        await websocket.send(json.dumps({"type": "error", "groupId": group_id, "message": f"Group {group_id} does not exist."}))
+        return False
+    if len(subscriptions) >= MAX_SUBSCRIPTIONS:
+        logger.warning(f"User '{username}' hit the subscription limit ({MAX_SUBSCRIPTIONS}) subscribing to '{group_id}'")
+        await websocket.send(json.dumps({"type": "error", "groupId": group_id, "message": f"At most {MAX_SUBSCRIPTIONS} groups per connection."}))
+        return False
+
+    subscriptions.add(group_id)
+    actor = GROUPS.get(group_id)
+    if actor is None:
+        actor = GROUPS[group_id] = GroupActor(group_id)
+        prune = PLAYBACK_PRUNES.pop(group_id, None)
+        if prune:
+            prune.cancel() # Back before its state was dropped
+    actor.add(websocket)
+    REGISTRY.connect(group_id, username)
+    logger.info(f"User '{username}' ({websocket.remote_address}) joined group '{group_id}'.")
+    if group_id in PLAYBACK_STATE and needs_playback_state(group_id, websocket):
+        # Bring a (re)joining client to where the room is instead of waiting for the next action.
+        await websocket.send(json.dumps(playback_state_message(group_id)))
 
     # Optionally, notify others in the group that a new user joined
     join_notification = json.dumps({
@@ -53,74 +160,464 @@ async def register_client(websocket, join_data):
         "text": f"{username} has joined the movie night! 💞"
     })
     await broadcast(group_id, join_notification, sender=websocket) # Send to others
-
-    return True # Indicate registration succeeded
+    return True
+
+async def unsubscribe_client(websocket, group_id, notify=True):
+    """Removes a connection from a group's channel, deleting the channel once it's empty."""
+    subscriptions = SUBSCRIPTIONS.get(websocket, set())
+    if group_id not in subscriptions:
+        return False
+    username = CLIENTS[websocket]
+    subscriptions.remove(group_id)
+    actor = GROUPS[group_id]
+    actor.remove(websocket)
+    REGISTRY.disconnect(group_id, username)
+    RECENT_LEAVES.setdefault(group_id, {})[username] = time.monotonic()
+    logger.debug(f"Removed {username} from group '{group_id}'.")
+    if not actor.members:
+        logger.info(f"Group '{group_id}' is now empty, removing.")
+        del GROUPS[group_id]
+        actor.stop()
+        schedule_playback_prune(group_id, PLAYBACK_STATE_GRACE_S)
+    elif notify:
+        leave_notification = json.dumps({
+            "type": "notification",
+            "groupId": group_id,
+            "text": f"{username} has left the movie night. 👋"
+        })
+        await broadcast(group_id, leave_notification, sender=websocket)
+    return True
 
 async def unregister_client(websocket):
-    """Removes a client from tracking and groups upon disconnection."""
+    """Removes a client from tracking and all of its groups upon disconnection."""
     username = CLIENTS.get(websocket)
     if not username:
         logger.warning(f"Attempted to unregister unknown client: {websocket.remote_address}")
         return # Client was likely never fully registered
 
     logger.info(f"Client Disconnected: User '{username}' ({websocket.remote_address})")
-
-    # Find which groups the client was in and remove them
-    groups_to_leave = []
-    for group_id, members in GROUPS.items():
-        if websocket in members:
-            members.remove(websocket)
-            logger.debug(f"Removed {username} from group '{group_id}'.")
-            groups_to_leave.append(group_id)
-            # If group becomes empty, remove the group itself
-            if not members:
-                logger.info(f"Group '{group_id}' is now empty, removing.")
-                del GROUPS[group_id] # Need to handle potential concurrent modification if iterating directly
-
-    # Remove from the main client registry
+    # Only this connection's own subscriptions are visited, not every group.
+    for group_id in list(SUBSCRIPTIONS.get(websocket, ())):
+        # While draining everyone is being asked to reconnect, so nobody is really leaving.
+        await unsubscribe_client(websocket, group_id, notify=not DRAINING)
+    SUBSCRIPTIONS.pop(websocket, None)
+    DROPPED.discard(websocket)
     del CLIENTS[websocket]
 
     logger.debug(f"Current state after unregister - CLIENTS: { {c.remote_address: u for c, u in CLIENTS.items()} }")
-    logger.debug(f"Current state after unregister - GROUPS: { {gid: {c.remote_address for c in members} for gid, members in GROUPS.items()} }")
-
-    # Notify others in the groups that the user left
-    if groups_to_leave:
-         leave_notification = json.dumps({
-            "type": "notification",
-            "text": f"{username} has left the movie night. 👋"
-         })
-         # Must iterate through the groups *before* potential deletion in GROUPS dict
-         for group_id in groups_to_leave:
-              # Check if group still exists (might be empty now)
-              if group_id in GROUPS:
-                   await broadcast(group_id, leave_notification, sender=websocket) # Sender doesn't matter here
-
-async def broadcast(group_id, message, sender):
-    """Sends a message to all clients in a group EXCEPT the sender."""
-    if group_id in GROUPS:
-        # Create a list of tasks for sending messages concurrently
-        message_tasks = []
-        # Iterate over a copy of the set to avoid issues if the set is modified during iteration (e.g., disconnects)
-        members_copy = set(GROUPS[group_id])
-        for client_ws in members_copy:
-            if client_ws != sender: # Don't send back to the original sender
-                # Create a task for each send operation
-                 message_tasks.append(asyncio.create_task(client_ws.send(message)))
-
-        # Wait for all send tasks to complete (or fail)
-        if message_tasks:
-            done, pending = await asyncio.wait(message_tasks, return_when=asyncio.FIRST_COMPLETED) # Or ALL_COMPLETED
-
-            # Optional: Log errors from failed sends
-            for future in done:
-                if future.exception():
-                    logger.error(f"Error sending message during broadcast: {future.exception()}")
-            # Optional: Handle pending tasks (e.g., cancel them if needed)
-            for future in pending:
-                 future.cancel()
-
+    logger.debug(f"Current state after unregister - GROUPS: { {gid: [c.remote_address for c in actor.members] for gid, actor in GROUPS.items()} }")
+
+async def broadcast(group_id, message, sender, span=None):
+    """
+    Queues a message for all clients in a group EXCEPT the sender. The group's actor sends it
+    after everything queued before it. `span` traces the fan-out if sampled and is ended by the actor.
+    """
+    actor = GROUPS.get(group_id)
+    if actor:
+        await actor.post(message, sender, span)
     else:
         logger.warning(f"Attempted to broadcast to non-existent group: {group_id}")
+        if span:
+            span.end()
+
+
+# --- Group Actors ---
+
+class GroupActor:
+    """
+    Delivers one group's frames from an inbox, in the order they were queued.
+
+    The member list is an immutable tuple that is replaced (never modified) when someone
+    joins or leaves, and the "everyone but the sender" tuples derived from it are cached
+    until then. A queued frame keeps the tuple it was queued with, so fanning it out copies
+    nothing and a member who joins later doesn't receive it.
+
+    With chat batching on, the actor also holds the group's chat frames for the batch window
+    and hands them to the inbox as one item, so they stay ordered against sync frames.
+
+    Each frame is written to every recipient before the next one is taken from the inbox,
+    so a slow reader holds its group back (and, once the inbox is full, the senders) until
+    it catches up or is dropped after SEND_TIMEOUT_S.
+    """
+
+    def __init__(self, group_id):
+        self.group_id = group_id
+        self.members = ()
+        self._others = {} # {sender: members without the sender}, valid for the current tuple
+        self.pending_chat = [] # [(sender_websocket, raw_message), ...] awaiting the next flush
+        self._flush_handle = None
+        self.stopped = False
+        self.inbox = asyncio.Queue(maxsize=GROUP_INBOX_SIZE)
+        self.task = asyncio.create_task(self._run(), name=f"group-{group_id}")
+
+    def add(self, websocket):
+        if websocket not in self.members:
+            self.members = self.members + (websocket,)
+            self._others = {}
+
+    def remove(self, websocket):
+        if websocket in self.members:
+            self.members = tuple(ws for ws in self.members if ws is not websocket)
+            self._others = {}
+
+    def recipients(self, sender):
+        """Members except `sender`, built once per membership change."""
+        others = self._others.get(sender)
+        if others is None:
+            others = self._others[sender] = tuple(ws for ws in self.members if ws is not sender)
+        return others
+
+    async def post(self, message, sender, span=None):
+        """Queues one frame for everyone but `sender` (waits while the inbox is full)."""
+        if self.stopped:
+            return # The group emptied; nobody is left to receive it
+        await self.inbox.put(("frame", message, self.recipients(sender), span))
+
+    def queue_chat(self, message, sender):
+        """Holds a chat frame for the next flush, scheduling one if none is pending."""
+        if not self.pending_chat:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                CHAT_BATCH_WINDOW_MS / 1000, lambda: asyncio.create_task(self.flush_chat()))
+        self.pending_chat.append((sender, message))
+
+    async def flush_chat(self):
+        """Queues the pending chat frames: one frame per recipient, without their own messages."""
+        if self.stopped:
+            return # Scheduled just before the group emptied
+        batch, self.pending_chat = self.pending_chat, []
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if len(batch) == 1:
+            sender, message = batch[0]
+            await self.post(message, sender)
+        elif batch:
+            await self.inbox.put(("batch", batch, self.members, None))
+
+    def stop(self):
+        """Ends the actor of a group that has no members left; anything still queued was for them."""
+        self.stopped = True
+        if self._flush_handle:
+            self._flush_handle.cancel()
+        self.task.cancel()
+
+    async def _run(self):
+        while True:
+            kind, payload, recipients, span = await self.inbox.get()
+            try:
+                if kind == "frame":
+                    if span:
+                        span.mark("queue")
+                    await self._send([(ws, payload) for ws in recipients], span)
+                else:
+                    await self._send(self._batch_frames(payload, recipients))
+            except Exception as e:
+                logger.error(f"Error delivering to group '{self.group_id}': {e}", exc_info=True)
+            finally:
+                if span:
+                    span.end()
+                self.inbox.task_done()
+
+    def _batch_frames(self, batch, recipients):
+        frames = []
+        for client_ws in recipients:
+            messages = [message for sender, message in batch if sender is not client_ws]
+            if not messages:
+                continue
+            # The frames are already JSON; join them instead of decoding and re-encoding.
+            frames.append((client_ws, messages[0] if len(messages) == 1 else "[" + ",".join(messages) + "]"))
+        logger.debug(f"Flushed {len(batch)} chat messages to group '{self.group_id}' as {len(frames)} frames.")
+        return frames
+
+    async def _send(self, frames, span=None):
+        # One send task per recipient, all awaited: the next frame only goes out once this
+        # one has been written everywhere (or its slow recipients have been dropped).
+        message_tasks = {}
+        for client_ws, frame in frames:
+            if client_ws in DROPPED:
+                continue
+            task = asyncio.create_task(client_ws.send(frame))
+            task.add_done_callback(self._log_send_error)
+            message_tasks[task] = client_ws
+            if span:
+                span.send(task, TRACER.thread_id(client_ws, CLIENTS.get(client_ws)))
+        if span:
+            span.mark("fanout", recipients=len(message_tasks))
+        if not message_tasks:
+            return
+        _, pending = await asyncio.wait(message_tasks, timeout=SEND_TIMEOUT_S)
+        for task in pending:
+            task.cancel()
+            drop_slow_client(message_tasks[task], self.group_id)
+
+    def _log_send_error(self, task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"Error sending message to group '{self.group_id}': {task.exception()}")
+
+
+def drop_slow_client(websocket, group_id):
+    """Stops delivering to a connection that can't keep up and closes it."""
+    if websocket in DROPPED:
+        return
+    DROPPED.add(websocket)
+    logger.warning(f"Dropping slow client '{CLIENTS.get(websocket)}' ({websocket.remote_address}) of group '{group_id}': "
+                   f"a frame took over {SEND_TIMEOUT_S:g}s to write.")
+    for gid in SUBSCRIPTIONS.get(websocket, ()):
+        GROUPS[gid].remove(websocket)
+    # Not close(): its handshake would queue behind the same full buffer. The handler sees the
+    # connection fail and unregisters it as usual.
+    websocket.fail_connection(CLOSE_CODE_TOO_SLOW, "Too slow to keep up")
+
+
+# --- Playback State, Snapshot and Drain ---
+
+def record_playback(group_id, data):
+    """
+    Updates the cached playback state of a group from a sync message.
+
+    Intents carrying a Lamport clock are resolved last-writer-wins on (clock, origin),
+    the same order clients use (sync.intent_key): one older than the group's newest
+    intent is stale and must not be relayed.
+
+    Returns:
+        bool: False if the message is a stale intent.
+    """
+    state = PLAYBACK_STATE.setdefault(group_id, {"paused": True, "position": 0.0, "updatedAt": time.time(), "sender": None})
+    if isinstance(data.get("clock"), int):
+        key = (data["clock"], data.get("origin") or data.get("sender") or "")
+        if key <= (state.get("clock", 0), state.get("origin") or ""):
+            return False
+        state["clock"], state["origin"] = key
+    state["position"] = current_position(state) # Account for playback since the last update
+    action = data.get("action")
+    if action in ("play", "pause"):
+        state["paused"] = action == "pause"
+    if isinstance(data.get("time"), (int, float)):
+        state["position"] = float(data["time"])
+    state["updatedAt"] = time.time()
+    state["sender"] = data.get("sender")
+    return True
+
+def current_position(state):
+    """Estimated playback position now: the recorded position plus elapsed wall time while playing."""
+    if state["paused"]:
+        return state["position"]
+    return state["position"] + (time.time() - state["updatedAt"])
+
+def needs_playback_state(group_id, websocket):
+    """
+    Whether a newly subscribed connection should get the room's playback state: only if its
+    user has no other connection in the group and didn't just leave it (an iframe reload).
+    """
+    username = CLIENTS[websocket]
+    if any(CLIENTS.get(ws) == username for ws in GROUPS[group_id].members if ws is not websocket):
+        return False
+    left_at = RECENT_LEAVES.get(group_id, {}).pop(username, None)
+    return left_at is None or time.monotonic() - left_at > REJOIN_QUIET_S
+
+def schedule_playback_prune(group_id, delay_s):
+    """Forgets a group's playback state and leave times after `delay_s`, unless it has members again by then."""
+    def prune():
+        PLAYBACK_PRUNES.pop(group_id, None)
+        if group_id not in GROUPS and not DRAINING:
+            RECENT_LEAVES.pop(group_id, None)
+            if PLAYBACK_STATE.pop(group_id, None) is not None:
+                logger.debug(f"Dropped playback state of empty group '{group_id}'.")
+    previous = PLAYBACK_PRUNES.get(group_id)
+    if previous:
+        previous.cancel()
+    PLAYBACK_PRUNES[group_id] = asyncio.get_running_loop().call_later(delay_s, prune)
+
+def playback_state_message(group_id):
+    state = PLAYBACK_STATE[group_id]
+    message = {"type": "state", "groupId": group_id, "paused": state["paused"],
+               "time": round(current_position(state), 3), "sender": state["sender"]}
+    if "clock" in state: # Lets the client order this against intents still in flight
+        message.update({"clock": state["clock"], "origin": state["origin"]})
+    return message
+
+def save_snapshot(path):
+    """Writes group presence and playback state to `path` atomically (write, fsync, rename)."""
+    snapshot = {
+        "version": 1,
+        "savedAt": time.time(),
+        "groups": {gid: sorted(CLIENTS[ws] for ws in actor.members) for gid, actor in GROUPS.items()},
+        "playback": {gid: dict(state, position=current_position(state), updatedAt=time.time())
+                     for gid, state in PLAYBACK_STATE.items()},
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    logger.info(f"Saved snapshot of {len(snapshot['groups'])} groups and {len(snapshot['playback'])} playback states to {path}")
+
+def restore_snapshot(path):
+    """Loads playback state saved by a draining predecessor. The snapshot is consumed (deleted)."""
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, "r") as f:
+            snapshot = json.load(f)
+        os.remove(path)
+    except (json.JSONDecodeError, OSError) as e:
+        logger.error(f"Could not read snapshot {path}: {e}")
+        return
+    age = time.time() - snapshot.get("savedAt", 0)
+    if age > SNAPSHOT_MAX_AGE_S:
+        logger.warning(f"Ignoring snapshot {path} saved {age:.0f}s ago.")
+        return
+    # Rooms nobody comes back to are dropped once everyone has had their chance to reconnect.
+    reconnect_window_s = (RECONNECT_BASE_MS + RECONNECT_SPREAD_MS) / 1000
+    for group_id, state in snapshot.get("playback", {}).items():
+        if REGISTRY.group_exists(group_id):
+            PLAYBACK_STATE[group_id] = state
+            schedule_playback_prune(group_id, reconnect_window_s + PLAYBACK_STATE_GRACE_S)
+    expected = sum(len(users) for users in snapshot.get("groups", {}).values())
+    logger.info(f"Restored playback state for {len(PLAYBACK_STATE)} groups from {path} ({age:.1f}s old); expecting {expected} clients back.")
+
+def reconnect_delay_ms(index, total):
+    """Staggered reconnect hint for the index-th of `total` closed connections."""
+    return RECONNECT_BASE_MS + (RECONNECT_SPREAD_MS * index // max(total, 1))
+
+async def drain(ws_server):
+    """
+    Stops accepting connections, snapshots state, then closes every client with
+    "service restart" and a staggered reconnect hint so the next process isn't hit all at once.
+    """
+    global DRAINING
+    DRAINING = True
+    ws_server.server.close() # Stop listening; open connections stay up until closed below
+    logger.info(f"Draining: stopped accepting connections, {len(CLIENTS)} clients connected.")
+    actors = list(GROUPS.values())
+    for actor in actors: # Deliver held chat and queued frames before everyone is disconnected
+        await actor.flush_chat()
+    if actors:
+        await asyncio.wait([asyncio.create_task(actor.inbox.join()) for actor in actors], timeout=DRAIN_FLUSH_TIMEOUT_S)
+    save_snapshot(SNAPSHOT_FILE)
+    # Members of a room get neighbouring slots so each room comes back together. A connection
+    # subscribed to several rooms is closed once; idle (unsubscribed) ones go last.
+    connections = list(dict.fromkeys([ws for actor in actors for ws in actor.members] + list(CLIENTS)))
+    closes = []
+    for index, ws in enumerate(connections):
+        reason = json.dumps({"reconnectAfterMs": reconnect_delay_ms(index, len(connections))})
+        closes.append(ws.close(code=CLOSE_CODE_SERVICE_RESTART, reason=reason))
+    await asyncio.gather(*closes, return_exceptions=True)
+    logger.info(f"Drain complete: closed {len(connections)} connections.")
+
+
+# --- Relay-Hosted Media (plain HTTP on the same port) ---
+# Groups created with "share through the relay" record the creator's upload ID. Joiners'
+# players stream that single copy with Range requests instead of uploading their own.
+# Each response covers at most one upload chunk, which is checked against the manifest
+# hash before it is sent, so memory per request is bounded by uploads.CHUNK_SIZE.
+# Requests must carry the group's media token (?token=..., created with the group and only
+# handed to its members), since the responses are readable from any origin.
+
+MEDIA_PREFIX = "/media/"
+MEDIA_HEADERS = [
+    ("Access-Control-Allow-Origin", "*"), # The player is served by Streamlit on another origin
+    ("Access-Control-Expose-Headers", "Content-Range, X-Chunk-Index, X-Chunk-Sha256"),
+    ("Cache-Control", "private, max-age=3600"),
+]
+
+def parse_range(range_header, size):
+    """
+    Parses a single 'bytes=' range (including suffix ranges) against `size`.
+
+    Returns:
+        tuple[int, int] | None: Inclusive (start, end), or None if it can't be satisfied.
+    """
+    if not range_header:
+        return (0, size - 1) if size else None # Players always send Range; treat a plain GET as 'bytes=0-'
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first: # Suffix range: the last N bytes
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    return (start, end) if 0 <= start <= end else None
+
+async def process_request(path, request_headers):
+    """websockets hook: answers /media/ and /qoe requests over HTTP, lets everything else upgrade to WebSocket."""
+    path, _, query = path.partition("?")
+    if path == QOE_PATH or path.startswith(QOE_PATH + "/"):
+        return qoe_response(path[len(QOE_PATH) + 1:], query, request_headers)
+    if not path.startswith(MEDIA_PREFIX):
+        return None
+    group_id, _, resource = path[len(MEDIA_PREFIX):].partition("/")
+    group_data = REGISTRY.get_group(group_id)
+    upload_id = group_data["video_info"].get("relay_upload_id") if group_data else None
+    if not upload_id:
+        return http.HTTPStatus.NOT_FOUND, MEDIA_HEADERS, b"No shared video for this group.\n"
+    expected_token = group_data["video_info"].get("media_token") or ""
+    token = urllib.parse.parse_qs(query).get("token", [""])[0]
+    if not expected_token or not hmac.compare_digest(token.encode("utf-8"), expected_token.encode("utf-8")):
+        logger.warning(f"Refused media request for group '{group_id}' without a valid token.")
+        return http.HTTPStatus.FORBIDDEN, MEDIA_HEADERS, b"Missing or invalid media token.\n"
+    manifest = uploads.load_manifest(upload_id)
+    if not manifest or not manifest.get("complete"):
+        return http.HTTPStatus.SERVICE_UNAVAILABLE, MEDIA_HEADERS + [("Retry-After", "2")], b"Video is still uploading.\n"
+
+    if resource == "manifest":
+        body = {key: manifest.get(key) for key in ("filename", "size", "chunk_size", "chunks", "digest")}
+        return http.HTTPStatus.OK, MEDIA_HEADERS + [("Content-Type", "application/json")], json.dumps(body).encode("utf-8")
+    if resource:
+        return http.HTTPStatus.NOT_FOUND, MEDIA_HEADERS, b"Unknown media resource.\n"
+
+    size, chunk_size = manifest["size"], manifest["chunk_size"]
+    byte_range = parse_range(request_headers.get("Range"), size)
+    if byte_range is None:
+        return http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, MEDIA_HEADERS + [("Content-Range", f"bytes */{size}")], b""
+    start, end = byte_range
+    index = start // chunk_size
+    try:
+        # Reading and hashing a chunk takes milliseconds; keep it off the event loop.
+        data, chunk_hash = await asyncio.to_thread(uploads.read_chunk, upload_id, index)
+    except (uploads.UploadError, OSError) as e:
+        logger.error(f"Refusing to serve chunk {index} of group '{group_id}': {e}")
+        return http.HTTPStatus.INTERNAL_SERVER_ERROR, MEDIA_HEADERS, b"Video chunk failed verification.\n"
+    chunk_start = index * chunk_size
+    end = min(end, chunk_start + len(data) - 1) # Partial responses stop at the chunk boundary
+    headers = MEDIA_HEADERS + [
+        ("Content-Type", group_data["video_info"].get("type") or "video/mp4"),
+        ("Accept-Ranges", "bytes"),
+        ("Content-Range", f"bytes {start}-{end}/{size}"),
+        ("X-Chunk-Index", str(index)),
+        ("X-Chunk-Sha256", chunk_hash),
+    ]
+    logger.debug(f"Serving bytes {start}-{end} of group '{group_id}' video (chunk {index}).")
+    return http.HTTPStatus.PARTIAL_CONTENT, headers, data[start - chunk_start:end - chunk_start + 1]
+
+
+def qoe_response(group_id, query, request_headers):
+    """
+    JSON QoE percentiles for one group (/qoe/<group_id>) or all groups (/qoe, keyed by
+    qoe.group_key so no group IDs are listed). Requires the operator token QOE_TOKEN.
+    """
+    if not QOE_TOKEN:
+        return http.HTTPStatus.NOT_FOUND, [("Content-Type", "text/plain")], b"QoE endpoint disabled (set RELAY_QOE_TOKEN).\n"
+    authorization = request_headers.get("Authorization") or ""
+    token = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else urllib.parse.parse_qs(query).get("token", [""])[0]
+    if not hmac.compare_digest(token.encode("utf-8"), QOE_TOKEN.encode("utf-8")):
+        return http.HTTPStatus.UNAUTHORIZED, [("Content-Type", "text/plain"), ("WWW-Authenticate", "Bearer")], b"Missing or invalid QoE token.\n"
+    summary = QOE.summary(group_id or None)
+    if summary is None:
+        return http.HTTPStatus.NOT_FOUND, [("Content-Type", "text/plain")], b"No QoE reports for this group.\n"
+    body = {"windowS": QOE.window_s, "group" if group_id else "groups": summary}
+    return http.HTTPStatus.OK, [("Content-Type", "application/json"), ("Cache-Control", "no-store")], json.dumps(body).encode("utf-8")
+
+async def log_qoe(interval_s):
+    """Logs each group's QoE summary every `interval_s` seconds."""
+    while True:
+        await asyncio.sleep(interval_s)
+        QOE.log_summary()
 
 
 # --- Main Connection Handler ---
@@ -128,20 +625,21 @@ async def broadcast(group_id, message, sender):
 async def handler(websocket, path):
     """Handles a single client connection."""
     logger.info(f"New connection attempt from: {websocket.remote_address}")
+    if DRAINING:
+        await websocket.close(code=CLOSE_CODE_SERVICE_RESTART, reason=json.dumps({"reconnectAfterMs": RECONNECT_BASE_MS}))
+        return
     registered = False
-    client_group_id = None # Track the group this connection belongs to
 
     try:
         # --- Registration Step ---
-        # Expect the first message to be a 'join' message
+        # Expect the first message to be 'join' (identify + subscribe to one group) or 'identify'
         join_message_str = await websocket.recv()
         logger.debug(f"Received potential join message: {join_message_str}")
         try:
             join_data = json.loads(join_message_str)
-            if join_data.get("type") == "join":
+            CAPTURE.frame(websocket, join_message_str, join_data)
+            if join_data.get("type") in ("join", "identify"):
                 registered = await register_client(websocket, join_data)
-                if registered:
-                    client_group_id = join_data.get("groupId")
             else:
                 logger.warning(f"First message was not 'join' type from {websocket.remote_address}. Closing.")
                 await websocket.close(code=1002, reason="Join message required first.")
@@ -162,27 +660,55 @@ async def handler(websocket, path):
 
         # --- Message Handling Loop (after successful registration) ---
         async for message in websocket:
+            span = TRACER.frame(websocket, CLIENTS.get(websocket), bytes=len(message))
             logger.debug(f"Received message from {CLIENTS.get(websocket)}: {message}")
             try:
                 data = json.loads(message)
+                CAPTURE.frame(websocket, message, data)
+                if span:
+                    span.mark("parse")
                 msg_type = data.get("type")
-                group_id = data.get("groupId") # Expect groupId on every message after join
+                group_id = data.get("groupId") # Every frame names the channel (group) it's for
 
                 # Basic validation
                 if not msg_type or not group_id:
                     logger.warning(f"Received message without type or groupId from {CLIENTS.get(websocket)}: {data}")
                     continue # Ignore malformed message
 
-                # Ensure the message's group matches the client's registered group (optional security)
-                if group_id != client_group_id:
-                     logger.warning(f"Received message for group '{group_id}' from user {CLIENTS.get(websocket)} who is registered in group '{client_group_id}'. Ignoring.")
+                # --- Channel Management ---
+                if msg_type == "subscribe":
+                    if await subscribe_client(websocket, group_id):
+                        await websocket.send(json.dumps({"type": "subscribed", "groupId": group_id}))
+                    continue
+                if msg_type == "unsubscribe":
+                    await unsubscribe_client(websocket, group_id)
+                    await websocket.send(json.dumps({"type": "unsubscribed", "groupId": group_id}))
+                    continue
+
+                # Only relay into channels this connection is subscribed to
+                if group_id not in SUBSCRIPTIONS[websocket]:
+                     logger.warning(f"Received message for group '{group_id}' from user {CLIENTS.get(websocket)} who isn't subscribed to it. Ignoring.")
                      continue
 
+                # --- Telemetry (kept by the relay, not relayed) ---
+                if msg_type == "qoe":
+                    QOE.record(group_id, CLIENTS.get(websocket), data)
+                    continue
+
                 # --- Relay Logic ---
                 if msg_type == "chat" or msg_type == "sync":
                     # No server-side processing needed, just relay
+                    if msg_type == "sync" and not record_playback(group_id, data):
+                        logger.info(f"Dropping stale intent {data.get('intentId')} from {CLIENTS.get(websocket)} in group '{group_id}'")
+                        continue
                     logger.info(f"Relaying '{msg_type}' message from {CLIENTS.get(websocket)} to group '{group_id}'")
-                    await broadcast(group_id, message, sender=websocket)
+                    if span:
+                        span.mark("route", type=msg_type)
+                    if msg_type == "chat" and CHAT_BATCH_WINDOW_MS > 0:
+                        GROUPS[group_id].queue_chat(message, websocket)
+                    else:
+                        await broadcast(group_id, message, sender=websocket, span=span)
+                        span = None # Ended by the group's actor once the frame is sent
                 # Can add other message types here if needed (e.g., "leave")
                 else:
                      logger.warning(f"Received unknown message type '{msg_type}' from {CLIENTS.get(websocket)}")
@@ -192,27 +718,56 @@ async def handler(websocket, path):
             except Exception as e:
                 logger.error(f"Error processing message from {CLIENTS.get(websocket)}: {e}", exc_info=True)
                 # Decide if the connection should be closed on error
+            finally:
+                if span:
+                    span.end()
 
     except websockets.exceptions.ConnectionClosedOK:
         logger.info(f"Connection closed normally by {CLIENTS.get(websocket, websocket.remote_address)}.")
     except websockets.exceptions.ConnectionClosedError as e:
-        logger.warning(f"Connection closed with error by {CLIENTS.get(websocket, websocket.remote_address)}: {e}")
+        if DRAINING: # We closed it with 1012, which websockets reports as an error
+            logger.info(f"Connection closed for restart: {CLIENTS.get(websocket, websocket.remote_address)}.")
+        else:
+            logger.warning(f"Connection closed with error by {CLIENTS.get(websocket, websocket.remote_address)}: {e}")
     except Exception as e:
         logger.error(f"Unexpected error in handler for {CLIENTS.get(websocket, websocket.remote_address)}: {e}", exc_info=True)
     finally:
         # --- Cleanup ---
         # Ensure client is removed from state regardless of how connection ended
+        CAPTURE.closed(websocket)
         await unregister_client(websocket)
 
 
 # --- Start Server ---
 
 async def main():
+    global REGISTRY, TRACER, CAPTURE
     host = "0.0.0.0" # Listen on all available network interfaces
     port = 8765      # Standard WebSocket port, change if needed
+    REGISTRY = membership.MembershipRegistry(membership.GROUPS_FILE, write_behind=True)
+    TRACER = tracing.Tracer.from_env()
+    CAPTURE = capture.Capture.from_env()
+    loop_monitor = tracing.LoopMonitor(TRACER)
+    loop_monitor.start()
+    qoe_logger = asyncio.create_task(log_qoe(qoe.QOE_REPORT_S)) if qoe.QOE_REPORT_S > 0 else None
+    restore_snapshot(SNAPSHOT_FILE)
+    membership_server = await membership.serve(REGISTRY, membership.MEMBERSHIP_SOCKET)
+    # SIGTERM (e.g., from a process manager restarting us) drains instead of dropping everyone.
+    drain_requested = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, drain_requested.set)
     logger.info(f"Starting WebSocket server on ws://{host}:{port}")
-    async with websockets.serve(handler, host, port):
-        await asyncio.Future()  # Run forever
+    try:
+        async with membership_server, websockets.serve(handler, host, port, process_request=process_request) as ws_server:
+            await drain_requested.wait()
+            await drain(ws_server)
+    finally:
+        # Also on Ctrl+C, so the capture's gzip stream is terminated properly
+        loop_monitor.stop()
+        if qoe_logger:
+            qoe_logger.cancel()
+        TRACER.close()
+        CAPTURE.close()
+        REGISTRY.close() # Writes any membership change still pending
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,13 @@
+# stats.py
+"""
+Small statistics helpers shared by the relay's profiling and QoE code, the Streamlit
+rerun timings and the offline tools (replay, benchmarks, simulator).
+"""
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """Nearest-rank percentile of an already sorted list (0 if empty)."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
@@ -7,6 +7,8 @@ import logging # Use logging for better debugging
 # Configure logger for this module
 logger = logging.getLogger(__name__)
 
+SEEK_MATCH_TOLERANCE_S = 0.5 # A 'seeked' this close to the intended position is the intent's own event
+
 # We are removing get_video_control_js because standard Streamlit cannot easily
 # receive the 'postMessage' events from it. We will initiate sync actions
 # using Streamlit buttons/widgets in main.py instead.
@@ -14,25 +16,50 @@ logger = logging.getLogger(__name__)
 # The JavaScript to *control* the video will be injected directly via
 # st.markdown in the handle_sync_command function below.
 
-def create_sync_message(action: str, current_time: float = None) -> str:
+def build_sync_message(action: str, sender: str, current_time: float = None, timestamp: float = None, clock: int = None) -> dict:
     """
-    Helper function to create a standardized JSON sync message payload.
+    Builds the sync message dictionary sent for a playback action.
+    Kept free of Streamlit state so the same message flow can be driven headlessly (see sync_sim.py).
 
     Args:
         action (str): The playback action ('play', 'pause', 'seek').
+        sender (str): The user who initiated the action.
         current_time (float, optional): The video time for 'seek' actions. Defaults to None.
+        timestamp (float, optional): When the action happened. Defaults to time.time().
+        clock (int, optional): Lamport clock of the intent (see PlaybackIntents). Messages
+                               without one are relayed and applied unordered.
 
     Returns:
-        str: A JSON string representing the sync message.
+        dict: The sync message.
     """
     message = {
         "type": "sync", # Clearly identify message type
         "action": action,
-        "sender": st.session_state.get("user", "unknown"), # Identify who initiated the action
-        "timestamp": time.time() # Optional: helps debugging timing issues
+        "sender": sender, # Identify who initiated the action
+        "timestamp": time.time() if timestamp is None else timestamp # Optional: helps debugging timing issues
     }
     if action == "seek" and current_time is not None:
         message["time"] = current_time
+    if clock is not None:
+        message.update({"clock": clock, "origin": sender, "intentId": f"{sender}:{clock}"})
+    return message
+
+def intent_key(data: dict) -> tuple[int, str]:
+    """Total order of playback intents: Lamport clock, then origin user as the tie-breaker."""
+    return data.get("clock", 0), data.get("origin") or data.get("sender") or ""
+
+def create_sync_message(action: str, current_time: float = None) -> str:
+    """
+    Helper function to create a standardized JSON sync message payload.
+
+    Args:
+        action (str): The playback action ('play', 'pause', 'seek').
+        current_time (float, optional): The video time for 'seek' actions. Defaults to None.
+
+    Returns:
+        str: A JSON string representing the sync message.
+    """
+    message = build_sync_message(action, st.session_state.get("user", "unknown"), current_time)
 
     try:
         return json.dumps(message)
@@ -75,16 +102,17 @@ def send_sync_message(action: str, current_time: float = None):
         st.toast("⚠️ Not connected to partner. Sync disabled.", icon="🔌")
 
 
-def handle_sync_command(data: dict):
+def resolve_sync_command(data: dict, local_user: str | None) -> tuple[str, float | None] | None:
     """
-    Receives parsed sync data (from WebRTC) and injects JavaScript via st.markdown
-    to control the *local* HTML5 video player displayed by st.video.
-
-    This function should be called by the central WebRTC message handler in main.py.
+    Decides whether a received sync message should be applied to the local player.
 
     Args:
         data (dict): The parsed JSON data from the sync message.
-                     Expected keys: 'action', 'sender', potentially 'time'.
+        local_user (str | None): The user this player belongs to.
+
+    Returns:
+        tuple[str, float | None] | None: The (action, time) to apply, or None if the
+                                         message is an echo of our own action or invalid.
     """
     sender = data.get("sender")
     action = data.get("action")
@@ -92,12 +120,104 @@ def handle_sync_command(data: dict):
 
     # --- Crucial: Prevent Echo ---
     # Do not apply sync commands that originated from the current user.
-    if sender == st.session_state.get("user"):
-        # logger.debug(f"Ignoring sync command from self: {action}")
-        return
+    if sender == local_user:
+        return None
     # --- End Prevent Echo ---
 
-    logger.info(f"Handling remote sync command: {action} from {sender}, time: {current_time}")
+    if action in ("play", "pause"):
+        return action, None
+    if action == "seek":
+        # Validate that 'time' exists and is a number before applying
+        if current_time is not None and isinstance(current_time, (int, float)):
+            return action, current_time
+        logger.warning(f"Invalid or missing time received for remote seek action: {current_time}")
+        return None
+    logger.warning(f"Unknown sync action received: {action}")
+    return None
+
+class PlaybackIntents:
+    """
+    Orders one player's playback intents with a Lamport clock and resolves conflicts
+    last-writer-wins (highest intent_key). This mirrors the bridge logic in script.js
+    and is what sync_sim.py drives for the "lamport" protocol.
+
+    Instead of a timed "remote action in progress" flag, a media event is only sent
+    as a new intent if the player's state differs from what the last applied intent
+    asked for; the events an intent causes match it and are dropped deterministically.
+    """
+
+    def __init__(self, user: str):
+        self.user = user
+        self.clock = 0
+        self.last_key = (0, "")
+        self.paused = True # Play state the last intent asked for
+        self.seek_target = None # Position a pending seek will land on
+
+    def _record(self, action: str, current_time: float | None):
+        if action in ("play", "pause"):
+            self.paused = action == "pause"
+        elif action == "seek":
+            self.seek_target = current_time
+
+    def local_event(self, action: str, current_time: float | None = None, timestamp: float = None) -> dict | None:
+        """
+        Turns a local media event into a new intent.
+
+        Returns:
+            dict | None: The sync message to send, or None if the event only reflects
+                         the intent already applied (an echo).
+        """
+        if (action == "play" and not self.paused) or (action == "pause" and self.paused):
+            return None
+        if action == "seek" and self.seek_target is not None and abs(current_time - self.seek_target) <= SEEK_MATCH_TOLERANCE_S:
+            self.seek_target = None
+            return None
+        self.clock += 1
+        self.last_key = (self.clock, self.user)
+        self._record(action, current_time)
+        if action == "seek":
+            self.seek_target = None # Already at the position; no further 'seeked' follows
+        return build_sync_message(action, self.user, current_time, timestamp, clock=self.clock)
+
+    def receive(self, data: dict) -> tuple[str, float | None] | None:
+        """
+        Resolves a received intent against the newest one applied so far.
+
+        Returns:
+            tuple[str, float | None] | None: The (action, time) to apply, or None if the
+                                             intent is stale, our own, or invalid.
+        """
+        if not isinstance(data.get("clock"), int):
+            command = resolve_sync_command(data, self.user) # Peer without intent ordering
+        else:
+            self.clock = max(self.clock, data["clock"])
+            if intent_key(data) <= self.last_key:
+                return None
+            command = resolve_sync_command(data, self.user)
+            if command is not None:
+                self.last_key = intent_key(data)
+        if command is not None:
+            self._record(*command)
+        return command
+
+def handle_sync_command(data: dict):
+    """
+    Receives parsed sync data (from WebRTC) and injects JavaScript via st.markdown
+    to control the *local* HTML5 video player displayed by st.video.
+
+    This function should be called by the central WebRTC message handler in main.py.
+
+    Args:
+        data (dict): The parsed JSON data from the sync message.
+                     Expected keys: 'action', 'sender', potentially 'time'.
+    """
+    command = resolve_sync_command(data, st.session_state.get("user"))
+    if command is None:
+        # logger.debug(f"Ignoring sync command: {data}")
+        return
+    action, current_time = command
+
+    logger.info(f"Handling remote sync command: {action} from {data.get('sender')}, time: {current_time}")
 
     js_command = ""
     if action == "play":
@@ -106,22 +226,17 @@ def handle_sync_command(data: dict):
     elif action == "pause":
         js_command = "document.querySelector('video')?.pause(); console.log('Remote PAUSE triggered');"
     elif action == "seek":
-        # Validate that 'time' exists and is a number before injecting
-        if current_time is not None and isinstance(current_time, (int, float)):
-            # Check video element exists in JS before setting time.
-            # Add console logs for easier browser-side debugging.
-            js_command = f"""
-            const video = document.querySelector('video');
-            if (video) {{
-                console.log('Remote SEEK triggered to {current_time}');
-                video.currentTime = {current_time};
-            }} else {{
-                console.warn('Sync: Video element not found for seeking.');
-            }}
-            """
-        else:
-            logger.warning(f"Invalid or missing time received for remote seek action: {current_time}")
-            return # Do not execute if time is invalid
+        # Check video element exists in JS before setting time.
+        # Add console logs for easier browser-side debugging.
+        js_command = f"""
+        const video = document.querySelector('video');
+        if (video) {{
+            console.log('Remote SEEK triggered to {current_time}');
+            video.currentTime = {current_time};
+        }} else {{
+            console.warn('Sync: Video element not found for seeking.');
+        }}
+        """
 
     if js_command:
         try:
@@ -131,4 +246,4 @@ def handle_sync_command(data: dict):
         except Exception as e:
             # This catch might be less useful as errors often happen client-side,
             # but good practice to have.
-            logger.error(f"Error trying to inject JS via st.markdown: {e}")
\ No newline at end of file
+            logger.error(f"Error trying to inject JS via st.markdown: {e}")
@@ -0,0 +1,389 @@
+# sync_sim.py
+"""
+Deterministic, headless simulator for the playback sync protocol.
+
+Virtual players mimic the listeners in script.js (play/pause/seeked events)
+with one of two echo-suppression protocols:
+
+    flag     The original remote-action flag and its 100 ms reset, with
+             sync.build_sync_message / sync.resolve_sync_command.
+    lamport  Lamport-clocked intents resolved last-writer-wins
+             (sync.PlaybackIntents), as script.js does now.
+
+Messages travel through a relay that, like server.py, fans out to every member
+except the sender (dropping stale clocked intents), over links with seeded
+latency, jitter and reordering.
+
+For every scenario and network profile it reports how long partners take to
+converge after each user action, the maximum drift while playing, how many
+redundant (echoed) sync messages were sent, and how many user actions were
+swallowed by the remote-action flag.
+
+Usage:
+    python sync_sim.py                                  # all scenarios x all networks
+    python sync_sim.py --scenario seek --network wan --runs 50 --seed 7
+    python sync_sim.py --protocol lamport --json results.json
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import random
+import statistics
+from dataclasses import dataclass
+
+import sync
+from stats import percentile
+
+logger = logging.getLogger(__name__)
+
+# --- Client behaviour mirrored from script.js ---
+REMOTE_FLAG_RESET_S = 0.1 # setTimeout that clears isRemoteActionInProgress
+SEEK_SKIP_TOLERANCE_S = 0.5 # performVideoAction skips seeks closer than this
+MEDIA_EVENT_DELAY_S = 0.004 # play()/pause() -> 'play'/'pause' event dispatch
+
+# --- Measurement ---
+SAMPLE_INTERVAL_S = 0.01
+CONVERGENCE_TOLERANCE_S = 0.25 # Players closer than this (and in the same play state) are "in sync"
+EPISODE_GAP_S = 0.5 # User actions closer together than this are measured as one episode
+DRIFT_GRACE_S = 1.0 # Drift right after a user action is expected and not counted
+
+PROTOCOLS = ("flag", "lamport")
+
+
+@dataclass(frozen=True)
+class NetworkProfile:
+    """One-way link characteristics between a client and the relay."""
+    name: str
+    base_latency: float # Seconds
+    jitter: float # Standard deviation of the latency, seconds
+    reorder_prob: float = 0.0 # Chance a message is held back (and so overtaken)
+    reorder_delay: float = 0.0 # Maximum extra hold-back, seconds
+
+    def sample_delay(self, rng: random.Random) -> float:
+        delay = max(0.0, rng.gauss(self.base_latency, self.jitter))
+        if self.reorder_prob and rng.random() < self.reorder_prob:
+            delay += rng.uniform(0.0, self.reorder_delay)
+        return delay
+
+
+@dataclass(frozen=True)
+class Scenario:
+    """A scripted sequence of user actions: (time, player index, action, seek target)."""
+    name: str
+    description: str
+    actions: tuple
+    duration: float
+    players: int = 2
+
+
+NETWORKS = {
+    "lan": NetworkProfile("lan", 0.005, 0.002),
+    "wan": NetworkProfile("wan", 0.060, 0.020),
+    "mobile": NetworkProfile("mobile", 0.120, 0.060, reorder_prob=0.05, reorder_delay=0.2),
+}
+
+SCENARIOS = {
+    "play_pause": Scenario(
+        "play_pause", "Partners take turns pressing play and pause.",
+        ((1.0, 0, "play", None), (6.0, 0, "pause", None), (9.0, 1, "play", None), (14.0, 1, "pause", None)),
+        18.0),
+    "seek": Scenario(
+        "seek", "One partner seeks while playing, then the other seeks back.",
+        ((1.0, 0, "play", None), (4.0, 0, "seek", 120.0), (9.0, 1, "seek", 30.0)),
+        14.0),
+    "simultaneous_play": Scenario(
+        "simultaneous_play", "Both partners press play, then pause, at almost the same moment.",
+        ((1.0, 0, "play", None), (1.02, 1, "play", None), (5.0, 0, "pause", None), (5.03, 1, "pause", None)),
+        9.0),
+    "scrub": Scenario(
+        "scrub", "One partner drags the progress bar, producing a burst of seeks.",
+        ((1.0, 0, "play", None),) + tuple((3.0 + i * 0.15, 0, "seek", 10.0 * (i + 1)) for i in range(6)),
+        8.0),
+    "conflicting_seek": Scenario(
+        "conflicting_seek", "Both partners seek to different places within 40 ms.",
+        ((1.0, 0, "play", None), (4.0, 0, "seek", 60.0), (4.04, 1, "seek", 200.0)),
+        9.0),
+}
+
+
+class VirtualPlayer:
+    """An HTML5 video element plus the script.js bridge that drives it."""
+
+    def __init__(self, sim: "Simulation", index: int, rate: float):
+        self.sim = sim
+        self.index = index
+        self.username = f"user{index}"
+        self.rate = rate # Playback clock relative to real time (models device clock skew)
+        self.intents = sync.PlaybackIntents(self.username) if sim.protocol == "lamport" else None
+        self.playing = False
+        self._position = 0.0
+        self._anchor = 0.0 # Time from which the position advances (later than "now" while decoding after a seek)
+        self._seeks = 0 # A new seek aborts a pending one, which then fires no 'seeked'
+        self.remote_flag = False # isRemoteActionInProgress
+        self.messages_sent = 0
+        self.echo_messages = 0 # Sent for events that a remote command caused
+        self.lost_actions = 0 # User actions swallowed because the remote flag was set
+
+    def position(self, now: float) -> float:
+        if not self.playing:
+            return self._position
+        return self._position + max(0.0, now - self._anchor) * self.rate
+
+    # --- Media element semantics ---
+
+    # `origin` ("user" or "remote") only feeds the metrics; the listeners can't see it.
+
+    def media_play(self, now: float, origin: str):
+        if self.playing:
+            return # play() on a playing element fires no event
+        self._position, self._anchor, self.playing = self.position(now), now, True
+        self.sim.schedule(now + MEDIA_EVENT_DELAY_S, self.on_media_event, "play", origin)
+
+    def media_pause(self, now: float, origin: str):
+        if not self.playing:
+            return
+        self._position, self.playing = self.position(now), False
+        self.sim.schedule(now + MEDIA_EVENT_DELAY_S, self.on_media_event, "pause", origin)
+
+    def media_seek(self, now: float, target: float, origin: str):
+        # Playback stalls while the decoder catches up from the previous keyframe.
+        decode_time = self.sim.rng.uniform(*self.sim.seek_decode_range)
+        self._position, self._anchor = target, now + decode_time
+        self._seeks += 1
+        self.sim.schedule(now + decode_time, self._seeked, self._seeks, origin)
+
+    def _seeked(self, now: float, seek: int, origin: str):
+        if seek == self._seeks:
+            self.on_media_event(now, "seeked", origin)
+
+    # --- script.js listeners ---
+
+    def on_media_event(self, now: float, event: str, origin: str):
+        action = "seek" if event == "seeked" else event
+        if self.intents:
+            message = self.intents.local_event(action, self.position(now) if action == "seek" else None, timestamp=now)
+            if message is None:
+                return
+            if origin == "remote":
+                self.echo_messages += 1
+            self.messages_sent += 1
+            self.sim.send_to_relay(now, self.index, json.dumps(message))
+            return
+        if self.remote_flag:
+            if event == "seeked":
+                self.remote_flag = False # The seeked listener clears the flag
+            if origin == "user":
+                self.lost_actions += 1
+            return
+        if origin == "remote":
+            self.echo_messages += 1
+        self.send(now, action, self.position(now) if action == "seek" else None)
+
+    def on_remote_message(self, now: float, raw: str):
+        data = json.loads(raw)
+        if self.intents:
+            command = self.intents.receive(data)
+            if command is None:
+                return
+            action, target = command
+            if action == "play":
+                self.media_play(now, "remote")
+            elif action == "pause":
+                self.media_pause(now, "remote")
+            elif action == "seek":
+                if abs(self.position(now) - target) > SEEK_SKIP_TOLERANCE_S:
+                    self.media_seek(now, target, "remote")
+                else:
+                    self.intents.seek_target = None # No 'seeked' will follow
+            return
+        command = sync.resolve_sync_command(data, self.username)
+        if command is None:
+            return
+        action, target = command
+        self.remote_flag = True
+        if action == "play":
+            self.media_play(now, "remote")
+        elif action == "pause":
+            self.media_pause(now, "remote")
+        elif action == "seek":
+            if abs(self.position(now) - target) > SEEK_SKIP_TOLERANCE_S:
+                self.media_seek(now, target, "remote")
+            else:
+                self.remote_flag = False
+        self.sim.schedule(now + REMOTE_FLAG_RESET_S, self._reset_remote_flag)
+
+    def _reset_remote_flag(self, now: float):
+        self.remote_flag = False
+
+    def user_action(self, now: float, action: str, target: float | None):
+        """A local click on the native controls."""
+        if action == "play":
+            self.media_play(now, "user")
+        elif action == "pause":
+            self.media_pause(now, "user")
+        elif action == "seek":
+            self.media_seek(now, target, "user")
+
+    def send(self, now: float, action: str, current_time: float | None):
+        message = sync.build_sync_message(action, self.username, current_time, timestamp=now)
+        self.messages_sent += 1
+        self.sim.send_to_relay(now, self.index, json.dumps(message))
+
+
+class Simulation:
+    """Discrete-event simulation of one scenario over one network profile."""
+
+    def __init__(self, scenario: Scenario, network: NetworkProfile, seed: int,
+                 seek_decode_range: tuple = (0.05, 0.4), clock_skew_ppm: float = 50.0, protocol: str = "flag"):
+        self.scenario = scenario
+        self.network = network
+        self.protocol = protocol
+        self._newest_intent = (0, "") # Relay-side last-writer-wins, as server.record_playback
+        self.rng = random.Random(seed)
+        self.seek_decode_range = seek_decode_range
+        self._queue = []
+        self._counter = itertools.count() # Tie-breaker keeps same-time events in FIFO order
+        self.players = [
+            VirtualPlayer(self, i, 1.0 + self.rng.uniform(-clock_skew_ppm, clock_skew_ppm) * 1e-6)
+            for i in range(scenario.players)
+        ]
+
+    def schedule(self, when: float, callback, *args):
+        heapq.heappush(self._queue, (when, next(self._counter), callback, args))
+
+    def send_to_relay(self, now: float, sender: int, raw: str):
+        self.schedule(now + self.network.sample_delay(self.rng), self._relay, sender, raw)
+
+    def _relay(self, now: float, sender: int, raw: str):
+        data = json.loads(raw)
+        if isinstance(data.get("clock"), int):
+            if sync.intent_key(data) <= self._newest_intent:
+                return # Stale intent, dropped by the relay
+            self._newest_intent = sync.intent_key(data)
+        # Same fan-out as server.broadcast(): everyone in the group except the sender.
+        for player in self.players:
+            if player.index != sender:
+                self.schedule(now + self.network.sample_delay(self.rng), player.on_remote_message, raw)
+
+    def _sample(self, now: float):
+        self.samples.append((now, [p.position(now) for p in self.players], [p.playing for p in self.players]))
+        if now + SAMPLE_INTERVAL_S <= self.scenario.duration:
+            self.schedule(now + SAMPLE_INTERVAL_S, self._sample)
+
+    def run(self) -> dict:
+        self.samples = []
+        for when, index, action, target in self.scenario.actions:
+            self.schedule(when, self.players[index].user_action, action, target)
+        self.schedule(0.0, self._sample)
+        while self._queue:
+            when, _, callback, args = heapq.heappop(self._queue)
+            if when > self.scenario.duration:
+                break
+            callback(when, *args)
+        return self._measure()
+
+    def _measure(self) -> dict:
+        def converged(positions, playing):
+            return len(set(playing)) == 1 and max(positions) - min(positions) <= CONVERGENCE_TOLERANCE_S
+
+        # Group near-simultaneous actions (e.g. both partners pressing play) into episodes.
+        episodes = []
+        for when, *_ in self.scenario.actions:
+            if episodes and when - episodes[-1][-1] < EPISODE_GAP_S:
+                episodes[-1].append(when)
+            else:
+                episodes.append([when])
+        starts = [e[0] for e in episodes]
+        ends = starts[1:] + [self.scenario.duration]
+        convergence = []
+        for start, end in zip(starts, ends):
+            window = [s for s in self.samples if start <= s[0] < end]
+            settled_at = None
+            # Converged means "in sync from here until the next episode".
+            for now, positions, playing in reversed(window):
+                if not converged(positions, playing):
+                    break
+                settled_at = now
+            convergence.append(None if settled_at is None else settled_at - start)
+
+        action_times = [a[0] for a in self.scenario.actions]
+        drift = [
+            max(positions) - min(positions)
+            for now, positions, playing in self.samples
+            if all(playing) and not any(0 <= now - t < DRIFT_GRACE_S for t in action_times)
+        ]
+        final_positions = self.samples[-1][1]
+        return {
+            "convergence_s": convergence,
+            "max_drift_s": max(drift, default=0.0),
+            "final_drift_s": max(final_positions) - min(final_positions),
+            "messages_sent": sum(p.messages_sent for p in self.players),
+            "redundant_messages": sum(p.echo_messages for p in self.players),
+            "lost_actions": sum(p.lost_actions for p in self.players),
+        }
+
+
+def run_benchmark(scenario: Scenario, network: NetworkProfile, seed: int, runs: int, protocol: str = "flag") -> dict:
+    """
+    Runs a scenario `runs` times with consecutive seeds and aggregates the results.
+
+    Returns:
+        dict: Convergence percentiles (over every user action in every run), drift and message counts.
+    """
+    results = [Simulation(scenario, network, seed + i, protocol=protocol).run() for i in range(runs)]
+    convergence = [c for r in results for c in r["convergence_s"] if c is not None]
+    failures = sum(c is None for r in results for c in r["convergence_s"])
+    return {
+        "scenario": scenario.name,
+        "network": network.name,
+        "protocol": protocol,
+        "runs": runs,
+        "convergence_p50_s": statistics.median(convergence) if convergence else None,
+        "convergence_p95_s": percentile(sorted(convergence), 95) if convergence else None,
+        "convergence_max_s": max(convergence) if convergence else None,
+        "not_converged": failures,
+        "max_drift_s": max(r["max_drift_s"] for r in results),
+        "final_drift_max_s": max(r["final_drift_s"] for r in results),
+        "redundant_messages_mean": statistics.mean(r["redundant_messages"] for r in results),
+        "redundant_messages_max": max(r["redundant_messages"] for r in results),
+        "lost_actions": sum(r["lost_actions"] for r in results),
+    }
+
+def format_table(rows: list) -> str:
+    def fmt(value):
+        if value is None:
+            return "-"
+        return f"{value:.3f}" if isinstance(value, float) else str(value)
+    columns = ["scenario", "network", "protocol", "convergence_p50_s", "convergence_p95_s", "not_converged",
+               "max_drift_s", "final_drift_max_s", "redundant_messages_mean", "redundant_messages_max", "lost_actions"]
+    table = [columns] + [[fmt(row[c]) for c in columns] for row in rows]
+    widths = [max(len(r[i]) for r in table) for i in range(len(columns))]
+    return "\n".join("  ".join(cell.ljust(w) for cell, w in zip(r, widths)) for r in table)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark playback sync convergence over simulated networks.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run (repeatable; default: all)")
+    parser.add_argument("--network", action="append", choices=sorted(NETWORKS), help="Network profile (repeatable; default: all)")
+    parser.add_argument("--protocol", action="append", choices=PROTOCOLS, help="Echo-suppression protocol (repeatable; default: both)")
+    parser.add_argument("--runs", type=int, default=20, help="Seeded runs per scenario/network pair")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the first run")
+    parser.add_argument("--json", metavar="PATH", help="Also write the results as JSON")
+    args = parser.parse_args()
+
+    rows = [
+        run_benchmark(SCENARIOS[s], NETWORKS[n], args.seed, args.runs, p)
+        for s in (args.scenario or SCENARIOS)
+        for n in (args.network or NETWORKS)
+        for p in (args.protocol or PROTOCOLS)
+    ]
+    print(format_table(rows))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=4)
+        logger.info(f"Wrote {len(rows)} results to {args.json}")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
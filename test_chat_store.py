@@ -0,0 +1,63 @@
+# test_chat_store.py
+import pytest
+
+import chat_store
+
+
+@pytest.fixture(autouse=True)
+def chat_db(tmp_path, monkeypatch):
+    # A new path makes _get_connection open (and create) a fresh database for each test.
+    monkeypatch.setattr(chat_store, "CHAT_DB_FILE", str(tmp_path / "chat_history.db"))
+
+
+def _message(n, msg_id=None):
+    return {"sender": f"user{n % 2}", "text": f"message {n}", "time": "12:00", "id": msg_id or f"id-{n}"}
+
+
+def test_load_page_walks_back_with_cursor():
+    for n in range(7):
+        chat_store.append_message("g1", _message(n))
+    chat_store.append_message("g2", _message(100)) # Other groups never leak into a page
+
+    page, has_more = chat_store.load_page("g1", limit=3)
+    assert [m["text"] for m in page] == ["message 4", "message 5", "message 6"]
+    assert has_more
+
+    page, has_more = chat_store.load_page("g1", before_seq=page[0]["seq"], limit=3)
+    assert [m["text"] for m in page] == ["message 1", "message 2", "message 3"]
+    assert has_more
+
+    page, has_more = chat_store.load_page("g1", before_seq=page[0]["seq"], limit=3)
+    assert [m["text"] for m in page] == ["message 0"]
+    assert not has_more
+
+
+def test_load_page_exact_multiple_has_no_more():
+    for n in range(3):
+        chat_store.append_message("g1", _message(n))
+    page, has_more = chat_store.load_page("g1", limit=3)
+    assert len(page) == 3
+    assert not has_more
+
+
+def test_load_page_unknown_group_is_empty():
+    assert chat_store.load_page("missing") == ([], False)
+
+
+def test_append_duplicate_id_returns_original_seq():
+    seq = chat_store.append_message("g1", _message(0, msg_id="dup"))
+    chat_store.append_message("g1", _message(1))
+    retried = dict(_message(0, msg_id="dup"), text="retried send")
+    assert chat_store.append_message("g1", retried) == seq
+
+    page, _ = chat_store.load_page("g1")
+    assert [m["id"] for m in page] == ["dup", "id-1"]
+    assert page[0]["text"] == "message 0" # The stored row is never rewritten
+
+
+def test_messages_without_id_are_all_kept():
+    # NULLs are distinct in a UNIQUE index, so messages from clients without IDs still append.
+    first = chat_store.append_message("g1", {"sender": "a", "text": "hi", "time": "12:00"})
+    second = chat_store.append_message("g1", {"sender": "a", "text": "hi", "time": "12:00"})
+    assert first != second
+    assert len(chat_store.load_page("g1")[0]) == 2
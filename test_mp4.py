@@ -0,0 +1,99 @@
+# test_mp4.py
+import io
+import struct
+
+import pytest
+
+import mp4
+
+SAMPLES = [bytes([n]) * 10 for n in range(6)] # Two chunks of three 10-byte samples
+FTYP_SIZE = 20
+MDAT_PAYLOAD = FTYP_SIZE + 8 # Where the first sample lands when mdat follows ftyp
+
+
+def _box(box_type, payload):
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+def _full_box(box_type, payload):
+    return _box(box_type, b"\0\0\0\0" + payload) # Version 0, no flags
+
+def _moov(chunk_offsets, offset_table=b"stco"):
+    fmt = "I" if offset_table == b"stco" else "Q"
+    sample_entry = struct.pack(">I4s", 86, b"avc1") + b"\0" * 24 + struct.pack(">HH", 640, 360) + b"\0" * 50
+    stbl = _box(b"stbl", b"".join([
+        _full_box(b"stsd", struct.pack(">I", 1) + sample_entry),
+        _full_box(b"stts", struct.pack(">III", 1, len(SAMPLES), 1000)),
+        _full_box(b"stss", struct.pack(">III", 2, 1, 4)),
+        _full_box(b"stsz", struct.pack(">II", 0, len(SAMPLES)) + struct.pack(f">{len(SAMPLES)}I", *map(len, SAMPLES))),
+        _full_box(b"stsc", struct.pack(">IIII", 1, 1, 3, 1)),
+        _full_box(offset_table, struct.pack(f">I{len(chunk_offsets)}{fmt}", len(chunk_offsets), *chunk_offsets)),
+    ]))
+    mdia = _box(b"mdia", b"".join([
+        _full_box(b"mdhd", struct.pack(">IIII", 0, 0, 1000, 6000) + b"\0" * 4),
+        _full_box(b"hdlr", b"\0" * 4 + b"vide" + b"\0" * 13),
+        _box(b"minf", stbl),
+    ]))
+    mvhd = _full_box(b"mvhd", struct.pack(">IIII", 0, 0, 1000, 6000) + b"\0" * 80)
+    return _box(b"moov", mvhd + _box(b"trak", mdia))
+
+def _movie(offset_table=b"stco", trailing=b""):
+    """An MP4 with its moov at the end (after mdat and `trailing`), as cameras write them."""
+    ftyp = _box(b"ftyp", b"isom\0\0\0\0isom")
+    assert len(ftyp) == FTYP_SIZE
+    mdat = _box(b"mdat", b"".join(SAMPLES))
+    offsets = [MDAT_PAYLOAD, MDAT_PAYLOAD + 3 * len(SAMPLES[0])]
+    return ftyp + mdat + trailing + _moov(offsets, offset_table)
+
+def _rewrite(data):
+    dst = io.BytesIO()
+    assert mp4.faststart(io.BytesIO(data), dst)
+    return dst.getvalue()
+
+
+def test_probe_reads_metadata_and_keyframes():
+    info = mp4.probe(io.BytesIO(_movie()))
+    assert info["duration"] == 6.0
+    assert (info["codec"], info["width"], info["height"]) == ("avc1", 640, 360)
+    assert info["keyframes"] == [0.0, 3.0]
+    assert info["keyframe_offsets"] == [MDAT_PAYLOAD, MDAT_PAYLOAD + 30]
+    assert not info["faststart"]
+
+
+@pytest.mark.parametrize("offset_table", [b"stco", b"co64"])
+def test_faststart_moves_moov_and_rewrites_chunk_offsets(offset_table):
+    original = _movie(offset_table, trailing=_box(b"free", b"\0" * 5))
+    rewritten = _rewrite(original)
+    assert len(rewritten) == len(original)
+
+    types = [b[0] for b in mp4.iter_top_level_boxes(io.BytesIO(rewritten), len(rewritten))]
+    assert types == [b"ftyp", b"moov", b"mdat", b"free"]
+
+    info = mp4.probe(io.BytesIO(rewritten))
+    assert info["faststart"]
+    assert info["keyframes"] == [0.0, 3.0]
+    # The patched offsets still point at the same samples, now behind the moved moov.
+    assert [rewritten[o:o + 10] for o in info["keyframe_offsets"]] == [SAMPLES[0], SAMPLES[3]]
+
+
+def test_faststart_leaves_input_position_alone():
+    src = io.BytesIO(_movie())
+    src.seek(7)
+    mp4.faststart(src, io.BytesIO())
+    assert src.tell() == 7
+
+
+def test_faststart_skips_files_that_need_no_rewrite():
+    rewritten = _rewrite(_movie())
+    dst = io.BytesIO()
+    assert not mp4.faststart(io.BytesIO(rewritten), dst) # Already fast-start
+    assert not mp4.faststart(io.BytesIO(b"not an mp4 at all"), dst)
+    assert dst.getvalue() == b""
+
+
+def test_faststart_rejects_truncated_moov_children():
+    movie = bytearray(_movie())
+    moov_offset = len(movie) - len(_moov([0, 0])) # Offset values don't change the moov size
+    # Claim the mvhd child is larger than the moov that holds it.
+    struct.pack_into(">I", movie, moov_offset + 8, 10_000)
+    with pytest.raises(mp4.MP4Error):
+        mp4.faststart(io.BytesIO(bytes(movie)), io.BytesIO())
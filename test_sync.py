@@ -0,0 +1,66 @@
+# test_sync.py
+import pytest
+
+import server
+import sync
+
+
+@pytest.fixture(autouse=True)
+def playback_state(monkeypatch):
+    monkeypatch.setattr(server, "PLAYBACK_STATE", {})
+
+
+def _intent(action, sender, clock, current_time=None):
+    return sync.build_sync_message(action, sender, current_time, timestamp=0.0, clock=clock)
+
+
+def test_intent_key_breaks_clock_ties_by_origin():
+    assert sync.intent_key(_intent("play", "alice", 3)) < sync.intent_key(_intent("pause", "bob", 3))
+    assert sync.intent_key(_intent("pause", "bob", 3)) < sync.intent_key(_intent("play", "alice", 4))
+    # Unclocked (legacy) messages sort before every clocked intent.
+    assert sync.intent_key({"action": "play", "sender": "zed"}) < sync.intent_key(_intent("play", "alice", 1))
+
+
+def test_record_playback_tie_goes_to_higher_origin():
+    assert server.record_playback("g1", _intent("play", "alice", 3))
+    assert server.record_playback("g1", _intent("pause", "bob", 3))
+    assert server.PLAYBACK_STATE["g1"]["paused"]
+    # Same clock, lower origin: loses the tie in either arrival order.
+    assert not server.record_playback("g1", _intent("play", "alice", 3))
+    assert server.PLAYBACK_STATE["g1"]["paused"]
+    assert server.PLAYBACK_STATE["g1"]["origin"] == "bob"
+
+
+def test_record_playback_drops_stale_and_duplicate_intents():
+    assert server.record_playback("g1", _intent("seek", "alice", 5, 120.0))
+    assert not server.record_playback("g1", _intent("seek", "bob", 4, 30.0)) # Overtaken in flight
+    assert not server.record_playback("g1", _intent("seek", "alice", 5, 120.0)) # Redelivered
+    assert server.PLAYBACK_STATE["g1"]["position"] == 120.0
+    assert server.record_playback("g1", _intent("seek", "bob", 6, 30.0))
+    assert server.PLAYBACK_STATE["g1"]["position"] == 30.0
+
+
+def test_record_playback_relays_unclocked_messages():
+    assert server.record_playback("g1", _intent("play", "alice", 9))
+    assert server.record_playback("g1", sync.build_sync_message("pause", "bob", timestamp=0.0))
+    assert server.PLAYBACK_STATE["g1"]["paused"]
+
+
+def test_playback_intents_apply_newest_and_drop_stale():
+    player = sync.PlaybackIntents("carol")
+    assert player.receive(_intent("seek", "alice", 2, 60.0)) == ("seek", 60.0)
+    assert player.receive(_intent("seek", "bob", 2, 200.0)) == ("seek", 200.0) # Tie: bob > alice
+    assert player.receive(_intent("seek", "alice", 2, 60.0)) is None
+    assert player.receive(_intent("play", "alice", 1)) is None
+    # The next local intent is ordered after everything seen so far.
+    message = player.local_event("play")
+    assert message["clock"] == 3 and message["intentId"] == "carol:3"
+
+
+def test_playback_intents_swallow_echoes_of_applied_intent():
+    player = sync.PlaybackIntents("carol")
+    assert player.receive(_intent("play", "alice", 1)) == ("play", None)
+    assert player.local_event("play") is None # The 'play' event our own player.play() fires
+    assert player.receive(_intent("seek", "alice", 2, 45.0)) == ("seek", 45.0)
+    assert player.local_event("seek", 45.2) is None # Its 'seeked' event
+    assert player.local_event("seek", 90.0)["clock"] == 3 # A real user seek afterwards
@@ -0,0 +1,25 @@
+# test_sync_sim.py
+import pytest
+
+import sync_sim
+
+
+@pytest.mark.parametrize("protocol", sync_sim.PROTOCOLS)
+def test_same_seed_same_result(protocol):
+    scenario, network = sync_sim.SCENARIOS["conflicting_seek"], sync_sim.NETWORKS["mobile"]
+    first = sync_sim.Simulation(scenario, network, 7, protocol=protocol).run()
+    again = sync_sim.Simulation(scenario, network, 7, protocol=protocol).run()
+    assert first == again
+
+
+def test_lamport_sends_no_echoes_and_loses_no_actions():
+    for name in ("play_pause", "simultaneous_play", "conflicting_seek"):
+        result = sync_sim.run_benchmark(sync_sim.SCENARIOS[name], sync_sim.NETWORKS["wan"], 1, 5, protocol="lamport")
+        assert result["redundant_messages_max"] == 0, name
+        assert result["lost_actions"] == 0, name
+
+
+def test_simultaneous_play_converges_with_lamport():
+    result = sync_sim.run_benchmark(sync_sim.SCENARIOS["simultaneous_play"], sync_sim.NETWORKS["lan"], 1, 5, protocol="lamport")
+    assert result["not_converged"] == 0
+    assert result["final_drift_max_s"] < sync_sim.CONVERGENCE_TOLERANCE_S
@@ -0,0 +1,106 @@
+# test_uploads.py
+import io
+import os
+
+import pytest
+
+import uploads
+
+CHUNK = 16
+DATA = bytes(range(256))[:5 * CHUNK - 3] # Five chunks, the last one short
+
+
+@pytest.fixture(autouse=True)
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(uploads, "CHUNK_SIZE", CHUNK)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def _interrupt_after(byte_count):
+    def progress(written, size):
+        if written >= byte_count:
+            raise Interrupted()
+    return progress
+
+
+def test_stream_to_disk_resumes_after_last_confirmed_chunk():
+    with pytest.raises(Interrupted):
+        uploads.stream_to_disk(io.BytesIO(DATA), "alice", "movie.bin", len(DATA), _interrupt_after(2 * CHUNK))
+
+    progress = []
+    upload = uploads.stream_to_disk(io.BytesIO(DATA), "alice", "movie.bin", len(DATA),
+                                    lambda written, size: progress.append(written))
+    assert progress[0] == 3 * CHUNK # Chunks 0 and 1 were not written again
+    assert upload.is_complete
+    with open(upload.path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_stream_to_disk_reuses_a_finished_upload():
+    first = uploads.stream_to_disk(io.BytesIO(DATA), "alice", "movie.bin", len(DATA))
+    progress = []
+    again = uploads.stream_to_disk(io.BytesIO(DATA), "alice", "movie.bin", len(DATA),
+                                   lambda written, size: progress.append(written))
+    assert again.upload_id == first.upload_id
+    assert progress == [len(DATA)]
+
+
+def test_different_file_with_same_name_and_size_gets_its_own_upload():
+    other = bytes(reversed(DATA))
+    first = uploads.stream_to_disk(io.BytesIO(DATA), "alice", "movie.bin", len(DATA))
+    second = uploads.stream_to_disk(io.BytesIO(other), "alice", "movie.bin", len(other))
+    assert second.upload_id != first.upload_id
+    with open(first.path, "rb") as f:
+        assert f.read() == DATA # Still what groups referencing it will stream
+
+
+def test_changed_content_behind_the_same_head(monkeypatch):
+    # Files that only differ after the bytes head_digest() covers share an upload ID.
+    monkeypatch.setattr(uploads, "head_digest", lambda source: "same head")
+    edited = DATA[:3 * CHUNK] + bytes(b ^ 0xFF for b in DATA[3 * CHUNK:]) # Differs from chunk 3 on
+    with pytest.raises(Interrupted):
+        uploads.stream_to_disk(io.BytesIO(DATA), "alice", "movie.bin", len(DATA), _interrupt_after(4 * CHUNK))
+    progress = []
+    upload = uploads.stream_to_disk(io.BytesIO(edited), "alice", "movie.bin", len(edited),
+                                    lambda written, size: progress.append(written))
+    assert progress[0] == CHUNK # The partial attempt was discarded, not resumed
+    with open(upload.path, "rb") as f:
+        assert f.read() == edited
+
+    # A finished upload may be streamed by a group, so it is never replaced.
+    with pytest.raises(uploads.UploadError, match="already holds a different file"):
+        uploads.stream_to_disk(io.BytesIO(DATA), "alice", "movie.bin", len(DATA))
+    with open(upload.path, "rb") as f:
+        assert f.read() == edited
+
+
+def test_read_chunk_returns_verified_chunks():
+    upload = uploads.stream_to_disk(io.BytesIO(DATA), "alice", "movie.bin", len(DATA))
+    chunks = [uploads.read_chunk(upload.upload_id, i) for i in range(upload.total_chunks)]
+    assert b"".join(data for data, _ in chunks) == DATA
+    assert [digest for _, digest in chunks] == upload.chunk_hashes
+    with pytest.raises(uploads.UploadError):
+        uploads.read_chunk(upload.upload_id, upload.total_chunks)
+
+
+def test_read_chunk_rejects_bytes_that_dont_match_the_manifest():
+    upload = uploads.stream_to_disk(io.BytesIO(DATA), "alice", "movie.bin", len(DATA))
+    with open(upload.path, "r+b") as f:
+        f.seek(CHUNK + 1)
+        f.write(b"\xff")
+    assert uploads.read_chunk(upload.upload_id, 0)[0] == DATA[:CHUNK]
+    with pytest.raises(uploads.UploadError, match="doesn't match"):
+        uploads.read_chunk(upload.upload_id, 1)
+
+
+def test_read_chunk_refuses_incomplete_uploads():
+    with pytest.raises(Interrupted):
+        uploads.stream_to_disk(io.BytesIO(DATA), "alice", "movie.bin", len(DATA), _interrupt_after(CHUNK))
+    upload_id = uploads.upload_id_for("alice", "movie.bin", len(DATA), uploads.head_digest(io.BytesIO(DATA)))
+    assert os.path.exists(os.path.join(uploads.UPLOAD_DIR, f"{upload_id}.part"))
+    with pytest.raises(uploads.UploadError, match="not complete"):
+        uploads.read_chunk(upload_id, 0)
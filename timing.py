@@ -0,0 +1,182 @@
+# timing.py
+"""
+Per-rerun timing for the Streamlit app (main.py).
+
+main.py runs every rerun inside track_rerun() and wraps its expensive stages in
+section("name"). Each finished rerun becomes one record:
+
+    {"cause": ..., "total_ms": ..., "sections": {name: ms, ...}, "ended_by": ...}
+
+Records are kept per session (the last TIMING_HISTORY, shown by render_panel()) and
+folded into process-wide aggregates that are logged every TIMING_REPORT_S.
+
+The cause is the reason the rerun happened. Code that triggers one calls
+rerun(cause) instead of st.rerun(), which leaves the cause in
+st.session_state.rerun_cause for the next run to pick up:
+
+    chat        the user sent a chat message
+    button      a button or other control (sign in, play, leave, theme, ...)
+    component   a value from the script.js bridge (e.g. received chat)
+    state       the app's own state changed under it (e.g. the group disappeared)
+
+Most reruns are started by Streamlit itself (a click or widget change in the
+browser) and carry no tag. For those, track_rerun() compares the widget values in
+st.session_state with the ones the previous run ended with:
+
+    button      a keyed button (or checkbox) turned True
+    widget      any other keyed widget changed value (text, select, form inputs, ...)
+    component   a bridge value is waiting in st.session_state.component_value
+    other       nothing to go by (first load, unkeyed controls)
+
+Configured through environment variables:
+    APP_TIMING_HISTORY     Reruns kept per session (default 50).
+    APP_TIMING_REPORT_S    Interval of the aggregate log lines (default 300, 0 disables).
+    APP_TIMING_PANEL       Set to 1 to show the timings panel in the sidebar.
+"""
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import streamlit as st
+
+from stats import percentile
+
+logger = logging.getLogger(__name__)
+
+TIMING_HISTORY = int(os.environ.get("APP_TIMING_HISTORY", "50"))
+TIMING_REPORT_S = float(os.environ.get("APP_TIMING_REPORT_S", "300"))
+TIMING_PANEL = os.environ.get("APP_TIMING_PANEL") == "1"
+AGGREGATE_SAMPLES = 1024 # Samples kept per section/cause for the logged percentiles
+RERUN_CAUSES = ("chat", "button", "component", "state")
+HISTORY_KEY = "rerun_timings"
+WIDGET_VALUES_KEY = "rerun_widget_values" # Widget values at the end of the previous run
+_OWN_KEYS = ("rerun_cause", HISTORY_KEY, WIDGET_VALUES_KEY)
+
+# Each session's script runs in its own thread, so the rerun being timed is thread-local.
+_current = threading.local()
+
+# Process-wide aggregates across all sessions: {name: deque of ms}
+_lock = threading.Lock()
+_sections = defaultdict(lambda: deque(maxlen=AGGREGATE_SAMPLES))
+_causes = defaultdict(lambda: deque(maxlen=AGGREGATE_SAMPLES))
+_last_report = time.monotonic()
+
+
+def rerun(cause: str):
+    """Records why the next run happens, then reruns the script (like st.rerun())."""
+    st.session_state.rerun_cause = cause if cause in RERUN_CAUSES else "other"
+    st.rerun()
+
+@contextmanager
+def section(name: str):
+    """Times one stage of the current rerun. Repeated sections add up."""
+    record = getattr(_current, "record", None)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if record is not None:
+            record["sections"][name] = record["sections"].get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+def _widget_values() -> dict:
+    """The plain (widget-like) values in st.session_state."""
+    return {key: value for key, value in st.session_state.items()
+            if key not in _OWN_KEYS and isinstance(value, (bool, int, float, str))}
+
+def _infer_cause() -> str:
+    """Why Streamlit started this run, judged from what changed since the previous one ended."""
+    if isinstance(st.session_state.get("component_value"), dict):
+        return "component"
+    previous = st.session_state.get(WIDGET_VALUES_KEY)
+    if previous is None:
+        return "other"
+    changed = {key: value for key, value in _widget_values().items()
+               if previous.get(key) != value and not (value is False and previous.get(key) is True)} # Buttons reset to False
+    if any(value is True for value in changed.values()):
+        return "button"
+    return "widget" if changed else "other"
+
+@contextmanager
+def track_rerun():
+    """Times a whole rerun. Also records reruns cut short by st.rerun() or st.stop()."""
+    record = {"cause": st.session_state.pop("rerun_cause", None) or _infer_cause(), "started_at": time.time(), "sections": {}}
+    _current.record = record
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e: # st.rerun()/st.stop() raise to end the run
+        record["ended_by"] = type(e).__name__
+        raise
+    finally:
+        _current.record = None
+        record["total_ms"] = (time.perf_counter() - started) * 1000
+        _finish(record)
+
+def _finish(record: dict):
+    global _last_report
+    # Sign-out clears the session state mid-run; the history simply starts over.
+    history = st.session_state.get(HISTORY_KEY)
+    if history is None:
+        history = st.session_state[HISTORY_KEY] = deque(maxlen=TIMING_HISTORY)
+    history.append(record)
+    st.session_state[WIDGET_VALUES_KEY] = _widget_values()
+    logger.debug(f"Rerun ({record['cause']}) took {record['total_ms']:.1f} ms: {record['sections']}")
+
+    with _lock:
+        for name, ms in record["sections"].items():
+            _sections[name].append(ms)
+        _causes[record["cause"]].append(record["total_ms"])
+        now = time.monotonic()
+        due = TIMING_REPORT_S and now - _last_report >= TIMING_REPORT_S
+        if due:
+            _last_report = now
+    if due:
+        log_aggregates()
+
+def _stats(values) -> dict:
+    values = sorted(values)
+    return {"count": len(values), "p50_ms": round(percentile(values, 50), 1),
+            "p95_ms": round(percentile(values, 95), 1), "max_ms": round(values[-1], 1) if values else 0.0}
+
+def aggregates() -> dict:
+    """Process-wide per-section and per-cause statistics (over the last AGGREGATE_SAMPLES of each)."""
+    with _lock:
+        return {"sections": {name: _stats(v) for name, v in _sections.items()},
+                "causes": {name: _stats(v) for name, v in _causes.items()}}
+
+def log_aggregates():
+    stats = aggregates()
+    for kind in ("causes", "sections"):
+        for name, s in sorted(stats[kind].items(), key=lambda item: -item[1]["p95_ms"]):
+            logger.info(f"Rerun timing {kind[:-1]} '{name}': {s['count']} samples, p50 {s['p50_ms']:.1f} ms, "
+                        f"p95 {s['p95_ms']:.1f} ms, max {s['max_ms']:.1f} ms")
+
+def render_panel():
+    """Sidebar panel with this session's recent reruns (only with APP_TIMING_PANEL=1)."""
+    if not TIMING_PANEL:
+        return
+    history = list(st.session_state.get(HISTORY_KEY, ()))
+    with st.expander("⏱️ Rerun timings", expanded=False):
+        if not history:
+            st.caption("No reruns timed yet.")
+            return
+        last = history[-1]
+        st.caption(f"Last rerun: {last['total_ms']:.0f} ms ({last['cause']}) · {len(history)} reruns kept")
+        by_section = defaultdict(list)
+        by_cause = defaultdict(list)
+        for record in history:
+            by_cause[record["cause"]].append(record["total_ms"])
+            for name, ms in record["sections"].items():
+                by_section[name].append(ms)
+        st.markdown("**By section**")
+        st.dataframe([{"section": name, **_stats(v)} for name, v in sorted(by_section.items(), key=lambda item: -sum(item[1]))],
+                     hide_index=True, use_container_width=True)
+        st.markdown("**By cause**")
+        st.dataframe([{"cause": name, **_stats(v)} for name, v in by_cause.items()], hide_index=True, use_container_width=True)
+        st.markdown("**Recent reruns**")
+        st.dataframe([{"cause": r["cause"], "total_ms": round(r["total_ms"], 1), "ended_by": r.get("ended_by", ""),
+                       **{name: round(ms, 1) for name, ms in r["sections"].items()}} for r in reversed(history)],
+                     hide_index=True, use_container_width=True)
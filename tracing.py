@@ -0,0 +1,224 @@
+# tracing.py
+"""
+Profiling hooks for the relay (server.py).
+
+- LoopMonitor samples event-loop lag (how late a sleep wakes up) and runs a watchdog
+  thread that logs the loop thread's stack when the loop stops ticking for too long.
+- Tracer records sampled per-frame spans (parse, fan-out, per-recipient send) in the
+  Chrome Trace Event format, which chrome://tracing, Perfetto and speedscope can open.
+
+Configured through environment variables:
+    RELAY_LAG_INTERVAL_MS   How often to sample loop lag (default 100).
+    RELAY_STALL_MS          Loop stall that triggers a stack capture (default 200).
+    RELAY_LAG_REPORT_S      Interval of the lag summary log line (default 60, 0 disables).
+    RELAY_TRACE_FILE        Where to write frame traces; unset disables tracing.
+    RELAY_TRACE_SAMPLE      Fraction of frames to trace (default 0.01).
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import deque
+
+from stats import percentile
+
+# Configure logger for this module
+logger = logging.getLogger(__name__)
+
+LAG_INTERVAL_MS = float(os.environ.get("RELAY_LAG_INTERVAL_MS", "100"))
+STALL_MS = float(os.environ.get("RELAY_STALL_MS", "200"))
+LAG_REPORT_S = float(os.environ.get("RELAY_LAG_REPORT_S", "60"))
+TRACE_FILE = os.environ.get("RELAY_TRACE_FILE") or None
+TRACE_SAMPLE = float(os.environ.get("RELAY_TRACE_SAMPLE", "0.01"))
+LAG_HISTORY = 1024 # Samples kept for the periodic summary
+
+
+def _now_us() -> float:
+    return time.perf_counter_ns() / 1000
+
+
+# --- Trace Writer ---
+
+class Tracer:
+    """
+    Appends Chrome trace events to a file. The file is a JSON array left open at the end,
+    which the format explicitly allows, so events can be streamed and a file cut short still
+    opens. Writes go through a 1 MB buffer that is flushed with every lag report and on close,
+    so a crash loses the events since the last flush.
+    """
+
+    def __init__(self, path: str | None = None, sample_rate: float = TRACE_SAMPLE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock() # The watchdog thread writes stall events too
+        self._file = None
+        self._tids = weakref.WeakKeyDictionary()
+        self._next_tid = itertools.count(1)
+        self._pid = os.getpid()
+        if path:
+            self._file = open(path, "w", buffering=1024 * 1024)
+            self._file.write("[\n")
+            logger.info(f"Tracing {sample_rate:.1%} of relay frames to {path}")
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        return cls(TRACE_FILE, TRACE_SAMPLE)
+
+    @property
+    def enabled(self) -> bool:
+        return self._file is not None
+
+    def emit(self, event: dict):
+        if not self._file:
+            return
+        event.setdefault("pid", self._pid)
+        with self._lock:
+            if self._file: # Checked again: close() may have run since (e.g., from another thread)
+                self._file.write(json.dumps(event, separators=(",", ":")) + ",\n")
+
+    def thread_id(self, connection, label: str | None = None) -> int:
+        """A stable trace 'thread' per connection, named after `label` in the viewer."""
+        tid = self._tids.get(connection)
+        if tid is None:
+            tid = self._tids[connection] = next(self._next_tid)
+            if label:
+                self.emit({"name": "thread_name", "ph": "M", "tid": tid, "args": {"name": label}})
+        return tid
+
+    def frame(self, connection, label: str | None = None, **args) -> "FrameSpan | None":
+        """Starts tracing one received frame, or returns None if it isn't sampled."""
+        if not self._file or random.random() >= self.sample_rate:
+            return None
+        return FrameSpan(self, self.thread_id(connection, label), args)
+
+    def flush(self):
+        with self._lock:
+            if self._file:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+class FrameSpan:
+    """
+    Timeline of one relayed frame. Its start is the moment the frame was received;
+    mark() closes the current phase, send() records each recipient's write separately.
+    """
+
+    def __init__(self, tracer: Tracer, tid: int, args: dict):
+        self.tracer = tracer
+        self.tid = tid
+        self.args = args
+        self.start_us = self._phase_start = _now_us()
+
+    def mark(self, phase: str, **args):
+        now = _now_us()
+        self.tracer.emit({"name": phase, "cat": "relay", "ph": "X", "ts": self._phase_start,
+                          "dur": now - self._phase_start, "tid": self.tid, "args": args})
+        self._phase_start = now
+
+    def send(self, task: asyncio.Task, recipient_tid: int):
+        """Records a 'send' span on the recipient's row when `task` finishes."""
+        started = _now_us()
+        def done(t: asyncio.Task):
+            self.tracer.emit({"name": "send", "cat": "relay", "ph": "X", "ts": started,
+                              "dur": _now_us() - started, "tid": recipient_tid,
+                              "args": {"from": self.tid, "cancelled": t.cancelled()}})
+        task.add_done_callback(done)
+
+    def end(self, **args):
+        self.args.update(args)
+        self.tracer.emit({"name": "frame", "cat": "relay", "ph": "X", "ts": self.start_us,
+                          "dur": _now_us() - self.start_us, "tid": self.tid, "args": self.args})
+
+
+# --- Event Loop Monitor ---
+
+class LoopMonitor:
+    """
+    Measures event-loop lag and catches stalls.
+
+    The sampler task sleeps `interval_ms` and records how late it woke up. A watchdog
+    thread watches the sampler's heartbeat; when the loop hasn't ticked for `stall_ms`,
+    it captures the loop thread's current stack (via sys._current_frames), which names
+    the blocking code while it is still running.
+    """
+
+    def __init__(self, tracer: Tracer | None = None, interval_ms: float = LAG_INTERVAL_MS,
+                 stall_ms: float = STALL_MS, report_s: float = LAG_REPORT_S):
+        self.tracer = tracer or Tracer(None)
+        self.interval_s = interval_ms / 1000
+        self.stall_s = stall_ms / 1000
+        self.report_s = report_s
+        self.lags_ms = deque(maxlen=LAG_HISTORY)
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the sampler on the running loop and the watchdog thread."""
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        self._thread = threading.Thread(target=self._watchdog, name="relay-loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"Loop monitor started (interval {self.interval_s * 1000:.0f} ms, stall threshold {self.stall_s * 1000:.0f} ms)")
+
+    def stop(self):
+        """Stops the sampler and waits for the watchdog, so nothing is emitted after this returns."""
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+        if self._thread:
+            self._thread.join(timeout=max(1.0, self.stall_s))
+
+    def summary(self) -> dict:
+        lags = sorted(self.lags_ms)
+        return {"samples": len(lags), "p50_ms": percentile(lags, 50), "p99_ms": percentile(lags, 99),
+                "max_ms": lags[-1] if lags else 0.0, "stalls": self.stalls}
+
+    async def _sample(self):
+        last_report = time.monotonic()
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval_s)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag_ms = max(0.0, (now - before - self.interval_s) * 1000)
+            self.lags_ms.append(lag_ms)
+            if self.tracer.enabled:
+                self.tracer.emit({"name": "loop_lag_ms", "ph": "C", "ts": _now_us(), "tid": 0, "args": {"lag": round(lag_ms, 3)}})
+            if self.report_s and now - last_report >= self.report_s:
+                last_report = now
+                s = self.summary()
+                logger.info(f"Loop lag over last {s['samples']} samples: p50 {s['p50_ms']:.1f} ms, p99 {s['p99_ms']:.1f} ms, max {s['max_ms']:.1f} ms, stalls {s['stalls']}")
+                self.tracer.flush()
+
+    def _watchdog(self):
+        reported_heartbeat = None
+        while not self._stop.wait(self.stall_s / 2):
+            heartbeat = self._heartbeat
+            stalled_for = time.monotonic() - heartbeat - self.interval_s
+            if stalled_for < self.stall_s or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat # One capture per stall
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<loop thread not found>\n"
+            logger.warning(f"Event loop blocked for {stalled_for * 1000:.0f} ms; loop thread is at:\n{stack}")
+            self.tracer.emit({"name": "loop_stall", "ph": "i", "s": "g", "ts": _now_us(), "tid": 0,
+                              "args": {"blocked_ms": round(stalled_for * 1000), "stack": stack}})
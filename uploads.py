@@ -0,0 +1,341 @@
+# uploads.py
+import hashlib
+import json
+import logging
+import os
+
+import mp4
+
+# Configure logger for this module
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = "uploads" # Where group videos are written
+CHUNK_SIZE = 4 * 1024 * 1024 # Bytes per chunk; also bounds the extra memory used per upload
+
+
+class UploadError(Exception):
+    """Raised when an upload cannot be written or does not match its manifest."""
+
+
+def upload_id_for(username: str, filename: str, size: int, head_digest: str) -> str:
+    """
+    The resume key of an upload; stable across attempts by the same user with the same file.
+    `head_digest` (see head_digest()) ties it to the content, so a different file with the
+    same name and size gets its own ID instead of replacing one a group may be streaming.
+    """
+    return hashlib.sha256(f"{username}\0{filename}\0{size}\0{head_digest}".encode("utf-8")).hexdigest()[:16]
+
+def head_digest(source, chunk_size: int = CHUNK_SIZE) -> str:
+    """SHA-256 of the first chunk of a seekable source (read once, then rewound)."""
+    source.seek(0)
+    digest = hashlib.sha256(source.read(chunk_size)).hexdigest()
+    source.seek(0)
+    return digest
+
+
+class ChunkedUpload:
+    """
+    A video being written to disk chunk by chunk.
+
+    Progress lives in a JSON manifest next to the partial file, listing the SHA-256 of
+    every chunk that has been written and fsync'ed ("confirmed"). A later attempt for the
+    same user, filename, size and first chunk picks up after the last confirmed chunk.
+    """
+
+    def __init__(self, username: str, filename: str, size: int, head: str, chunk_size: int | None = None):
+        self.filename = filename
+        self.size = size
+        self.upload_id = upload_id_for(username, filename, size, head)
+        extension = os.path.splitext(filename)[1].lower()
+        self.part_path = os.path.join(UPLOAD_DIR, f"{self.upload_id}.part")
+        self.path = os.path.join(UPLOAD_DIR, f"{self.upload_id}{extension}")
+        self.manifest_path = os.path.join(UPLOAD_DIR, f"{self.upload_id}.json")
+        self.manifest = {"filename": filename, "size": size, "chunk_size": chunk_size or CHUNK_SIZE, "chunks": [], "complete": False}
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        self._load_manifest()
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"Ignoring unreadable upload manifest {self.manifest_path}: {e}")
+            return
+        data_path = self.path if manifest.get("complete") else self.part_path
+        expected_bytes = min(len(manifest.get("chunks", [])) * manifest.get("chunk_size", 0), self.size)
+        if (manifest.get("size") != self.size or not os.path.exists(data_path)
+                or os.path.getsize(data_path) < expected_bytes):
+            logger.warning(f"Upload manifest {self.manifest_path} doesn't match the data on disk. Starting over.")
+            return
+        self.manifest = manifest
+        logger.info(f"Resuming upload {self.upload_id} at chunk {self.confirmed_chunks}/{self.total_chunks}.")
+
+    def _save_manifest(self):
+        # Write-then-rename so a crash never leaves a half-written manifest behind.
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    @property
+    def chunk_size(self) -> int:
+        return self.manifest["chunk_size"]
+
+    @property
+    def total_chunks(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    @property
+    def confirmed_chunks(self) -> int:
+        return len(self.manifest["chunks"])
+
+    @property
+    def bytes_confirmed(self) -> int:
+        return min(self.confirmed_chunks * self.chunk_size, self.size)
+
+    @property
+    def is_complete(self) -> bool:
+        return self.manifest["complete"]
+
+    @property
+    def chunk_hashes(self) -> list:
+        return list(self.manifest["chunks"])
+
+    @property
+    def source_chunk_hashes(self) -> list:
+        """Chunk hashes of the file as uploaded (before any fast-start rewrite)."""
+        return list(self.manifest.get("source_chunks", self.manifest["chunks"]))
+
+    @property
+    def digest(self) -> str | None:
+        """SHA-256 over the chunk hashes (a hash list), available once the upload is complete."""
+        return self.manifest.get("digest")
+
+    def write_chunk(self, index: int, data: bytes):
+        """
+        Writes and confirms one chunk. Chunks must arrive in order.
+
+        Args:
+            index (int): Zero-based chunk number; must equal confirmed_chunks.
+            data (bytes): The chunk contents (CHUNK_SIZE bytes except for the last chunk).
+
+        Raises:
+            UploadError: If the chunk is out of order or the wrong size.
+        """
+        if index != self.confirmed_chunks:
+            raise UploadError(f"Expected chunk {self.confirmed_chunks}, got {index}")
+        expected = min(self.chunk_size, self.size - index * self.chunk_size)
+        if len(data) != expected:
+            raise UploadError(f"Chunk {index} has {len(data)} bytes, expected {expected}")
+        mode = "r+b" if os.path.exists(self.part_path) else "wb"
+        with open(self.part_path, mode) as f:
+            f.seek(index * self.chunk_size)
+            f.write(data)
+            f.truncate() # Drop anything past this chunk left by an abandoned attempt
+            f.flush()
+            os.fsync(f.fileno())
+        self.manifest["chunks"].append(hashlib.sha256(data).hexdigest())
+        self._save_manifest()
+
+    def finalize(self) -> str:
+        """
+        Marks the upload complete and moves it to its final path.
+
+        Returns:
+            str: The path of the finished video.
+        """
+        if self.is_complete:
+            return self.path
+        if self.bytes_confirmed != self.size:
+            raise UploadError(f"Upload {self.upload_id} has {self.bytes_confirmed}/{self.size} bytes")
+        os.replace(self.part_path, self.path)
+        self.manifest["digest"] = hashlib.sha256("".join(self.manifest["chunks"]).encode("ascii")).hexdigest()
+        self.manifest["complete"] = True
+        self._save_manifest()
+        logger.info(f"Upload {self.upload_id} complete: {self.path} ({self.size} bytes, digest {self.digest[:12]})")
+        return self.path
+
+    def apply_faststart(self) -> bool:
+        """
+        Rewrites the finished video to fast-start layout (moov first) if needed, then
+        re-hashes it so the manifest's chunk hashes describe the file actually served.
+
+        Returns:
+            bool: True if the file was rewritten.
+        """
+        tmp_path = self.path + ".faststart"
+        try:
+            with open(self.path, "rb") as src, open(tmp_path, "wb") as dst:
+                rewritten = mp4.faststart(src, dst)
+            if rewritten:
+                os.replace(tmp_path, self.path)
+        except mp4.MP4Error as e:
+            logger.warning(f"Fast-start rewrite skipped for {self.path}: {e}")
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if rewritten:
+            # Keep the hashes of the bytes as uploaded, so a later attempt can still be matched
+            # against its source (see stream_to_disk).
+            self.manifest.setdefault("source_chunks", self.manifest["chunks"])
+            chunks = []
+            with open(self.path, "rb") as f:
+                while data := f.read(self.chunk_size):
+                    chunks.append(hashlib.sha256(data).hexdigest())
+            self.manifest["chunks"] = chunks
+            self.manifest["digest"] = hashlib.sha256("".join(chunks).encode("ascii")).hexdigest()
+            self.manifest["faststart"] = True
+            self._save_manifest()
+        return rewritten
+
+    def metadata_if_available(self) -> dict | None:
+        """
+        Probes the confirmed prefix of the file. For fast-start MP4s the metadata (moov)
+        is at the front, so this succeeds long before the media data has arrived.
+
+        Returns:
+            dict | None: mp4.probe() output with bitrate for the full size, or None if
+                         the metadata hasn't arrived yet (or the file isn't an MP4/MOV).
+        """
+        data_path = self.path if self.is_complete else self.part_path
+        if not os.path.exists(data_path):
+            return None
+        with open(data_path, "rb") as f:
+            try:
+                boxes = list(mp4.iter_top_level_boxes(f, self.bytes_confirmed))
+                moov = next((b for b in boxes if b[0] == b"moov"), None)
+                if moov is None or moov[1] + moov[3] > self.bytes_confirmed:
+                    return None
+                info = mp4.probe(f)
+            except mp4.MP4Error as e:
+                logger.warning(f"Could not read metadata of upload {self.upload_id}: {e}")
+                return None
+        if info and info.get("duration"):
+            info["bitrate"] = int(self.size * 8 / info["duration"])
+        return info
+
+
+def _matches_source(upload: ChunkedUpload, source) -> bool:
+    """
+    Spot-checks that `source` is the file an earlier attempt wrote: the last confirmed chunk,
+    and for a finished upload the first chunk as well. Hashes are compared against the
+    chunks as uploaded, since a fast-start rewrite changes the bytes on disk.
+    """
+    hashes = upload.source_chunk_hashes
+    indexes = {0, len(hashes) - 1} if upload.is_complete else {len(hashes) - 1}
+    for index in sorted(indexes):
+        source.seek(index * upload.chunk_size)
+        if hashlib.sha256(source.read(upload.chunk_size)).hexdigest() != hashes[index]:
+            return False
+    return True
+
+def stream_to_disk(source, username: str, filename: str, size: int,
+                   progress_callback=None, metadata_callback=None) -> ChunkedUpload:
+    """
+    Copies a file-like upload to UPLOAD_DIR in CHUNK_SIZE pieces, resuming after the last
+    confirmed chunk of an earlier attempt, then rewrites it to fast-start layout.
+    Only one chunk is held in memory at a time.
+
+    Args:
+        source: A seekable binary file object (e.g., a Streamlit UploadedFile).
+        username (str): The uploading user (part of the resume key).
+        filename (str): The original file name.
+        size (int): The total size in bytes.
+        progress_callback (callable, optional): Called as (bytes_written, size) after each chunk.
+        metadata_callback (callable, optional): Called once with the probed metadata as soon
+                                                as the chunks containing it are on disk.
+
+    Returns:
+        ChunkedUpload: The finalized upload.
+
+    Raises:
+        UploadError: If the source can't be read to the end, or a different file with the
+                     same upload ID (same name, size and first chunk) is already complete.
+    """
+    head = head_digest(source)
+    upload = ChunkedUpload(username, filename, size, head)
+    metadata_sent = False
+    if upload.confirmed_chunks and not _matches_source(upload, source):
+        # Same name, size and first chunk, different content. A finished upload may be what
+        # a group is streaming (video_info["relay_upload_id"]), so it is never replaced.
+        if upload.is_complete:
+            raise UploadError(f"Upload {upload.upload_id} already holds a different file with the same name, size and beginning")
+        logger.warning(f"Upload {upload.upload_id} content changed since the last attempt. Starting over.")
+        os.remove(upload.manifest_path)
+        upload = ChunkedUpload(username, filename, size, head)
+
+    source.seek(upload.bytes_confirmed)
+    while not upload.is_complete and upload.bytes_confirmed < size:
+        data = source.read(upload.chunk_size)
+        if not data:
+            raise UploadError(f"Source ended at {upload.bytes_confirmed} of {size} bytes")
+        upload.write_chunk(upload.confirmed_chunks, data)
+        if progress_callback:
+            progress_callback(upload.bytes_confirmed, size)
+        if metadata_callback and not metadata_sent:
+            info = upload.metadata_if_available()
+            if info:
+                metadata_sent = True
+                metadata_callback(info)
+    path = upload.finalize()
+    if not upload.manifest.get("faststart"):
+        upload.apply_faststart()
+    if metadata_callback and not metadata_sent:
+        # Metadata was at the end of the file (or it isn't an MP4): report what we can now.
+        metadata_callback(upload.metadata_if_available() or {})
+    if progress_callback:
+        progress_callback(size, size)
+    logger.info(f"Streamed '{filename}' for {username} to {path}")
+    return upload
+
+
+# --- Serving Finished Uploads ---
+
+def load_manifest(upload_id: str) -> dict | None:
+    """Returns the manifest of an upload, or None if there is no readable manifest for it."""
+    try:
+        with open(os.path.join(UPLOAD_DIR, f"{os.path.basename(upload_id)}.json"), "r") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return None
+
+def completed_upload_path(upload_id: str) -> str | None:
+    """Path of a finished upload's video, or None if it doesn't exist or is still being written."""
+    manifest = load_manifest(upload_id)
+    if not manifest or not manifest.get("complete"):
+        return None
+    extension = os.path.splitext(manifest["filename"])[1].lower()
+    path = os.path.join(UPLOAD_DIR, f"{os.path.basename(upload_id)}{extension}")
+    return path if os.path.exists(path) else None
+
+def read_chunk(upload_id: str, index: int) -> tuple[bytes, str]:
+    """
+    Reads one chunk of a finished upload and checks it against the manifest.
+
+    Args:
+        upload_id (str): The upload to read.
+        index (int): Zero-based chunk number.
+
+    Returns:
+        tuple[bytes, str]: The chunk and its SHA-256 (as recorded in the manifest).
+
+    Raises:
+        UploadError: If the upload isn't complete, the index is out of range, or the
+                     bytes on disk don't match the recorded hash.
+    """
+    manifest = load_manifest(upload_id)
+    path = completed_upload_path(upload_id)
+    if not manifest or not path:
+        raise UploadError(f"Upload {upload_id} is not complete")
+    if not 0 <= index < len(manifest["chunks"]):
+        raise UploadError(f"Upload {upload_id} has no chunk {index}")
+    with open(path, "rb") as f:
+        f.seek(index * manifest["chunk_size"])
+        data = f.read(manifest["chunk_size"])
+    expected = manifest["chunks"][index]
+    if hashlib.sha256(data).hexdigest() != expected:
+        raise UploadError(f"Chunk {index} of upload {upload_id} doesn't match its manifest hash")
+    return data, expected